@@ -1,22 +1,87 @@
 import numpy as np
-from scipy.spatial import ConvexHull
-from scipy.spatial._qhull import QhullError
+
+
+# foot markers in the order of the support polygon, around the outline of both feet
+CBOS_MARKER_NAMES = ["Left_foot2", "Left_foot3", "Left_foot_heel", "Right_foot_heel", "Right_foot3", "Right_foot2"]
+
+
+def compute_support_polygon_centroid(points):
+    # area centroid (shoelace formula) of the horizontal polygon through the (x, y, z) `points` in order, with the mean z
+    # of the points. plain python arithmetic, fast for a single polygon. returns None for a degenerate polygon.
+    area = centroid_x = centroid_y = centroid_z = 0.0
+    x0, y0 = points[-1][0], points[-1][1]
+    for x1, y1, z1 in points:
+        cross = x0 * y1 - x1 * y0
+        area += cross
+        centroid_x += (x0 + x1) * cross
+        centroid_y += (y0 + y1) * cross
+        centroid_z += z1
+        x0, y0 = x1, y1
+
+    if abs(area) < 1e-12:
+        return None
+    return centroid_x / (3 * area), centroid_y / (3 * area), centroid_z / len(points)
 
 
 def compute_cbos(markers):
-    # https://stackoverflow.com/questions/31562534/scipy-centroid-of-convex-hull
-    # markers must be in the order that forms a convex polygon
-    marker_keys = ["Left_foot2", "Left_foot3", "Left_foot_heel", "Right_foot_heel", "Right_foot3", "Right_foot2"]
-    marker_positions = []
-    for key in marker_keys:
-        marker_positions.append(markers[key])
-    
-    marker_positions = np.stack(marker_positions, axis=0)
-
-    try:
-        hull = ConvexHull(marker_positions)
-        centroid = np.mean(hull.points[hull.vertices], axis=0)
-    except QhullError:
-        centroid = np.zeros(3)
-
-    return centroid
\ No newline at end of file
+    # centroid of the base of support of a dict of marker positions, zeros if the polygon is degenerate
+    centroid = compute_support_polygon_centroid(np.stack([markers[key] for key in CBOS_MARKER_NAMES], axis=0).tolist())
+    return np.zeros(3) if centroid is None else np.array(centroid)
+
+
+def compute_cbos_batch(positions, marker_names):
+    # vectorized version of `compute_cbos` over a whole recording.
+    # `positions` is an (N, len(marker_names), 3) array, returns the (N, 3) CBOS, zeros for degenerate polygons.
+    points = positions[:, [marker_names.index(key) for key in CBOS_MARKER_NAMES]]
+    x0, y0 = np.roll(points[:, :, 0], 1, axis=1), np.roll(points[:, :, 1], 1, axis=1)
+    x1, y1 = points[:, :, 0], points[:, :, 1]
+    cross = x0 * y1 - x1 * y0
+    area = cross.sum(axis=1)
+
+    is_valid = np.abs(area) >= 1e-12
+    area = np.where(is_valid, area, 1.0)
+    cbos = np.stack([((x0 + x1) * cross).sum(axis=1) / (3 * area), ((y0 + y1) * cross).sum(axis=1) / (3 * area), points[:, :, 2].mean(axis=1)], axis=1)
+    cbos[~is_valid] = 0.0
+    return cbos
+
+
+class CbosTracker:
+    # CBOS of every frame, compared with the reference CBOS the screen is centered on. the feet count as moved when the CBOS
+    # stays more than `movement_threshold` m (horizontally) away from the reference for `movement_frames` consecutive frames,
+    # which ignores marker noise and short jumps. frames with an occluded foot marker keep the previous CBOS.
+
+    def __init__(self, marker_names, movement_threshold=0.02, movement_frames=20):
+        self.marker_idxs = [marker_names.index(key) for key in CBOS_MARKER_NAMES]
+        self.movement_threshold = movement_threshold
+        self.movement_frames = movement_frames
+
+        self.cbos = np.zeros(3)
+        self.reference = None
+        self.n_moved_frames = 0
+        self.foot_moved = False
+
+    def set_reference(self, reference):
+        self.reference = reference.tolist()
+        self.n_moved_frames = 0
+        self.foot_moved = False
+
+    def update(self, marker_positions, marker_occluded=None):
+        # `marker_positions` is the (len(marker_names), 3) frame, `marker_occluded` its occlusion flags.
+        # converted to python lists once, numpy indexing of a few elements costs more than the centroid itself
+        if marker_occluded is not None:
+            occluded = marker_occluded.tolist()
+            for marker_idx in self.marker_idxs:
+                if occluded[marker_idx]:
+                    return self.cbos
+        rows = marker_positions.tolist()
+        centroid = compute_support_polygon_centroid([rows[marker_idx] for marker_idx in self.marker_idxs])
+        if centroid is None:
+            return self.cbos
+        self.cbos = np.array(centroid)
+
+        if self.reference is not None:
+            distance = ((centroid[0] - self.reference[0]) ** 2 + (centroid[1] - self.reference[1]) ** 2) ** 0.5
+            self.n_moved_frames = self.n_moved_frames + 1 if distance > self.movement_threshold else 0
+            if self.n_moved_frames >= self.movement_frames:
+                self.foot_moved = True
+        return self.cbos
@@ -30,6 +30,104 @@ def create_marker_dict(positions, measurement_idx, ignore={}):
 
     return markers
 
+def stack_marker_positions(positions, marker_names):
+    # (N, len(marker_names), 3) array from a dict of per-marker (N, 3) arrays
+    return np.stack([np.asarray(positions[marker_name], dtype=float) for marker_name in marker_names], axis=1)
+
+def compute_com_batch(positions, marker_names, height_adjustment_ratio, weight_adjustment_ratio):
+    # vectorized version of `compute_com` over a whole recording.
+    # `positions` is an (N, len(marker_names), 3) array, returns the (N, 3) COM and a dict of (N, 3) intermediate positions.
+    positions = np.asarray(positions, dtype=float)
+    assert positions.ndim == 3 and positions.shape[1:] == (len(marker_names), 3), "Positions must be of shape (N, len(marker_names), 3)."
+    marker_idxs = {marker_name: idx for idx, marker_name in enumerate(marker_names)}
+
+    left_thigh = positions[:, marker_idxs["Upper_body_left_thigh"]]
+    right_thigh = positions[:, marker_idxs["Upper_body_right_thigh"]]
+    left_heel = positions[:, marker_idxs["Left_foot_heel"]]
+    right_heel = positions[:, marker_idxs["Right_foot_heel"]]
+    neck = positions[:, marker_idxs["Upper_body_neck"]]
+
+    # get adjusted lengths
+    lh2 = height_adjustment_ratio * NOMINAL_LH2
+    ld = height_adjustment_ratio * NOMINAL_LD
+    lb = height_adjustment_ratio * NOMINAL_LB
+    rhob = height_adjustment_ratio * NOMINAL_RHOB
+    rhoc = height_adjustment_ratio * NOMINAL_RHOC
+    rhoa1 = height_adjustment_ratio * NOMINAL_RHOA1
+    rhoa2 = height_adjustment_ratio * NOMINAL_RHOA2
+    rhod2 = height_adjustment_ratio * NOMINAL_RHOD2
+    rhoh2 = height_adjustment_ratio * NOMINAL_RHOH2
+
+    # get adjusted weights
+    torso_weight = weight_adjustment_ratio * NOMINAL_TORSO_WEIGHT
+    pelvis_weight = weight_adjustment_ratio * NOMINAL_PELVIS_WEIGHT
+    foot_weight = weight_adjustment_ratio * NOMINAL_FOOT_WEIGHT
+    shank_weight = weight_adjustment_ratio * NOMINAL_SHANK_WEIGHT
+    thigh_weight = weight_adjustment_ratio * NOMINAL_THIGH_WEIGHT
+
+    def norm(v):
+        return np.sqrt(np.einsum("ij,ij->i", v, v))[:, None]
+
+    def interpolate(a, b, ratio):
+        return a * ratio + b * (1 - ratio)
+
+    # get the positions of all missing markers
+    midpoint = 0.5 * (left_thigh + right_thigh)
+
+    inner_thigh_ratio = (ld / 2) / (norm(midpoint - left_thigh) + 1e-8)
+    inner_thigh_left = interpolate(midpoint, left_thigh, inner_thigh_ratio)
+    inner_thigh_right = interpolate(midpoint, right_thigh, inner_thigh_ratio)
+
+    knee_left = interpolate(left_heel, inner_thigh_left, lb / (norm(inner_thigh_left - left_heel) + 1e-8))
+    knee_right = interpolate(right_heel, inner_thigh_right, lb / (norm(inner_thigh_right - right_heel) + 1e-8))
+
+    # obtain lower back marker position, see `compute_com`
+    hip_distance = norm(right_thigh - left_thigh)[:, 0]
+    lower_back_denominator = hip_distance + (left_thigh[:, 2] + right_thigh[:, 2]) / 2 + 1e-8
+    lower_back = midpoint.copy()
+    lower_back[:, 0] += lh2 * (left_thigh[:, 2] - right_thigh[:, 2]) / lower_back_denominator
+    lower_back[:, 2] += lh2 * (left_thigh[:, 0] - right_thigh[:, 0]) / lower_back_denominator
+
+    # get COMs of all the lower body parts
+    thigh_left_com = interpolate(inner_thigh_left, knee_left, rhoc / (norm(knee_left - inner_thigh_left) + 1e-8))
+    thigh_right_com = interpolate(inner_thigh_right, knee_right, rhoc / (norm(knee_right - inner_thigh_right) + 1e-8))
+
+    shank_left_com = interpolate(knee_left, left_heel, rhob / (norm(knee_left - left_heel) + 1e-8))
+    shank_right_com = interpolate(knee_right, right_heel, rhob / (norm(knee_right - right_heel) + 1e-8))
+
+    foot_offset = np.array([0.0, rhoa1, rhoa2])
+    foot_left_com = left_heel - foot_offset
+    foot_right_com = right_heel - foot_offset
+
+    # get COMs of all the upper body parts
+    pelvis_com = interpolate(midpoint, lower_back, rhod2 / lh2)
+    torso_com = interpolate(lower_back, neck, rhoh2 / (norm(lower_back - neck) + 1e-8))
+
+    # get the actual center of mass
+    all_weights = np.array([torso_weight, pelvis_weight, thigh_weight, thigh_weight, shank_weight, shank_weight, foot_weight, foot_weight])
+    com = (torso_com * all_weights[0] + pelvis_com * all_weights[1] +
+           thigh_left_com * all_weights[2] + thigh_right_com * all_weights[3] +
+           shank_left_com * all_weights[4] + shank_right_com * all_weights[5] +
+           foot_left_com * all_weights[6] + foot_right_com * all_weights[7]) / all_weights.sum()
+
+    intermediates = {
+        "midpoint": midpoint,
+        "lower_back": lower_back,
+        "inner_thigh_left": inner_thigh_left,
+        "inner_thigh_right": inner_thigh_right,
+        "knee_left": knee_left,
+        "knee_right": knee_right,
+        "torso_com": torso_com,
+        "pelvis_com": pelvis_com,
+        "thigh_left_com": thigh_left_com,
+        "thigh_right_com": thigh_right_com,
+        "shank_left_com": shank_left_com,
+        "shank_right_com": shank_right_com,
+        "foot_left_com": foot_left_com,
+        "foot_right_com": foot_right_com,
+    }
+    return com, intermediates
+
 def compute_com(markers, height_adjustment_ratio, weight_adjustment_ratio, plot=False):
     # get adjusted lengths
     lh2 = height_adjustment_ratio * NOMINAL_LH2
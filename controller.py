@@ -1,14 +1,88 @@
 import struct 
 import socket
+import select
+from time import monotonic
 
 import numpy as np
 
 
+# framed motor command: version, sequence number, monotonic send time, mode, force (little-endian, 22 bytes).
+# the puller acknowledges it with version, sequence number, the echoed send time and its own receive time.
+PROTOCOL_VERSION = 1
+COMMAND_FORMAT = struct.Struct("<BIdBd")
+ACK_FORMAT = struct.Struct("<BIdd")
+COMMAND_MODES = ["regular", "channel", "none"]
+
+
+class CommandTelemetry:
+    # round-trip times, losses and reordering of framed motor commands, from their acknowledgements
+
+    def __init__(self, capacity=100000, window=1024):
+        self.round_trip_times = np.zeros(capacity)
+        self.n_sent = 0
+        self.n_acked = 0
+        self.n_reordered = 0
+        self.n_duplicates = 0
+        self.max_acked_sequence = -1
+        # RFC 3550 style jitter, smoothed mean of the differences between consecutive round-trip times
+        self.jitter = 0.0
+        # exponentially smoothed round-trip time, as in TCP
+        self.smoothed_round_trip_time = None
+        # acknowledged sequence numbers of the last `window` commands as a bitmap, bit i is `max_acked_sequence - i`
+        # (a sliding window like the anti-replay window of IPsec). older acknowledgements count as duplicates.
+        self.window = window
+        self._acked_bits = 0
+        self._prev_round_trip_time = None
+
+    def add_ack(self, sequence, send_time, receive_time):
+        if sequence > self.max_acked_sequence:
+            self._acked_bits = ((self._acked_bits << (sequence - self.max_acked_sequence)) | 1) & ((1 << self.window) - 1)
+            self.max_acked_sequence = sequence
+        else:
+            offset = self.max_acked_sequence - sequence
+            if offset >= self.window or (self._acked_bits >> offset) & 1:
+                self.n_duplicates += 1
+                return
+            self._acked_bits |= 1 << offset
+            self.n_reordered += 1
+
+        round_trip_time = receive_time - send_time
+        self.round_trip_times[self.n_acked % len(self.round_trip_times)] = round_trip_time
+        self.n_acked += 1
+
+        if self.smoothed_round_trip_time is None:
+            self.smoothed_round_trip_time = round_trip_time
+        else:
+            self.smoothed_round_trip_time += (round_trip_time - self.smoothed_round_trip_time) / 8
+        if self._prev_round_trip_time is not None:
+            self.jitter += (abs(round_trip_time - self._prev_round_trip_time) - self.jitter) / 16
+        self._prev_round_trip_time = round_trip_time
+
+    def to_dict(self):
+        round_trip_times = self.round_trip_times[:min(self.n_acked, len(self.round_trip_times))] * 1e6
+        has_acks = len(round_trip_times) > 0
+        return {
+            "sent": self.n_sent,
+            "acked": self.n_acked,
+            # commands still in flight count as lost
+            "lost": self.n_sent - self.n_acked,
+            "reordered": self.n_reordered,
+            "duplicates": self.n_duplicates,
+            "rtt_p50_us": float(np.percentile(round_trip_times, 50)) if has_acks else None,
+            "rtt_p99_us": float(np.percentile(round_trip_times, 99)) if has_acks else None,
+            "rtt_max_us": float(round_trip_times.max()) if has_acks else None,
+            "jitter_us": self.jitter * 1e6,
+            "smoothed_rtt_us": self.smoothed_round_trip_time * 1e6 if has_acks else None,
+        }
+
+
 class MotorController:
     
-    def __init__(self, address="178.172.42.144", port=9005, max_velocity=0.5):
+    def __init__(self, address="178.172.42.144", port=9005, max_velocity=0.5, protocol="raw"):
+        assert protocol in {"raw", "framed"}, "Protocol must be {raw, framed}."
         self.address = address
         self.port = port
+        self.protocol = protocol
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         
         self.force_amplification = 0
@@ -18,9 +92,57 @@ class MotorController:
         self.direction = None
         self.force_mode = None
         
-    def send_force(self, force):
-        data = struct.pack("d", force)
-        self.socket.sendto(data, (self.address, self.port))
+        if protocol == "framed":
+            # acknowledgements are read without blocking after every command
+            self.socket.setblocking(False)
+            self.sequence = 0
+            self.telemetry = CommandTelemetry()
+        
+    def send_force(self, force, perturbation_mode="regular"):
+        if self.protocol == "raw":
+            data = struct.pack("d", force)
+            self.socket.sendto(data, (self.address, self.port))
+            return
+        
+        mode = "none" if self.force_mode == "none" else perturbation_mode
+        data = COMMAND_FORMAT.pack(PROTOCOL_VERSION, self.sequence, monotonic(), COMMAND_MODES.index(mode), force)
+        try:
+            self.socket.sendto(data, (self.address, self.port))
+        except BlockingIOError:
+            pass
+        self.sequence = (self.sequence + 1) % 2 ** 32
+        self.telemetry.n_sent += 1
+        self.poll_acks()
+    
+    def poll_acks(self, timeout=0.0):
+        # reads the pending acknowledgements, waiting up to `timeout` s for the first one. the round-trip times
+        # include the time an acknowledgement waits for this call, see `poll_acks_until`.
+        if timeout > 0:
+            select.select([self.socket], [], [], timeout)
+        while True:
+            try:
+                data = self.socket.recv(ACK_FORMAT.size)
+            except (BlockingIOError, ConnectionResetError):
+                # on Windows, an unreachable port is reported on the next recv
+                return
+            receive_time = monotonic()
+            if len(data) == ACK_FORMAT.size:
+                version, sequence, send_time, _ = ACK_FORMAT.unpack(data)
+                if version == PROTOCOL_VERSION:
+                    self.telemetry.add_ack(sequence, send_time, receive_time)
+        
+    def poll_acks_until(self, deadline):
+        # reads the acknowledgements as they arrive until the monotonic `deadline`, e.g. the next deadline of the control
+        # loop, so the round-trip times do not include the wait for the next command
+        while monotonic() < deadline:
+            self.poll_acks(timeout=deadline - monotonic())
+
+    def get_network_latency(self):
+        # one-way command latency in s, half of the smoothed round-trip time; unknown (0) without framed commands. only
+        # unbiased if the acknowledgements are read as they arrive (`poll_acks_until`)
+        if self.protocol != "framed" or self.telemetry.smoothed_round_trip_time is None:
+            return 0.0
+        return self.telemetry.smoothed_round_trip_time / 2
         
     def get_force(self, coordinates, perturbation_mode):
         assert len(coordinates) == 3
@@ -45,6 +167,22 @@ class MotorController:
             return 0.0
         return force
     
+    def get_force_batch(self, velocities, positions, perturbation_modes, force_amplifications):
+        # vectorized `get_force` over N frames; `force_amplifications` replaces the per-frame `set_force_amplification`
+        assert self.direction is not None, "You have to set direction before obtaining force."
+        assert self.force_mode is not None, "You have to set force_mode before obtaining force."
+        perturbation_modes = np.asarray(perturbation_modes)
+        assert np.all(np.isin(perturbation_modes, ["regular", "channel"]))
+
+        if self.force_mode != "regular":
+            return np.zeros(len(perturbation_modes))
+
+        velocities = np.clip(velocities, -self.max_velocity, self.max_velocity)
+        regular_force = self.direction * np.abs(velocities[:, 0]) * force_amplifications * self.participant_weight
+        channel_force = -1 * positions[:, 1] * force_amplifications * self.participant_weight
+        force = np.where(perturbation_modes == "regular", regular_force, channel_force)
+        return np.where(np.isnan(force), 0.0, force)
+    
     def set_force_amplification(self, force_amplification):
         self.force_amplification = force_amplification
 
@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from experiment_logging import (find_sessions, get_session_config_filename, get_session_trials_filename, read_trial_index, read_session_columns,
+                                derive_trial_index, TrajectoryContainerWriter, TrajectoryReader)
+
+
+# per-trial columns of the dataset; integer columns are int64 because int32 columns are categorical codes in the container
+INTEGER_COLUMNS = ["participant_id", "session_idx", "trial_idx", "block_idx"]
+FLOAT_COLUMNS = ["start_time", "end_time", "reaction_time", "movement_time", "hold_time", "success", "peak_velocity", "peak_velocity_x", "peak_motor_force", "current_force_amplification",
+                 "force_amplification", "desired_velocity_min", "desired_velocity_max", "desired_trial_time_min", "desired_trial_time_max"]
+CATEGORY_COLUMNS = ["session", "side", "perturbation_mode", "force_mode", "force_direction"]
+SESSION_COLUMNS = ["marker_velocity.0", "marker_velocity.1", "marker_velocity.2", "motor_force", "perturbation_mode", "current_force_amplification"]
+
+
+def discover_sessions(results_path):
+    # sessions of all participant folders; a session converted to .traj is read from the .traj file
+    filenames = {os.path.splitext(filename)[0]: filename for filename in find_sessions(results_path, extension="tsv")}
+    filenames.update({os.path.splitext(filename)[0]: filename for filename in find_sessions(results_path, extension="traj")})
+    return [filenames[stem] for stem in sorted(filenames.keys())]
+
+
+def get_session_signature(filename):
+    # changes whenever the session, its trial index (if it was logged) or its config is rewritten
+    paths = [filename, get_session_trials_filename(filename), get_session_config_filename(filename)]
+    return [[os.path.getsize(path), os.path.getmtime(path)] for path in paths if os.path.exists(path)]
+
+
+def aggregate_session(filename):
+    # one row per trial of the trial index, joined with the block parameters of the logged experiment config.
+    # success is nan for trials interrupted by a pause or the end of the experiment.
+    experiment_config = json.load(open(get_session_config_filename(filename), "r"))
+    # sessions logged before the trial index existed get it from their logged states
+    trials_filename = get_session_trials_filename(filename)
+    trials = read_trial_index(trials_filename) if os.path.exists(trials_filename) else derive_trial_index(filename)
+    session = read_session_columns(filename, SESSION_COLUMNS)
+    velocities = np.stack([session[f"marker_velocity.{idx}"].astype(float) for idx in range(3)], axis=1)
+    speeds = np.sqrt((velocities ** 2).sum(axis=1))
+    motor_forces = np.abs(session["motor_force"].astype(float))
+    force_amplifications = session["current_force_amplification"].astype(float)
+    participant_id = int(os.path.basename(os.path.dirname(filename)).split("_")[-1])
+    session_idx = int(os.path.splitext(os.path.basename(filename))[0].split("_")[-1])
+
+    rows = {name: [] for name in INTEGER_COLUMNS + FLOAT_COLUMNS + CATEGORY_COLUMNS}
+    for trial in trials:
+        # velocities over the movement, forces over the movement and the hold (the perturbation is set when the movement
+        # starts and kept until the outcome); nan for trials interrupted before the movement
+        start_row, end_row = trial["start_row"], min(trial["end_row"], len(speeds))
+        if start_row >= end_row:
+            continue
+        movement_start_row, movement_end_row = trial["movement_start_row"], trial["movement_end_row"]
+        movement_start_row = end_row if movement_start_row is None else min(movement_start_row, end_row)
+        movement_end_row = end_row if movement_end_row is None else min(movement_end_row, end_row)
+        movement_start_time, movement_end_time = trial["movement_start_time"], trial["movement_end_time"]
+        has_movement = movement_start_row < movement_end_row
+        has_perturbation = movement_start_row < end_row
+        block = experiment_config["experiment"][trial["block_idx"]]
+        row = {
+            "participant_id": participant_id,
+            "session_idx": session_idx,
+            "trial_idx": trial["trial_idx"],
+            "block_idx": trial["block_idx"],
+            "start_time": trial["start_time"],
+            "end_time": trial["end_time"],
+            "reaction_time": np.nan if movement_start_time is None else movement_start_time - trial["start_time"],
+            "movement_time": np.nan if movement_end_time is None else movement_end_time - movement_start_time,
+            "hold_time": np.nan if movement_end_time is None else trial["end_time"] - movement_end_time,
+            "success": np.nan if trial["success"] is None else float(trial["success"]),
+            "peak_velocity": speeds[movement_start_row:movement_end_row].max() if has_movement else np.nan,
+            "peak_velocity_x": np.abs(velocities[movement_start_row:movement_end_row, 0]).max() if has_movement else np.nan,
+            "peak_motor_force": motor_forces[movement_start_row:end_row].max() if has_perturbation else np.nan,
+            "current_force_amplification": force_amplifications[movement_start_row:end_row].max() if has_perturbation else np.nan,
+            "force_amplification": block["force_amplification"],
+            "desired_velocity_min": block["desired_velocity"][0],
+            "desired_velocity_max": block["desired_velocity"][1],
+            "desired_trial_time_min": block["desired_trial_time"][0],
+            "desired_trial_time_max": block["desired_trial_time"][1],
+            "session": filename,
+            "side": trial["side"],
+            "perturbation_mode": str(session["perturbation_mode"][end_row - 1]),
+            "force_mode": block["force_mode"],
+            "force_direction": block["force_direction"],
+        }
+        for name, value in row.items():
+            rows[name].append(value)
+
+    columns = {name: np.array(rows[name], dtype=np.int64) for name in INTEGER_COLUMNS}
+    columns.update({name: np.array(rows[name], dtype=float) for name in FLOAT_COLUMNS})
+    columns.update({name: np.array(rows[name], dtype=str) for name in CATEGORY_COLUMNS})
+    return filename, columns
+
+
+def read_dataset(filename):
+    # columns of a dataset written by `write_dataset`, categories as strings
+    reader = TrajectoryReader(filename)
+    columns = {}
+    for name in reader.column_names:
+        columns[name] = reader.read_column(name).copy()
+        if name in reader.labels:
+            columns[name] = reader.decode_categories(name, columns[name]).astype(str)
+    reader.close()
+    return columns
+
+
+def write_dataset(filename, columns):
+    # writes to a temporary file first, so an interrupted write keeps the previous dataset
+    labels = {}
+    encoded_columns = {}
+    for name, values in columns.items():
+        if name in CATEGORY_COLUMNS:
+            labels[name], codes = np.unique(values, return_inverse=True)
+            encoded_columns[name] = codes.ravel().astype(np.int32)
+        else:
+            encoded_columns[name] = values
+    writer = TrajectoryContainerWriter(filename + ".tmp")
+    writer.write_columns(encoded_columns, labels=labels)
+    writer.close()
+    os.replace(filename + ".tmp", filename)
+
+
+def aggregate(results_path, output_filename, n_workers=None):
+    # rebuilds the per-trial dataset of all sessions in `results_path`. sessions that are unchanged since the last run are taken
+    # from the existing dataset, new and changed sessions are processed in a process pool.
+    manifest_filename = output_filename + ".json"
+    manifest = {}
+    if os.path.exists(output_filename) and os.path.exists(manifest_filename):
+        manifest = json.load(open(manifest_filename, "r"))
+
+    filenames = discover_sessions(results_path)
+    signatures = {filename: get_session_signature(filename) for filename in filenames}
+    names = INTEGER_COLUMNS + FLOAT_COLUMNS + CATEGORY_COLUMNS
+    unchanged = {filename for filename in filenames if manifest.get(filename) == signatures[filename]}
+
+    session_columns = {}
+    if len(unchanged) > 0:
+        columns = read_dataset(output_filename)
+        # a dataset with other columns, written by an older version, is rebuilt
+        if set(columns.keys()) != set(names):
+            unchanged = set()
+        for filename in unchanged:
+            is_session = columns["session"] == filename
+            session_columns[filename] = {name: values[is_session] for name, values in columns.items()}
+    pending = [filename for filename in filenames if filename not in unchanged]
+
+    n_workers = n_workers or cpu_count()
+    print(datetime.now(), f"- {len(filenames)} sessions, {len(unchanged)} unchanged, processing {len(pending)} on {n_workers} workers.")
+    if len(pending) > 0:
+        with Pool(min(n_workers, len(pending))) as pool:
+            for n_done, (filename, columns) in enumerate(pool.imap_unordered(aggregate_session, pending), start=1):
+                session_columns[filename] = columns
+                print(datetime.now(), f"- {n_done} of {len(pending)} done.", end="\r")
+        print()
+
+    columns = {name: np.concatenate([session_columns[filename][name] for filename in filenames]) if len(filenames) > 0 else np.zeros(0) for name in names}
+    write_dataset(output_filename, columns)
+    json.dump(signatures, open(manifest_filename, "w"), indent=4)
+    return columns
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggregate the trials of all participants and sessions into one columnar dataset, in parallel.")
+    parser.add_argument("--results_path", type=str, default=None, help="Defaults to the results_path in experiment_config.json.")
+    parser.add_argument("--output", type=str, default=None, help="Dataset file, defaults to trials.traj in --results_path. An existing dataset is updated with new and changed sessions.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes, defaults to the number of CPUs.")
+    args = parser.parse_args()
+
+    results_path = args.results_path or json.load(open("experiment_config.json", "r"))["results_path"]
+    output_filename = args.output or os.path.join(results_path, "trials.traj")
+    columns = aggregate(results_path, output_filename, n_workers=args.workers)
+    print(datetime.now(), f"- Saved {len(columns['trial_idx'])} trials of {len(np.unique(columns['session']))} sessions to {output_filename}")
@@ -1,15 +1,18 @@
+import argparse
 import json
-from time import time, sleep
+from time import time
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import numpy as np
 import matplotlib.pyplot as plt
-import scipy
 
 from vicon import ViconClient, MARKER_NAMES
+from vicon_replay import create_replay_client
 from experiment_logging import Logger
-from com_computation import compute_com, create_marker_dict, NOMINAL_HEIGHT, NOMINAL_WEIGHT
+from loop_scheduler import DeadlineScheduler
+from com_computation import compute_com_batch, stack_marker_positions, NOMINAL_HEIGHT, NOMINAL_WEIGHT
+from stillness_detection import StillnessMonitor
 
 
 class DummyClient:
@@ -25,26 +28,58 @@ def record(total_time, vicon_client, frequency=100):
     recording_start = time()
     
     positions = defaultdict(list)
+    timestamps = []
+    scheduler = DeadlineScheduler(frequency)
+    scheduler.start()
     while (time() - recording_start) < total_time:
-        time_start = time()
-        for marker_name, position in vicon_client.get_current_position(None, mode=MARKER_NAMES)[0].items():
-            positions[marker_name].append(position)
+        marker_positions, _, _, marker_timestamp = vicon_client.get_frame()
+        for marker_idx, marker_name in enumerate(MARKER_NAMES):
+            positions[marker_name].append(marker_positions[marker_idx].copy())
+        timestamps.append(marker_timestamp)
 
         positions["cop"].append(vicon_client.get_center_of_pressure())
 
-        curr_frequency = 1 / (time() - time_start + 1e-8)
-        curr_frequency = np.round(curr_frequency, 2)
-        curr_frequency = np.clip(curr_frequency, 0, 999)
-        print("Capture frequency:", curr_frequency, " " * 20, end="\r")
-        if time() - time_start > (1 / frequency):
-            pass
-            # print(datetime.now(), "- Loop took too much time!", "%.3fs > (1/%d)s" % (time() - time_start, frequency))
-        else:
-            sleep((1 / frequency) - (time() - time_start))
+        scheduler.wait()
+        if scheduler.n_ticks % int(frequency) == 0:
+            print("Recorded %d frames, %d missed deadlines (at most %.1f ms late)" % (scheduler.n_ticks, scheduler.overruns, scheduler.max_lateness * 1000), " " * 20, end="\r")
+    print()
         
     for marker_name in positions.keys():
         positions[marker_name] = np.stack(positions[marker_name], axis=0)
-    return positions
+    return positions, timestamps
+
+
+def record_still(capture_time, vicon_client, frequency=100, settle_time=0.5, max_distance=0.05, max_std=0.01):
+    # records until all markers and the COP have been still for `settle_time` + `capture_time` s and returns the last
+    # `capture_time` s, with the live stillness status on the terminal
+    names = MARKER_NAMES + ["cop"]
+    capture_frames = int(round(capture_time * frequency))
+    monitor = StillnessMonitor(len(names), capture_frames + int(round(settle_time * frequency)), max_distance=max_distance, max_std=max_std)
+    frames = deque(maxlen=capture_frames)
+    timestamps = deque(maxlen=capture_frames)
+
+    scheduler = DeadlineScheduler(frequency)
+    scheduler.start()
+    is_still = False
+    frame_idx = 0
+    while not is_still:
+        marker_positions, _, _, marker_timestamp = vicon_client.get_frame()
+        frame = np.vstack([marker_positions, vicon_client.get_center_of_pressure()])
+        frames.append(frame)
+        timestamps.append(marker_timestamp)
+        is_still = monitor.update(frame)
+
+        # a status line every 50 ms is enough to follow
+        if frame_idx % max(int(frequency / 20), 1) == 0 or is_still:
+            worst_idx = int(np.argmax(monitor.ranges / max_distance))
+            print("Still for %.2f of %.2f s, largest movement %.1f mm (%s), std %.1f mm, restarts %d" % (
+                monitor.n_frames / frequency, monitor.window_frames / frequency, monitor.ranges[worst_idx] * 1000, names[worst_idx], monitor.stds.max() * 1000, monitor.n_restarts) + " " * 10, end="\r")
+        frame_idx += 1
+        scheduler.wait()
+    print()
+
+    positions = {name: np.stack([frame[idx] for frame in frames], axis=0) for idx, name in enumerate(names)}
+    return positions, list(timestamps)
 
 
 def plot_markers(positions):
@@ -60,16 +95,28 @@ def plot_markers(positions):
     
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replay", type=str, default=None, help="Replay a recorded session (e.g. calibration_recording.tsv) instead of connecting to Vicon.")
+    parser.add_argument("--replay_speed", type=float, default=1.0, help="Replay speed-up, 0 replays as fast as possible.")
+    parser.add_argument("--capture_time", type=float, default=2.0, help="Duration of the COM and COP capture in s.")
+    parser.add_argument("--settle_time", type=float, default=0.5, help="The participant has to be still for this long in s before the capture.")
+    parser.add_argument("--max_distance", type=float, default=0.05, help="Largest movement of every marker and the COP during the capture in m.")
+    parser.add_argument("--max_std", type=float, default=0.01, help="Largest standard deviation of every marker and the COP during the capture in m.")
+    args = parser.parse_args()
+    
     experiment_config = json.load(open("experiment_config.json", "r"))
     logger = Logger(experiment_config["results_path"], experiment_config["participant"]["id"], no_log=False)
     logger.save_experiment_config(experiment_config, filename="calibration_config.json")
     
-    vicon_client = ViconClient()
+    if args.replay is not None:
+        vicon_client = create_replay_client(args.replay, speed=args.replay_speed or None, loop=True)
+    else:
+        vicon_client = ViconClient()
 
     ### align feet with hips
     answer = ""
     while answer.lower() != "y":
-        positions = record(2.0, vicon_client, frequency=experiment_config["refresh_frequency"])
+        positions, _ = record(2.0, vicon_client, frequency=experiment_config["refresh_frequency"])
 
         left_thigh = positions["Upper_body_left_thigh"].mean(axis=0)
         right_thigh = positions["Upper_body_right_thigh"].mean(axis=0)
@@ -93,32 +140,20 @@ if __name__ == "__main__":
         answer = input("Positioning OK? (y)es, (n)o: ")
         print("=" * 50)
 
-    ### get measurements related to COM and COP
-    max_distance = 0.05 # m
-    while True:
-        input("Press <Enter> when ready to start recording.")
-        
-        positions = record(2.0, vicon_client, frequency=experiment_config["refresh_frequency"])
-        
-        for key, value in positions.items():
-            if scipy.spatial.distance.cdist(value, value).max() > max_distance:
-                print(f"Too much movement on marker {key}. Try again.")
-                break
-        else:
-            break
-        
+    ### get measurements related to COM and COP, captured as soon as the participant stands still
+    input("Press <Enter> when the participant is ready, the recording starts once they stand still.")
+    positions, timestamps = record_still(args.capture_time, vicon_client, frequency=experiment_config["refresh_frequency"], settle_time=args.settle_time, max_distance=args.max_distance, max_std=args.max_std)
+
     height_adjustment_ratio = experiment_config["participant"]["height"] / NOMINAL_HEIGHT
     weight_adjustment_ratio = experiment_config["participant"]["weight"] / NOMINAL_WEIGHT
 
-    for measurement_idx in range(len(positions["Upper_body_left_thigh"])):
-        markers = create_marker_dict(positions, measurement_idx, ignore={"com_approx"})
-        positions["com_approx"].append(compute_com(markers, height_adjustment_ratio, weight_adjustment_ratio, plot=False))
-        
-    positions["com_approx"] = np.stack(positions["com_approx"], axis=0)
+    marker_positions = stack_marker_positions(positions, MARKER_NAMES)
+    positions["com_approx"], _ = compute_com_batch(marker_positions, MARKER_NAMES, height_adjustment_ratio, weight_adjustment_ratio)
     
     # do a sanity check over all the positions.
     # note that COM is not supposed to be aligned along the Y axis.
     plot_markers(positions)
+    recording = dict(positions)
 
     for key, value in positions.items():
         positions[key] = value.mean(axis=0).tolist()
@@ -132,4 +167,5 @@ if __name__ == "__main__":
     print(positions["com_offset"])
 
     logger.save_com(positions)
+    logger.save_calibration_recording(recording, timestamps)
     
\ No newline at end of file
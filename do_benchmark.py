@@ -0,0 +1,266 @@
+import os
+# headless, must be set before pygame is initialized
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import argparse
+import json
+import platform
+import socket
+import subprocess
+import tempfile
+from datetime import datetime
+from time import perf_counter, sleep
+
+import numpy as np
+
+from experiment_logging import Logger
+from vicon import MARKER_NAMES
+from vicon_replay import create_replay_client
+from controller import MotorController
+from interface import Interface, RemoteInterface
+from state_machine import StateMachine
+from com_computation import compute_com, NOMINAL_HEIGHT, NOMINAL_WEIGHT
+from cbos_computation import compute_cbos
+from velocity_computation import VelocityEstimator
+from do_experiment import ExperimentLoop
+from loop_timing import LoopTimer
+from loop_scheduler import DeadlineScheduler
+from force_servo import ForceServo
+from puller_loopback import PullerLoopback
+from state_prediction import create_state_predictor
+
+
+# standing pose in m, x is the left-right axis the participant leans along
+NEUTRAL_POSE = {
+    "Left_foot2": [-0.05, 0.15, 0.03],
+    "Left_foot3": [-0.14, 0.10, 0.02],
+    "Left_foot_heel": [-0.09, -0.08, 0.05],
+    "Right_foot2": [0.05, 0.15, 0.03],
+    "Right_foot3": [0.14, 0.10, 0.02],
+    "Right_foot_heel": [0.09, -0.08, 0.05],
+    "Upper_body_left_thigh": [-0.11, 0.0, 0.95],
+    "Upper_body_neck": [0.0, -0.02, 1.5],
+    "Upper_body_right_thigh": [0.11, 0.0, 0.95],
+}
+
+
+class ScriptedParticipant(ExperimentLoop):
+    # always presses <Enter>, so the initial screen and the final exit screen pass immediately
+
+    def is_enter_pressed(self):
+        return True
+
+
+def write_scripted_session(filename, duration, frame_rate=200, sway=0.06, hold_time=3.5, movement_time=0.8, noise=0.0002, seed=42):
+    # a participant that holds the middle circle, then leans from one side circle to the other.
+    # the whole body is shifted, so the COM and the feet move by exactly the scripted sway.
+    rng = np.random.default_rng(seed)
+    times = np.arange(int(duration * frame_rate)) / frame_rate
+
+    # (time, x offset) waypoints; the left circle is drawn at +x, the right circle at -x
+    waypoints_t, waypoints_x = [0.0, hold_time], [0.0, 0.0]
+    side = 1
+    while waypoints_t[-1] < duration:
+        waypoints_t += [waypoints_t[-1] + movement_time, waypoints_t[-1] + movement_time + hold_time]
+        waypoints_x += [side * sway, side * sway]
+        side = -side
+
+    # minimum jerk between waypoints
+    segment_idxs = np.clip(np.searchsorted(waypoints_t, times, side="right") - 1, 0, len(waypoints_t) - 2)
+    t0, t1 = np.array(waypoints_t)[segment_idxs], np.array(waypoints_t)[segment_idxs + 1]
+    x0, x1 = np.array(waypoints_x)[segment_idxs], np.array(waypoints_x)[segment_idxs + 1]
+    tau = (times - t0) / (t1 - t0)
+    offsets = x0 + (x1 - x0) * (10 * tau ** 3 - 15 * tau ** 4 + 6 * tau ** 5)
+
+    column_names = [f"{marker_name}.{idx}" for marker_name in MARKER_NAMES for idx in range(3)] + ["marker_timestamp"]
+    with open(filename, "w") as session_file:
+        session_file.write("\t".join(column_names) + "\n")
+        for frame_idx in range(len(times)):
+            positions = np.array([NEUTRAL_POSE[marker_name] for marker_name in MARKER_NAMES]) + rng.normal(0, noise, size=(len(MARKER_NAMES), 3))
+            positions[:, 0] += offsets[frame_idx]
+            session_file.write("\t".join([str(value) for value in positions.ravel().tolist()] + [str(times[frame_idx])]) + "\n")
+
+
+def compute_participant_com(experiment_config):
+    # COM offset that puts the COM of the neutral pose above its CBOS, as do_before.py does with the COP
+    height_adjustment_ratio = experiment_config["participant"]["height"] / NOMINAL_HEIGHT
+    weight_adjustment_ratio = experiment_config["participant"]["weight"] / NOMINAL_WEIGHT
+    markers = {marker_name: np.array(position) for marker_name, position in NEUTRAL_POSE.items()}
+    com_offset = compute_cbos(markers) - compute_com(markers, height_adjustment_ratio, weight_adjustment_ratio)
+    com_offset[2] = 0
+    return {"com_offset": com_offset.tolist()}
+
+
+def latency_stats(durations):
+    # durations in s, statistics in us; jitter is the standard deviation
+    durations = np.asarray(durations) * 1e6
+    return {
+        "mean_us": float(durations.mean()),
+        "p50_us": float(np.percentile(durations, 50)),
+        "p99_us": float(np.percentile(durations, 99)),
+        "max_us": float(durations.max()),
+        "jitter_us": float(durations.std()),
+    }
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(experiment_config, duration, replay=None, acquisition_thread=False, async_log=False, log_format="tsv", no_log=False, render_process=False, force_servo_rate=0, spin_time=0.0, missed_deadline_policy="skip", motor_protocol="raw", prediction_model=None, warmup_ticks=200):
+    with tempfile.TemporaryDirectory() as results_path:
+        experiment_config = dict(experiment_config, results_path=results_path)
+        if prediction_model is not None:
+            experiment_config["prediction_model"] = prediction_model
+
+        if replay is None:
+            replay = os.path.join(results_path, "scripted_session.tsv")
+            write_scripted_session(replay, duration + 10, frame_rate=experiment_config["refresh_frequency"])
+        vicon_client = create_replay_client(replay, speed=1.0, velocity_buffer_size=experiment_config["velocity_buffer_size"])
+        if acquisition_thread:
+            vicon_client.start_acquisition()
+
+        # null motor sink, the forces are sent over UDP to a local socket that is never read. framed commands go to
+        # the puller loopback, which acknowledges them.
+        if motor_protocol == "framed":
+            motor_sink = PullerLoopback()
+            motor_port = motor_sink.port
+        else:
+            motor_sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            motor_sink.bind(("127.0.0.1", 0))
+            motor_port = motor_sink.getsockname()[1]
+        controller = MotorController(address="127.0.0.1", port=motor_port, protocol=motor_protocol)
+        controller.set_participant_weight(experiment_config["participant"]["weight"])
+        force_servo = ForceServo(controller, rate=force_servo_rate, max_kinematics_age=5 / experiment_config["refresh_frequency"]) if force_servo_rate > 0 else None
+
+        velocity_estimator = VelocityEstimator(len(MARKER_NAMES) + 1, buffer_size=experiment_config["velocity_buffer_size"], kernel=experiment_config.get("velocity_kernel", "boxcar"))
+        interface = RemoteInterface(display_number=0) if render_process else Interface(display_number=0)
+        logger = Logger(results_path, experiment_config["participant"]["id"], no_log=no_log, asynchronous=async_log, file_format=log_format)
+        experiment_loop = ScriptedParticipant(experiment_config, vicon_client, velocity_estimator, interface, StateMachine(seed=42), logger, controller, compute_participant_com(experiment_config), acquisition_thread=acquisition_thread, no_log=no_log, force_servo=force_servo, state_predictor=create_state_predictor(experiment_config, velocity_estimator))
+
+        n_ticks = int(duration * experiment_config["refresh_frequency"]) + warmup_ticks
+        stage_durations = np.zeros((n_ticks, len(ExperimentLoop.STAGES)))
+        tick_starts = np.zeros(n_ticks)
+        # cost of the always-on instrumentation of do_experiment.py
+        loop_timer = LoopTimer(ExperimentLoop.STAGES, len(experiment_config["experiment"]), experiment_config["refresh_frequency"])
+        timer_durations = np.zeros(n_ticks)
+        states = []
+
+        scheduler = DeadlineScheduler(experiment_config["refresh_frequency"], spin_time=spin_time, missed_deadline_policy=missed_deadline_policy)
+        tick_idx = 0
+        continue_loop = True
+        try:
+            scheduler.start()
+            while continue_loop and tick_idx < n_ticks:
+                continue_loop = experiment_loop.tick()
+                state_dict = experiment_loop.state_dict
+
+                stage_times = experiment_loop.stage_times
+                timer_start = perf_counter()
+                loop_timer.record(state_dict["block_idx"], stage_times)
+                timer_durations[tick_idx] = perf_counter() - timer_start
+                tick_starts[tick_idx] = stage_times[0]
+                for stage_idx in range(len(ExperimentLoop.STAGES)):
+                    stage_durations[tick_idx, stage_idx] = stage_times[stage_idx + 1] - stage_times[stage_idx]
+                states.append(state_dict["current_state"])
+                tick_idx += 1
+
+                # same acknowledgement polling and pacing as do_experiment.py
+                if controller.protocol == "framed" and force_servo is None:
+                    controller.poll_acks_until(scheduler.deadline - scheduler.spin_time)
+                scheduler.wait()
+        finally:
+            vicon_client.stop_acquisition()
+            logger.close()
+            interface.close()
+            if force_servo is not None:
+                force_servo.close()
+                force_servo_status = force_servo.get_status()
+            if motor_protocol == "framed":
+                # the last acknowledgements are still in flight
+                sleep(0.05)
+                controller.poll_acks()
+            motor_sink.close()
+
+    # the state machine runs in the state the previous tick ended in
+    start_states = np.array([str(None)] + states[:-1])
+    stage_durations, tick_starts, states, timer_durations = stage_durations[warmup_ticks:tick_idx], tick_starts[warmup_ticks:tick_idx], states[warmup_ticks:tick_idx], timer_durations[warmup_ticks:tick_idx]
+    start_states = start_states[warmup_ticks:tick_idx]
+    state_machine_durations = stage_durations[:, ExperimentLoop.STAGES.index("state_machine")]
+    assert len(tick_starts) > 1, "Benchmark too short, no ticks after the warm-up."
+    periods = np.diff(tick_starts)
+    target_period = 1 / experiment_config["refresh_frequency"]
+
+    return {
+        "metadata": {
+            "date": datetime.now().isoformat(),
+            "git_commit": get_git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "replay": None if replay.startswith(results_path) else replay,
+            "acquisition_thread": acquisition_thread,
+            "async_log": async_log,
+            "log_format": log_format,
+            "no_log": no_log,
+            "render_process": render_process,
+            "force_servo_rate": force_servo_rate,
+            "force_servo_updates": force_servo_status[1] if force_servo is not None else None,
+            "force_servo_missed_deadlines": force_servo_status[2] if force_servo is not None else None,
+            "force_servo_timeouts": force_servo_status[3] if force_servo is not None else None,
+            "motor_protocol": motor_protocol,
+            "prediction_model": experiment_config.get("prediction_model", "none"),
+            "spin_time": spin_time,
+            "missed_deadline_policy": missed_deadline_policy,
+            "refresh_frequency": experiment_config["refresh_frequency"],
+            "n_ticks": len(tick_starts),
+            "n_states": len(set(states)),
+            "score": state_dict.get("score", 0),
+        },
+        "stages": {stage_name: latency_stats(stage_durations[:, stage_idx]) for stage_idx, stage_name in enumerate(ExperimentLoop.STAGES)},
+        "tick": latency_stats(stage_durations.sum(axis=1)),
+        # cost of the state machine stage per state it started the tick in
+        "state_machine_by_state": {state: dict(latency_stats(state_machine_durations[start_states == state]), n_ticks=int((start_states == state).sum())) for state in sorted(set(start_states))},
+        "loop_timer": latency_stats(timer_durations),
+        "period": dict(latency_stats(periods), overruns=int((periods > target_period * 1.1).sum()), missed_deadlines=scheduler.overruns, target_us=target_period * 1e6),
+        # round-trip time, loss and jitter of the motor commands sent by the control loop (the force servo reports its own)
+        "motor_commands": controller.telemetry.to_dict() if motor_protocol == "framed" and force_servo is None else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=30.0, help="Benchmark duration in s, after a short warm-up.")
+    parser.add_argument("--replay", type=str, default=None, help="Replay a recorded session instead of the scripted participant.")
+    parser.add_argument("--acquisition_thread", action="store_true", help="Acquire frames in a background thread, as in do_experiment.py.")
+    parser.add_argument("--async_log", action="store_true", help="Write the trajectory file from a background thread.")
+    parser.add_argument("--log_format", type=str, default="tsv", choices=["tsv", "traj"], help="Trajectory file format.")
+    parser.add_argument("--no_log", action="store_true", help="Disable logging.")
+    parser.add_argument("--render_process", action="store_true", help="Draw the interface in a separate process, as in do_experiment.py.")
+    parser.add_argument("--force_servo_rate", type=float, default=0, help="Send the motor force from a separate process at this rate in Hz, as in do_experiment.py.")
+    parser.add_argument("--motor_protocol", type=str, default="raw", choices=["raw", "framed"], help="Send framed motor commands to a local puller loopback and measure their round-trip time.")
+    parser.add_argument("--prediction_model", type=str, default=None, choices=["none", "constant_velocity", "constant_acceleration"], help="Overrides the prediction_model of experiment_config.json.")
+    parser.add_argument("--spin_time", type=float, default=0.0, help="Busy-wait this many seconds before every loop deadline.")
+    parser.add_argument("--missed_deadline_policy", type=str, default="skip", choices=["skip", "catch_up"], help="After an overrun, skip the missed loop periods or catch up on them.")
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file.")
+    args = parser.parse_args()
+
+    experiment_config = json.load(open("experiment_config.json", "r"))
+    results = run_benchmark(experiment_config, args.duration, replay=args.replay, acquisition_thread=args.acquisition_thread, async_log=args.async_log, log_format=args.log_format, no_log=args.no_log, render_process=args.render_process, force_servo_rate=args.force_servo_rate, spin_time=args.spin_time, missed_deadline_policy=args.missed_deadline_policy, motor_protocol=args.motor_protocol, prediction_model=args.prediction_model)
+
+    print()
+    print("%-16s %10s %10s %10s %10s" % ("stage", "p50 [us]", "p99 [us]", "max [us]", "jitter"))
+    for stage_name, stats in list(results["stages"].items()) + [("tick", results["tick"]), ("period", results["period"]), ("loop_timer", results["loop_timer"])]:
+        print("%-16s %10.1f %10.1f %10.1f %10.1f" % (stage_name, stats["p50_us"], stats["p99_us"], stats["max_us"], stats["jitter_us"]))
+    print()
+    print("%-32s %8s %10s %10s %10s" % ("state machine in state", "ticks", "p50 [us]", "p99 [us]", "max [us]"))
+    for state, stats in results["state_machine_by_state"].items():
+        print("%-32s %8d %10.1f %10.1f %10.1f" % (state, stats["n_ticks"], stats["p50_us"], stats["p99_us"], stats["max_us"]))
+    print("Overruns: %d of %d ticks, %d missed deadlines" % (results["period"]["overruns"], results["metadata"]["n_ticks"], results["period"]["missed_deadlines"]))
+    if results["motor_commands"] is not None:
+        print("Motor commands:", results["motor_commands"])
+
+    if args.output is not None:
+        json.dump(results, open(args.output, "w"), indent=4)
@@ -0,0 +1,24 @@
+import argparse
+import os
+from datetime import datetime
+
+from experiment_logging import convert_tsv_to_container
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filenames", type=str, nargs="+", help="experiment_data_XX.tsv files to convert.")
+    parser.add_argument("--chunk_rows", type=int, default=10000, help="Number of rows per chunk of the container.")
+    parser.add_argument("--compression", type=str, default="zlib", choices=["zlib", "none"], help="Per-column compression. Uncompressed columns can be memory-mapped without copying.")
+    parser.add_argument("--overwrite", action="store_true", help="Convert even if the .traj file already exists.")
+    args = parser.parse_args()
+    
+    for tsv_filename in args.filenames:
+        assert tsv_filename.endswith(".tsv"), f"{tsv_filename} is not a TSV file."
+        container_filename = tsv_filename[:-len(".tsv")] + ".traj"
+        if os.path.exists(container_filename) and not args.overwrite:
+            print(datetime.now(), f"- Skipping {tsv_filename}, {container_filename} already exists.")
+            continue
+        
+        n_rows = convert_tsv_to_container(tsv_filename, container_filename, chunk_rows=args.chunk_rows, compression=args.compression)
+        print(datetime.now(), f"- Converted {tsv_filename} ({n_rows} rows, {os.path.getsize(tsv_filename) / 1e6:.1f} MB -> {os.path.getsize(container_filename) / 1e6:.1f} MB).")
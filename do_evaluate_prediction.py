@@ -0,0 +1,108 @@
+import argparse
+import json
+from datetime import datetime
+
+import numpy as np
+from scipy.signal import savgol_filter
+
+from experiment_logging import read_trajectory_chunks, get_session_config_filename
+from controller import MotorController
+from velocity_computation import VelocityEstimator
+from state_prediction import StatePredictor
+
+
+def load_com_trajectory(filename, chunk_size=10000):
+    # logged COM positions and frame times of every new Vicon frame (repeated frames are dropped)
+    positions, times = [], []
+    for _, chunk in read_trajectory_chunks(filename, chunk_size=chunk_size):
+        positions.append(np.stack([chunk[f"com.{idx}"].astype(float) for idx in range(3)], axis=1))
+        times.append(chunk["marker_timestamp"].astype(float))
+    positions, times = np.concatenate(positions, axis=0), np.concatenate(times)
+
+    is_new = times > np.maximum.accumulate(np.concatenate([[-np.inf], times[:-1]]))
+    return positions[is_new], times[is_new]
+
+
+def find_delay(signal, reference, times, max_delay=0.2, resolution=0.0005):
+    # delay d in s that best aligns signal(t) with reference(t - d), the reference is interpolated between frames
+    delays = np.arange(-max_delay, max_delay + resolution, resolution)
+    valid = (times > times[0] + max_delay) & (times < times[-1] - max_delay)
+    errors = [np.mean((signal[valid] - np.interp(times[valid] - delay, times, reference)) ** 2) for delay in delays]
+    return float(delays[int(np.argmin(errors))])
+
+
+def evaluate_prediction(positions, times, experiment_config, model="constant_acceleration", horizon=None, latency=0.0, actuation_delay=0.0, acceleration_window=10, reference_window=0.1):
+    # replays the logged COM through the velocity estimator of the session, with and without the predictor, and compares the
+    # forces of a regular perturbation (unit amplification) with the force of a smoothed, zero-lag reference velocity at the
+    # actuation time (frame time + horizon). the effective force delay is the lag of the commanded force behind that reference.
+    buffer_size = experiment_config["velocity_buffer_size"]
+    frame_period = np.median(np.diff(times))
+    reference_frames = max(int(reference_window / frame_period) // 2 * 2 + 1, 5)
+    reference_velocities = savgol_filter(positions, reference_frames, 2, deriv=1, delta=frame_period, axis=0)
+
+    controller = MotorController()
+    controller.set_participant_weight(experiment_config["participant"]["weight"])
+    controller.set_direction("forward")
+    controller.set_force_mode("regular")
+    get_forces = lambda velocities: controller.get_force_batch(velocities, positions, ["regular"] * len(times), np.ones(len(times)))
+    reference_forces = get_forces(reference_velocities)
+
+    results = {}
+    for predictor_model in [StatePredictor.NONE, model]:
+        velocity_estimator = VelocityEstimator(1, buffer_size=buffer_size, kernel=experiment_config.get("velocity_kernel", "boxcar"))
+        predictor = StatePredictor(model=predictor_model, horizon=horizon, actuation_delay=actuation_delay, velocity_delay_frames=velocity_estimator.delay_frames, acceleration_window=acceleration_window)
+        velocities = np.zeros((len(times), 3))
+        predicted_positions = np.zeros((len(times), 3))
+        horizons = np.zeros(len(times))
+        for frame_idx in range(len(times)):
+            velocity = velocity_estimator.update(positions[frame_idx][None], times[frame_idx])[0]
+            predicted_positions[frame_idx], velocities[frame_idx] = predictor.predict(positions[frame_idx], velocity, times[frame_idx], latency)
+            horizons[frame_idx] = predictor.horizon
+
+        # the force commanded at frame i acts at times[i] + horizon
+        actuation_times = times + horizons
+        forces = get_forces(velocities)
+        valid = slice(buffer_size + acceleration_window, len(times))
+        results[predictor_model] = {
+            "horizon_ms": float(horizons.mean() * 1000),
+            "force_delay_ms": (find_delay(forces, reference_forces, times) + float(horizons.mean())) * 1000,
+            "force_rms_error": float(np.sqrt(np.mean((forces[valid] - np.interp(actuation_times[valid], times, reference_forces)) ** 2))),
+            "velocity_rms_error": float(np.sqrt(np.mean((velocities[valid, 0] - np.interp(actuation_times[valid], times, reference_velocities[:, 0])) ** 2))),
+            "position_rms_error": float(np.sqrt(np.mean((predicted_positions[valid, 0] - np.interp(actuation_times[valid], times, positions[:, 0])) ** 2))),
+        }
+
+    results["force_delay_removed_ms"] = results[StatePredictor.NONE]["force_delay_ms"] - results[model]["force_delay_ms"]
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the latency-compensating state predictor on logged sessions.")
+    parser.add_argument("filenames", type=str, nargs="+", help="experiment_data_XX.tsv files to evaluate.")
+    parser.add_argument("--experiment_config", type=str, default=None, help="Defaults to the logged experiment_config_XX.json of every session.")
+    parser.add_argument("--model", type=str, default="constant_acceleration", choices=["constant_velocity", "constant_acceleration"], help="Prediction model.")
+    parser.add_argument("--horizon", type=float, default=None, help="Fixed prediction horizon in s, otherwise --latency + --actuation_delay.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Pipeline latency from the Vicon frame to sending the force in s.")
+    parser.add_argument("--actuation_delay", type=float, default=0.0, help="Delay from sending the force to the pullers applying it in s.")
+    parser.add_argument("--acceleration_window", type=int, default=10, help="Number of velocity estimates the acceleration is computed from.")
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file.")
+    args = parser.parse_args()
+
+    all_results = {}
+    for filename in args.filenames:
+        experiment_config_filename = args.experiment_config
+        if experiment_config_filename is None:
+            experiment_config_filename = get_session_config_filename(filename)
+        experiment_config = json.load(open(experiment_config_filename, "r"))
+
+        positions, times = load_com_trajectory(filename)
+        results = evaluate_prediction(positions, times, experiment_config, model=args.model, horizon=args.horizon, latency=args.latency, actuation_delay=args.actuation_delay, acceleration_window=args.acceleration_window)
+        all_results[filename] = results
+
+        print(datetime.now(), f"- {filename} ({len(times)} frames)")
+        for model in [StatePredictor.NONE, args.model]:
+            print("    %-22s horizon %5.1f ms, force delay %6.1f ms, force RMS error %7.3f N, velocity RMS error %7.4f m/s" % (
+                model, results[model]["horizon_ms"], results[model]["force_delay_ms"], results[model]["force_rms_error"], results[model]["velocity_rms_error"]))
+        print("    force delay removed: %.1f ms" % results["force_delay_removed_ms"])
+
+    if args.output is not None:
+        json.dump(all_results, open(args.output, "w"), indent=4)
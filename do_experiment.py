@@ -2,19 +2,25 @@ import argparse
 import json
 import traceback
 from datetime import datetime
-from time import sleep, time
+from time import perf_counter, monotonic
 
 import numpy as np
-import pygame
 import os
 
 from experiment_logging import Logger
 from vicon import ViconClient, MARKER_NAMES
+from vicon_replay import create_replay_client
 from controller import MotorController
-from interface import Interface
+from interface import Interface, RemoteInterface
 from state_machine import StateMachine
 from com_computation import compute_com, NOMINAL_HEIGHT, NOMINAL_WEIGHT
-from cbos_computation import compute_cbos
+from cbos_computation import CbosTracker
+from velocity_computation import VelocityEstimator
+from loop_timing import LoopTimer
+from loop_scheduler import DeadlineScheduler
+from force_servo import ForceServo
+from state_prediction import create_state_predictor
+from trial_summary import TrialAccumulator
 
 
 def initialize_state_dict(state_dict, experiment_config, block_idx, total_blocks):
@@ -39,7 +45,7 @@ def initialize_state_dict(state_dict, experiment_config, block_idx, total_blocks
     state_dict["current_force_amplification"] = 0
     state_dict["current_force_decay"] = 0
     state_dict["max_trial_velocity"] = 0
-    state_dict["main_circle_offset"] = np.zeros(2)
+    state_dict["main_circle_offset"] = np.zeros(3)
     
     state_dict["experiment_start"] = -1
     state_dict["show_progress_bar"] = False
@@ -59,115 +65,236 @@ def initialize_state_dict(state_dict, experiment_config, block_idx, total_blocks
 
     state_dict["needs_update"] = False
     state_dict["cbos_set"] = False
+    state_dict["foot_moved"] = False
     
     return state_dict
 
 
+class ExperimentLoop:
+    # one control loop iteration per `tick`, with perf_counter timestamps of every stage boundary in `stage_times`
+
+    STAGES = ["input", "acquisition", "com", "velocity", "cbos", "force", "state_machine", "interface", "logging"]
+
+    def __init__(self, experiment_config, vicon_client, velocity_estimator, interface, state_machine, logger, controller, participant_com, acquisition_thread=False, debug=False, no_log=False, force_servo=None, state_predictor=None):
+        self.experiment_config = experiment_config
+        self.vicon_client = vicon_client
+        self.velocity_estimator = velocity_estimator
+        self.interface = interface
+        self.state_machine = state_machine
+        self.logger = logger
+        self.controller = controller
+        self.participant_com = participant_com
+        self.acquisition_thread = acquisition_thread
+        self.debug = debug
+        self.no_log = no_log
+        # with a `ForceServo`, the force is computed and sent by the servo process
+        self.force_servo = force_servo
+        # with a `StatePredictor`, the force is computed from the COM state extrapolated to the actuation time
+        self.state_predictor = state_predictor
+
+        self.trial_accumulator = TrialAccumulator()
+        # the CBOS is computed every frame, the screen stays centered on the CBOS of the first frame of the block
+        self.cbos_tracker = CbosTracker(MARKER_NAMES, movement_threshold=experiment_config.get("cbos_movement_threshold", 0.02),
+                                        movement_frames=max(int(experiment_config.get("cbos_movement_time", 0.1) * experiment_config["refresh_frequency"]), 1))
+
+        self.state_dict = None
+        self.block_idx, self.total_blocks = 0, len(experiment_config["experiment"])
+        self.stage_times = [0.0] * (len(ExperimentLoop.STAGES) + 1)
+
+    def is_enter_pressed(self):
+        return self.interface.is_enter_pressed()
+
+    def tick(self):
+        state_dict = self.state_dict
+        if state_dict is None or state_dict["needs_update"]:
+            print(datetime.now(), "- Starting block %d" % (self.block_idx + 1))
+            state_dict = self.state_dict = initialize_state_dict(state_dict, self.experiment_config, self.block_idx, self.total_blocks)
+            self.controller.set_direction(self.experiment_config["experiment"][self.block_idx]["force_direction"])
+            self.controller.set_force_mode(self.experiment_config["experiment"][self.block_idx]["force_mode"])
+            self.block_idx += 1
+
+        stage_times = self.stage_times
+        stage_times[0] = perf_counter()
+        self.interface.pump_events()
+
+        if self.no_log:
+            state_dict["is_recording"] = True
+        else:
+            state_dict["is_recording"] = self.vicon_client.is_recording()
+        stage_times[1] = perf_counter()
+        
+        # get marker position
+        if self.acquisition_thread:
+            marker_positions, marker_occluded, _, marker_timestamp, receive_time = self.vicon_client.get_latest_frame()
+        else:
+            marker_positions, marker_occluded, _, marker_timestamp = self.vicon_client.get_frame()
+            receive_time = monotonic()
+        for marker_idx, marker_name in enumerate(MARKER_NAMES):
+            state_dict[marker_name] = marker_positions[marker_idx]
+        state_dict["occluded_markers"] = int(marker_occluded.sum())
+        stage_times[2] = perf_counter()
+
+        state_dict["com_approx"] = compute_com(state_dict, state_dict["height_adjustment_ratio"], state_dict["weight_adjustment_ratio"])
+        state_dict["com"] = state_dict["com_approx"] + self.participant_com["com_offset"]
+        stage_times[3] = perf_counter()
+        
+        # calculate velocity of all markers and the COM, the COM is the last point
+        state_dict["marker_timestamp"] = marker_timestamp
+        marker_velocity = self.velocity_estimator.update(np.vstack([marker_positions, state_dict["com"]]), marker_timestamp)[-1]
+        
+        # update state dict
+        if self.debug:
+            state_dict["marker_position"] = (np.array(list(self.interface.get_mouse_pos()) + [0]) - np.array([self.interface.window_width / 2, self.interface.window_height / 2, 0.0])) / 1000
+        else:
+            state_dict["marker_position"] = state_dict["com"]
+
+        state_dict["marker_velocity"] = marker_velocity
+        stage_times[4] = perf_counter()
+
+        state_dict["cbos_current"] = self.cbos_tracker.update(marker_positions, marker_occluded)
+        if not state_dict["cbos_set"]:
+            state_dict["cbos"] = state_dict["cbos_current"]
+            if np.any(state_dict["cbos"] != 0):
+                state_dict["cbos_set"] = True
+                self.cbos_tracker.set_reference(state_dict["cbos"])
+        elif self.cbos_tracker.foot_moved and not state_dict["foot_moved"]:
+            state_dict["foot_moved"] = True
+            print(datetime.now(), "- Feet moved in block %d, the CBOS is %.1f cm from the start of the block." % (
+                state_dict["block_idx"] + 1, np.linalg.norm(state_dict["cbos_current"][:2] - state_dict["cbos"][:2]) * 100))
+        stage_times[5] = perf_counter()
+                
+        # the force acts on the COM state at the time the pullers apply it
+        force_position, force_velocity = state_dict["marker_position"], marker_velocity
+        if self.state_predictor is not None:
+            latency = self.vicon_client.latency + monotonic() - receive_time + self.controller.get_network_latency()
+            force_position, force_velocity = self.state_predictor.predict(state_dict["marker_position"], marker_velocity, marker_timestamp, latency)
+            state_dict["predicted_position"] = force_position
+            state_dict["predicted_velocity"] = force_velocity
+            state_dict["prediction_horizon"] = self.state_predictor.horizon
+        
+        # send data to motor controller
+        state_dict["current_force_amplification"] = max(0, state_dict["current_force_amplification"] - state_dict["current_force_decay"])
+        self.controller.set_force_amplification(state_dict["current_force_amplification"])
+        if self.force_servo is not None and state_dict["perturbation_mode"] in {"regular", "channel"}:
+            self.force_servo.set_kinematics(force_velocity, force_position - state_dict["cbos"], marker_timestamp)
+            self.force_servo.set_parameters(state_dict["current_force_amplification"], state_dict["current_force_decay"] * state_dict["frequency"], state_dict["perturbation_mode"])
+            motor_force = self.force_servo.get_force()
+        elif state_dict["perturbation_mode"] == "regular":
+            motor_force = self.controller.get_force(force_velocity, state_dict["perturbation_mode"])
+        elif state_dict["perturbation_mode"] == "channel":
+            motor_force = self.controller.get_force(force_position - state_dict["cbos"], state_dict["perturbation_mode"])
+        else:
+            print("Incorrect perturbation mode: " + str(state_dict["perturbation_mode"]))
+            raise NotImplementedError
+        state_dict["motor_force"] = motor_force
+        
+        if self.force_servo is None:
+            self.controller.send_force(motor_force, state_dict["perturbation_mode"])
+        stage_times[6] = perf_counter()
+        
+        state_dict["enter_pressed"] = self.is_enter_pressed()
+        
+        continue_loop, state_dict = self.state_machine.maybe_update_state(state_dict)
+        stage_times[7] = perf_counter()
+        
+        # update interface
+        self.interface.update(state_dict)
+        self.interface.draw()
+        stage_times[8] = perf_counter()
+        
+        # per-trial metrics, the peak velocity of the current (or last) trial is logged as max_trial_velocity
+        events = self.state_machine.pop_events()
+        for summary in self.trial_accumulator.update(state_dict, events):
+            self.logger.save_trial_summary(summary)
+        state_dict["max_trial_velocity"] = self.trial_accumulator.peak_velocity
+
+        # save current state to file
+        self.logger.save_datapoint(state_dict)
+        self.logger.save_events(events)
+        stage_times[9] = perf_counter()
+
+        return continue_loop
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--no_log", action="store_true", help="Disable logging")
     parser.add_argument("--debug", action="store_true", help="Enable debugging, i.e. mouse controlled COM.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the state machine wait times, stored in the logged experiment config.")
+    parser.add_argument("--acquisition_thread", action="store_true", help="Acquire Vicon frames in a background thread and always use the latest one.")
+    parser.add_argument("--async_log", action="store_true", help="Write the trajectory file from a background thread.")
+    parser.add_argument("--log_format", type=str, default="tsv", choices=["tsv", "traj"], help="Trajectory file format, text (tsv) or the binary columnar container (traj).")
+    parser.add_argument("--log_overflow_policy", type=str, default="drop", choices=["drop", "block"], help="What to do when the asynchronous log queue is full.")
+    parser.add_argument("--replay", type=str, default=None, help="Replay the markers of a recorded session (experiment_data_XX.tsv) instead of connecting to Vicon.")
+    parser.add_argument("--replay_speed", type=float, default=1.0, help="Replay speed-up, 0 replays as fast as possible.")
+    parser.add_argument("--render_process", action="store_true", help="Draw the interface in a separate process at the display refresh rate.")
+    parser.add_argument("--force_servo_rate", type=float, default=0, help="Compute and send the motor force in a separate process at this rate in Hz (e.g. 1000), 0 sends it once per loop.")
+    parser.add_argument("--motor_protocol", type=str, default="raw", choices=["raw", "framed"], help="Send bare forces, or framed commands with a sequence number, send time and mode that the puller acknowledges.")
+    parser.add_argument("--spin_time", type=float, default=0.0, help="Busy-wait this many seconds before every loop deadline instead of sleeping.")
+    parser.add_argument("--missed_deadline_policy", type=str, default="skip", choices=["skip", "catch_up"], help="After an overrun, skip the missed loop periods or catch up on them.")
+    parser.add_argument("--no_timing", action="store_true", help="Disable the per-stage loop timing histograms (experiment_timing_XX.json).")
     args = parser.parse_args()
     
     experiment_config = json.load(open("experiment_config.json", "r"))
     
-    vicon_client = ViconClient(velocity_buffer_size=experiment_config["velocity_buffer_size"])
-    interface = Interface(display_number=1)
-    state_machine = StateMachine()
+    if args.replay is not None:
+        vicon_client = create_replay_client(args.replay, speed=args.replay_speed or None, velocity_buffer_size=experiment_config["velocity_buffer_size"])
+    else:
+        vicon_client = ViconClient(velocity_buffer_size=experiment_config["velocity_buffer_size"])
+    if args.acquisition_thread:
+        vicon_client.start_acquisition()
+    velocity_estimator = VelocityEstimator(len(MARKER_NAMES) + 1, buffer_size=experiment_config["velocity_buffer_size"], kernel=experiment_config.get("velocity_kernel", "boxcar"))
+    interface = RemoteInterface(display_number=1) if args.render_process else Interface(display_number=1)
+    state_machine = StateMachine(seed=args.seed)
+    experiment_config["state_machine_seed"] = args.seed
 
-    logger = Logger(experiment_config["results_path"], experiment_config["participant"]["id"], no_log=args.no_log)
+    logger = Logger(experiment_config["results_path"], experiment_config["participant"]["id"], no_log=args.no_log, asynchronous=args.async_log, overflow_policy=args.log_overflow_policy, file_format=args.log_format)
     logger.save_experiment_config(experiment_config)
     
-    controller = MotorController()
+    controller = MotorController(protocol=args.motor_protocol)
     controller.set_participant_weight(experiment_config["participant"]["weight"])
+    # the servo stops the force when the loop has not published kinematics for 5 loop periods
+    force_servo = ForceServo(controller, rate=args.force_servo_rate, max_kinematics_age=5 / experiment_config["refresh_frequency"]) if args.force_servo_rate > 0 else None
+    state_predictor = create_state_predictor(experiment_config, velocity_estimator)
 
     assert os.path.exists(os.path.join(logger.results_path, logger.participant_folder, "participant_com.json")), "Run do_before.py first to obtain participant's COM."
     participant_com = json.load(open(os.path.join(logger.results_path, logger.participant_folder, "participant_com.json"), "r"))
 
+    experiment_loop = ExperimentLoop(experiment_config, vicon_client, velocity_estimator, interface, state_machine, logger, controller, participant_com, acquisition_thread=args.acquisition_thread, debug=args.debug, no_log=args.no_log, force_servo=force_servo, state_predictor=state_predictor)
+    loop_timer = None if args.no_timing else LoopTimer(ExperimentLoop.STAGES, len(experiment_config["experiment"]), experiment_config["refresh_frequency"])
+    scheduler = DeadlineScheduler(experiment_config["refresh_frequency"], spin_time=args.spin_time, missed_deadline_policy=args.missed_deadline_policy)
     continue_loop = True
-    state_dict = None
-    block_idx, total_blocks = 0, len(experiment_config["experiment"])
     try:
+        scheduler.start()
         while continue_loop:
-            if state_dict is None or state_dict["needs_update"]:
-                print(datetime.now(), "- Starting block %d" % (block_idx + 1))
-                state_dict = initialize_state_dict(state_dict, experiment_config, block_idx, total_blocks)
-                controller.set_direction(experiment_config["experiment"][block_idx]["force_direction"])
-                controller.set_force_mode(experiment_config["experiment"][block_idx]["force_mode"])
-                block_idx += 1
-
-            time_start = time()
-            pygame.event.get()
-
-            if args.no_log:
-                state_dict["is_recording"] = True
-            else:
-                state_dict["is_recording"] = vicon_client.is_recording()
-            
-            # get marker position
-            positions = {}
-            for marker_name, marker_position in vicon_client.get_current_position(None, mode=MARKER_NAMES)[0].items():
-                state_dict[marker_name] = marker_position
-
-            state_dict["com_approx"] = compute_com(state_dict, state_dict["height_adjustment_ratio"], state_dict["weight_adjustment_ratio"])
-            state_dict["com"] = state_dict["com_approx"] + participant_com["com_offset"]
-            
-            # calculate velocity
-            state_dict["marker_timestamp"] = time()
-            marker_velocity = vicon_client.get_velocity(state_dict["com"], state_dict["marker_timestamp"], "com")
-            
-            # update state dict
-            if args.debug:
-                state_dict["marker_position"] = (np.array(list(pygame.mouse.get_pos()) + [0]) - np.array([interface.window_width / 2, interface.window_height / 2, 0.0])) / 1000
-            else:
-                state_dict["marker_position"] = state_dict["com"]
-
-            state_dict["marker_velocity"] = marker_velocity
-            state_dict["max_trial_velocity"] = max(state_dict["max_trial_velocity"], np.linalg.norm(marker_velocity))
-            if not state_dict["cbos_set"]:
-                state_dict["cbos"] = compute_cbos(state_dict)
-                if np.any(state_dict["cbos"] != 0):
-                    state_dict["cbos_set"] = True
-                    
-            # send data to motor controller
-            state_dict["current_force_amplification"] = max(0, state_dict["current_force_amplification"] - state_dict["current_force_decay"])
-            controller.set_force_amplification(state_dict["current_force_amplification"])
-            if state_dict["perturbation_mode"] == "regular":
-                motor_force = controller.get_force(marker_velocity, state_dict["perturbation_mode"])
-            elif state_dict["perturbation_mode"] == "channel":
-                motor_force = controller.get_force(state_dict["marker_position"] - state_dict["cbos"], state_dict["perturbation_mode"])
-            else:
-                print("Incorrect perturbation mode: " + str(state_dict["perturbation_mode"]))
-                raise NotImplementedError
-            state_dict["motor_force"] = motor_force
-            
-            controller.send_force(motor_force)
-            
-            state_dict["enter_pressed"] = pygame.key.get_pressed()[pygame.K_RETURN]
-            
-            continue_loop, state_dict = state_machine.maybe_update_state(state_dict)
-            
-            # update interface
-            interface.update(state_dict)
-            interface.draw()
-            
-            # save current state to file
-            logger.save_datapoint(state_dict)
+            continue_loop = experiment_loop.tick()
+            state_dict = experiment_loop.state_dict
+            if loop_timer is not None:
+                loop_timer.record(state_dict["block_idx"], experiment_loop.stage_times)
             
-            # calculate time and optionally wait
-            curr_frequency = 1 / (time() - time_start + 1e-8)
-            curr_frequency = np.round(curr_frequency, 2)
-            curr_frequency = np.clip(curr_frequency, 0, 999)
-            # print("Capture frequency:", curr_frequency, " " * 20, end="\r")
-            if time() - time_start > (1 / state_dict["frequency"]):
-                pass
-                # print(datetime.now(), "- Loop took too much time!", "%.3fs > (1/%d)s" % (time() - time_start, state_dict["frequency"]), end="\r")
-            else:
-                sleep(np.abs((1 / state_dict["frequency"]) - (time() - time_start)))
+            # read the motor command acknowledgements until the next loop deadline, the network latency of the state predictor
+            # is otherwise biased by the wait for the next command
+            if controller.protocol == "framed" and force_servo is None:
+                controller.poll_acks_until(scheduler.deadline - scheduler.spin_time)
+            # wait for the next loop deadline
+            scheduler.wait()
                 
         print()
-        print(state_dict["score_text"])
+        print(experiment_loop.state_dict["score_text"])
     except Exception:
         print(traceback.format_exc())
     finally:    
-        logger.close()
\ No newline at end of file
+        vicon_client.stop_acquisition()
+        if force_servo is not None:
+            force_servo.close()
+            print(datetime.now(), "- Force servo sent %d updates, missed %d deadlines, stopped the force %d times (%d updates) on stale kinematics." % force_servo.get_status()[1:])
+        if controller.protocol == "framed" and force_servo is None:
+            print(datetime.now(), "- Motor commands:", controller.telemetry.to_dict())
+        print(datetime.now(), "- Missed %d of %d loop deadlines (max. %.1f ms late), skipped %d periods." % (scheduler.overruns, scheduler.n_ticks, scheduler.max_lateness * 1000, scheduler.skipped_periods))
+        if loop_timer is not None:
+            print(datetime.now(), "- Loop overruns per block:", loop_timer.overruns)
+            timing = loop_timer.to_dict()
+            timing["scheduler"] = {"missed_deadline_policy": scheduler.missed_deadline_policy, "spin_time": scheduler.spin_time, "n_ticks": scheduler.n_ticks, "overruns": scheduler.overruns, "skipped_periods": scheduler.skipped_periods, "max_lateness_us": scheduler.max_lateness * 1e6}
+            logger.save_timing(timing)
+        logger.close()
+        interface.close()
@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+from experiment_logging import read_trajectory_chunks, get_session_filename
+from vicon import MARKER_NAMES
+from controller import MotorController
+from com_computation import compute_com_batch, NOMINAL_HEIGHT, NOMINAL_WEIGHT
+from cbos_computation import compute_cbos_batch
+from velocity_computation import VelocityEstimator
+
+
+class VelocityReprocessor:
+    # vectorized boxcar `VelocityEstimator` over consecutive chunks of a session
+    
+    def __init__(self, velocity_buffer_size):
+        self.velocity_buffer_size = velocity_buffer_size
+        self.prev_position = None
+        self.prev_time = None
+        self.velocity_buffer = np.zeros((0, 3))
+        self.last_velocity = np.zeros(3)
+        
+    def __call__(self, positions, times):
+        # frames that are not newer than the previous one (the same Vicon frame read twice) repeat the previous estimate
+        prev_time = -np.inf if self.prev_time is None else self.prev_time
+        is_new = times > np.maximum.accumulate(np.concatenate([[prev_time], times[:-1]]))
+        new_positions, new_times = positions[is_new], times[is_new]
+        
+        if len(new_times) > 0:
+            if self.prev_position is None:
+                velocities = np.zeros((1, 3))
+                velocities = np.concatenate([velocities, np.diff(new_positions, axis=0) / np.diff(new_times)[:, None]], axis=0)
+            else:
+                all_positions = np.concatenate([self.prev_position[None], new_positions], axis=0)
+                all_times = np.concatenate([[self.prev_time], new_times])
+                velocities = np.diff(all_positions, axis=0) / np.diff(all_times)[:, None]
+            
+            self.prev_position = new_positions[-1].copy()
+            self.prev_time = new_times[-1]
+            
+            # boxcar average, including the velocities buffered from the previous chunk
+            buffered = np.concatenate([self.velocity_buffer, velocities], axis=0)
+            cumsum = np.concatenate([np.zeros((1, 3)), np.cumsum(buffered, axis=0)], axis=0)
+            end = np.arange(len(self.velocity_buffer), len(buffered)) + 1
+            start = np.maximum(end - self.velocity_buffer_size, 0)
+            smoothed = (cumsum[end] - cumsum[start]) / (end - start)[:, None]
+            self.velocity_buffer = buffered[max(0, len(buffered) - (self.velocity_buffer_size - 1)):]
+        else:
+            smoothed = np.zeros((0, 3))
+        
+        # forward fill the repeated frames, the ones before the first new frame repeat the last estimate of the previous chunk
+        new_idxs = np.maximum.accumulate(np.where(is_new, np.cumsum(is_new) - 1, -1))
+        result = np.concatenate([smoothed, self.last_velocity[None]], axis=0)[new_idxs]
+        self.last_velocity = result[-1].copy()
+        return result
+    
+
+class ForceReprocessor:
+    # replicates the force computation in `do_experiment.py` over consecutive chunks of a session.
+    # the force in frame i is computed before the state machine update, so it uses the amplification,
+    # decay and perturbation mode that were logged in frame i - 1.
+    
+    def __init__(self, experiment_config):
+        self.experiment_config = experiment_config
+        self.controller = MotorController()
+        self.controller.set_participant_weight(experiment_config["participant"]["weight"])
+        
+        self.prev_block_idx = None
+        self.prev_force_amplification = 0.0
+        self.prev_force_decay = 0.0
+        self.prev_perturbation_mode = "regular"
+        
+    def __call__(self, chunk, velocities, positions):
+        block_idxs = chunk["block_idx"].astype(int)
+        force_amplifications = chunk["current_force_amplification"].astype(float)
+        force_decays = chunk["current_force_decay"].astype(float)
+        perturbation_modes = chunk["perturbation_mode"]
+        
+        used_force_amplifications = np.concatenate([[self.prev_force_amplification], force_amplifications[:-1]]) - \
+                                    np.concatenate([[self.prev_force_decay], force_decays[:-1]])
+        used_force_amplifications = np.maximum(0, used_force_amplifications)
+        used_perturbation_modes = np.concatenate([[self.prev_perturbation_mode], perturbation_modes[:-1]])
+        
+        # `initialize_state_dict` resets the force parameters at the start of every block
+        block_start = block_idxs != np.concatenate([[self.prev_block_idx if self.prev_block_idx is not None else -1], block_idxs[:-1]])
+        used_force_amplifications[block_start] = 0.0
+        used_perturbation_modes[block_start] = "regular"
+        
+        motor_forces = np.zeros(len(block_idxs))
+        for block_idx in np.unique(block_idxs):
+            block_mask = block_idxs == block_idx
+            self.controller.set_direction(self.experiment_config["experiment"][block_idx]["force_direction"])
+            self.controller.set_force_mode(self.experiment_config["experiment"][block_idx]["force_mode"])
+            motor_forces[block_mask] = self.controller.get_force_batch(velocities[block_mask], positions[block_mask], used_perturbation_modes[block_mask], used_force_amplifications[block_mask])
+        
+        self.prev_block_idx = block_idxs[-1]
+        self.prev_force_amplification = force_amplifications[-1]
+        self.prev_force_decay = force_decays[-1]
+        self.prev_perturbation_mode = perturbation_modes[-1]
+        
+        return motor_forces
+
+
+def get_vector_columns(chunk, name, dtype=float):
+    return np.stack([chunk[f"{name}.{idx}"].astype(dtype) for idx in range(3)], axis=1)
+
+
+def set_vector_columns(chunk, name, values):
+    for idx in range(values.shape[1]):
+        chunk[f"{name}.{idx}"] = np.array([str(value) for value in values[:, idx].tolist()])
+
+
+def reprocess_session(input_filename, output_filename, experiment_config, participant_com, chunk_size=10000):
+    height_adjustment_ratio = experiment_config["participant"]["height"] / NOMINAL_HEIGHT
+    weight_adjustment_ratio = experiment_config["participant"]["weight"] / NOMINAL_WEIGHT
+    com_offset = np.array(participant_com["com_offset"])
+    
+    if experiment_config.get("velocity_kernel", "boxcar") == "boxcar":
+        velocity_reprocessor = VelocityReprocessor(experiment_config["velocity_buffer_size"])
+    else:
+        velocity_estimator = VelocityEstimator(1, buffer_size=experiment_config["velocity_buffer_size"], kernel=experiment_config["velocity_kernel"])
+        velocity_reprocessor = lambda positions, times: np.stack([velocity_estimator.update(position[None], t)[0].copy() for position, t in zip(positions, times)], axis=0)
+    force_reprocessor = ForceReprocessor(experiment_config)
+    
+    total_rows = 0
+    with open(output_filename, "w") as output_file:
+        for column_names, chunk in read_trajectory_chunks(input_filename, chunk_size=chunk_size):
+            if total_rows == 0:
+                output_file.write("\t".join(column_names) + "\n")
+            
+            marker_positions = np.stack([get_vector_columns(chunk, marker_name) for marker_name in MARKER_NAMES], axis=1)
+            com_approx, _ = compute_com_batch(marker_positions, MARKER_NAMES, height_adjustment_ratio, weight_adjustment_ratio)
+            com = com_approx + com_offset
+            
+            velocities = velocity_reprocessor(com, chunk["marker_timestamp"].astype(float))
+            
+            cbos = np.stack([chunk[f"cbos.{idx}"].astype(float) for idx in range(3)], axis=1)
+            motor_forces = force_reprocessor(chunk, velocities, com - cbos)
+            
+            set_vector_columns(chunk, "com_approx", com_approx)
+            set_vector_columns(chunk, "com", com)
+            set_vector_columns(chunk, "marker_velocity", velocities)
+            # the per-frame CBOS of sessions with CBOS tracking, the CBOS the screen is centered on is kept as logged
+            if "cbos_current.0" in chunk:
+                set_vector_columns(chunk, "cbos_current", compute_cbos_batch(marker_positions, MARKER_NAMES))
+            chunk["motor_force"] = np.array([str(value) for value in motor_forces.tolist()])
+            
+            rows = zip(*[chunk[column_name] for column_name in column_names])
+            output_file.write("".join("\t".join(row) + "\n" for row in rows))
+            
+            total_rows += len(motor_forces)
+            print(f"{datetime.now()} - Reprocessed {total_rows} rows.", end="\r")
+    print()
+    
+    return total_rows
+    
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--participant_id", type=int, required=True, help="ID of the participant whose session is reprocessed.")
+    parser.add_argument("--session", type=int, required=True, help="Index XX of the experiment_data_XX.tsv file.")
+    parser.add_argument("--results_path", type=str, default=None, help="Defaults to the results_path in experiment_config.json.")
+    parser.add_argument("--experiment_config", type=str, default=None, help="Defaults to the logged experiment_config_XX.json of the session.")
+    parser.add_argument("--participant_com", type=str, default=None, help="Defaults to the logged participant_com.json.")
+    parser.add_argument("--chunk_size", type=int, default=10000, help="Number of rows held in memory at once.")
+    args = parser.parse_args()
+    
+    results_path = args.results_path
+    if results_path is None:
+        results_path = json.load(open("experiment_config.json", "r"))["results_path"]
+    participant_folder = os.path.join(results_path, "participant_%03d" % args.participant_id)
+
+    experiment_config_filename = args.experiment_config
+    if experiment_config_filename is None:
+        experiment_config_filename = get_session_filename(results_path, args.participant_id, args.session, prefix="experiment_config", extension="json")
+    experiment_config = json.load(open(experiment_config_filename, "r"))
+
+    participant_com_filename = args.participant_com
+    if participant_com_filename is None:
+        participant_com_filename = os.path.join(participant_folder, "participant_com.json")
+    participant_com = json.load(open(participant_com_filename, "r"))
+    
+    # output name must not start with "experiment_data", otherwise the Logger would count it as a session
+    input_filename = get_session_filename(results_path, args.participant_id, args.session)
+    output_filename = get_session_filename(results_path, args.participant_id, args.session, prefix="reprocessed_data")
+    
+    print(f"{datetime.now()} - Reprocessing {input_filename}")
+    reprocess_session(input_filename, output_filename, experiment_config, participant_com, chunk_size=args.chunk_size)
+    print(f"{datetime.now()} - Saved to {output_filename}")
@@ -0,0 +1,167 @@
+import argparse
+import json
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+
+from experiment_logging import read_trajectory_chunks, get_session_config_filename
+from state_machine import StateMachine
+from do_experiment import initialize_state_dict
+from trial_summary import TrialSegmenter
+
+
+class ReplayClock:
+    # virtual clock of a replay, set by the replay driver
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def load_session(filename, chunk_size=10000):
+    # the logged state machine inputs of every tick: frame time, main circle position, recording state, <Enter> presses,
+    # marker position and CBOS, and the circle layout of the first tick. the COM velocity is used for the trial summaries.
+    columns = {name: [] for name in ["times", "main_circle_positions", "is_recording", "enter_pressed", "marker_positions", "cbos", "marker_velocities", "scores"]}
+    layout = None
+    for column_names, chunk in read_trajectory_chunks(filename, chunk_size=chunk_size):
+        columns["times"].append(chunk["marker_timestamp"].astype(float))
+        columns["main_circle_positions"].append(np.stack([chunk[f"main_circle_position.{idx}"].astype(float) for idx in range(2)], axis=1))
+        columns["is_recording"].append(chunk["is_recording"] == "True")
+        columns["enter_pressed"].append(chunk["enter_pressed"] == "True")
+        columns["marker_positions"].append(np.stack([chunk[f"marker_position.{idx}"].astype(float) for idx in range(3)], axis=1))
+        columns["cbos"].append(np.stack([chunk[f"cbos.{idx}"].astype(float) for idx in range(3)], axis=1))
+        columns["marker_velocities"].append(np.stack([chunk[f"marker_velocity.{idx}"].astype(float) for idx in range(3)], axis=1))
+        columns["scores"].append(chunk["score"].astype(float))
+        if layout is None:
+            layout = {"main_circle_radius": float(chunk["main_circle_radius"][0])}
+            for name in StateMachine.CIRCLE_NAMES:
+                layout[name + "_circle_position"] = np.array([float(chunk[f"{name}_circle_position.{idx}"][0]) for idx in range(2)])
+                layout[name + "_circle_radius"] = float(chunk[f"{name}_circle_radius"][0])
+
+    session = {name: np.concatenate(values, axis=0) for name, values in columns.items()}
+    session["layout"] = layout
+    return session
+
+
+def rescore_session(session, experiment_config, circle_radii=None, target_distance=None, state_wait_time_range=None, seed=None):
+    # feeds the logged inputs of `session` through a state machine on a virtual clock (the logged frame times) and returns the
+    # trial outcomes and the score. `circle_radii` maps circle names (main, middle, left, right) to radii in m, `target_distance`
+    # is the distance of the left and right circles from the middle one in m, and `state_wait_time_range` replaces the range of
+    # every block. the participant's movement is replayed as logged, regardless of how the changed state machine would have
+    # guided it. like the logged trial index, a trial spans the rows from its go cue to its outcome, and its movement time and
+    # peak velocities cover the movement from leaving the start circle to reaching the target (see `trial_summary`).
+    experiment_config = json.loads(json.dumps(experiment_config))
+    if state_wait_time_range is not None:
+        for block in experiment_config["experiment"]:
+            block["state_wait_time_range"] = list(state_wait_time_range)
+    scale = experiment_config["interface"]["pixels_per_m"] * experiment_config["interface"]["display_scaling"]
+    layout = dict(session["layout"])
+    for name, radius in (circle_radii or {}).items():
+        layout[name + "_circle_radius"] = radius * scale
+    if target_distance is not None:
+        for name, sign in [("left", -1), ("right", 1)]:
+            layout[name + "_circle_position"] = layout["middle_circle_position"] + np.array([sign * target_distance * scale, 0.0])
+
+    clock = ReplayClock()
+    state_machine = StateMachine(clock=clock, seed=seed)
+    total_blocks = len(experiment_config["experiment"])
+
+    # python lists are faster to index one element at a time than numpy arrays
+    times, is_recording, enter_pressed = session["times"].tolist(), session["is_recording"].tolist(), session["enter_pressed"].tolist()
+    main_circle_positions, marker_positions, cbos = session["main_circle_positions"], session["marker_positions"], session["cbos"]
+
+    trials = []
+    trial_segmenter = TrialSegmenter()
+    state_dict, block_idx = None, 0
+    continue_loop = True
+    row_idx = 0
+    for row_idx in range(len(times)):
+        if state_dict is None or state_dict["needs_update"]:
+            state_dict = initialize_state_dict(state_dict, experiment_config, block_idx, total_blocks)
+            state_dict.update(layout)
+            block_idx += 1
+
+        clock.now = times[row_idx]
+        state_dict["is_recording"] = is_recording[row_idx]
+        state_dict["enter_pressed"] = enter_pressed[row_idx]
+        state_dict["marker_position"] = marker_positions[row_idx]
+        state_dict["cbos"] = cbos[row_idx]
+        # the interface updates the main circle after the state machine, which sees the position of the previous tick
+        if row_idx > 0:
+            state_dict["main_circle_position"] = main_circle_positions[row_idx - 1]
+
+        continue_loop, state_dict = state_machine.maybe_update_state(state_dict)
+        if len(state_machine.events) > 0:
+            for trial in trial_segmenter.update(state_machine.pop_events(), row_idx):
+                # trials interrupted by a pause or the end of the experiment have no outcome, and an outcome follows the movement
+                if trial["success"] is None:
+                    continue
+                movement_velocities = session["marker_velocities"][trial["movement_start_row"]:trial["movement_end_row"]]
+                trials.append({
+                    "start_row": trial["start_row"],
+                    "end_row": trial["end_row"],
+                    "movement_start_row": trial["movement_start_row"],
+                    "movement_end_row": trial["movement_end_row"],
+                    "timestamp": trial["end_time"],
+                    "block_idx": trial["block_idx"],
+                    "side": trial["side"],
+                    "success": trial["success"],
+                    "reaction_time": trial["movement_start_time"] - trial["start_time"],
+                    "movement_time": trial["movement_end_time"] - trial["movement_start_time"],
+                    "hold_time": trial["end_time"] - trial["movement_end_time"],
+                    "peak_velocity": float(np.sqrt((movement_velocities ** 2).sum(axis=1)).max()),
+                    "peak_velocity_x": float(np.abs(movement_velocities[:, 0]).max()),
+                })
+        if not continue_loop:
+            break
+
+    return {
+        "score": int(state_dict["score"]),
+        "n_trials": len(trials),
+        "n_successful_trials": sum(trial["success"] for trial in trials),
+        "n_ticks": row_idx + 1,
+        "final_state": state_dict["current_state"],
+        "finished": not continue_loop or state_dict["current_state"] == "EXIT",
+        "trials": trials,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rescore logged sessions with a changed state machine, on a virtual clock.")
+    parser.add_argument("filenames", type=str, nargs="+", help="experiment_data_XX.tsv files to rescore.")
+    parser.add_argument("--experiment_config", type=str, default=None, help="Defaults to the logged experiment_config_XX.json of every session.")
+    parser.add_argument("--main_radius", type=float, default=None, help="Radius of the main (COM) circle in m.")
+    parser.add_argument("--middle_radius", type=float, default=None, help="Radius of the middle circle in m.")
+    parser.add_argument("--target_radius", type=float, default=None, help="Radius of the left and right circles in m.")
+    parser.add_argument("--state_wait_time_range", type=float, nargs=2, default=None, help="Range of the wait time in the left and right circles in s, for all blocks.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the wait times, defaults to the logged seed of the session.")
+    parser.add_argument("--output", type=str, default=None, help="Write the results, with all trial outcomes, to this JSON file.")
+    args = parser.parse_args()
+
+    circle_radii = {name: radius for name, radius in [("main", args.main_radius), ("middle", args.middle_radius), ("left", args.target_radius), ("right", args.target_radius)] if radius is not None}
+
+    all_results = {}
+    for filename in args.filenames:
+        experiment_config_filename = args.experiment_config
+        if experiment_config_filename is None:
+            experiment_config_filename = get_session_config_filename(filename)
+        experiment_config = json.load(open(experiment_config_filename, "r"))
+        seed = args.seed if args.seed is not None else experiment_config.get("state_machine_seed")
+
+        session = load_session(filename)
+        time_start = perf_counter()
+        results = rescore_session(session, experiment_config, circle_radii=circle_radii, state_wait_time_range=args.state_wait_time_range, seed=seed)
+        replay_time = perf_counter() - time_start
+        results["logged_score"] = int(session["scores"][-1])
+        all_results[filename] = results
+
+        session_time = session["times"][results["n_ticks"] - 1] - session["times"][0]
+        print(datetime.now(), f"- {filename}: score {results['score']} (logged {results['logged_score']}), "
+              f"{results['n_successful_trials']} of {results['n_trials']} trials successful, final state {results['final_state']}. "
+              f"Replayed {results['n_ticks']} ticks in {replay_time:.2f} s ({session_time / replay_time:.0f}x real time).")
+
+    if args.output is not None:
+        json.dump(all_results, open(args.output, "w"), indent=4)
@@ -0,0 +1,179 @@
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import os
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from experiment_logging import find_sessions, get_session_config_filename
+from controller import MotorController
+from do_rescore import load_session, rescore_session
+
+
+# interface geometry in m, the other grid parameters replace the parameter of every block of the logged experiment config
+INTERFACE_PARAMETERS = ["circle_radius", "main_circle_radius", "target_distance"]
+SWEEP_COLUMNS = ["session", "combination_id", "parameters", "n_blocks", "block_idx", "n_trials", "n_successful_trials", "success_rate",
+                 "desired_velocity_rate", "desired_trial_time_rate", "mean_movement_time", "mean_peak_velocity", "mean_peak_force", "score", "finished"]
+
+# sessions loaded by this worker process, the tasks of a session are usually handled by the same few workers
+_session_cache = {}
+# motor controller of this worker process, only used to compute forces; its socket never sends
+_controller = None
+
+
+def expand_grid(grid):
+    # every combination of the grid values, as (combination_id, parameters); the id does not depend on the order of the grid
+    names = sorted(grid.keys())
+    combinations = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        parameters = dict(zip(names, values))
+        combination_id = hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:12]
+        combinations.append((combination_id, parameters))
+    return combinations
+
+
+def summarize_blocks(results, experiment_config):
+    # per block trial counts and success rate, the share of trials within desired_velocity (peak velocity) and desired_trial_time
+    # (movement time, from leaving the start circle to reaching the target), and the mean peak force a regular perturbation
+    # would have applied
+    global _controller
+    if _controller is None:
+        _controller = MotorController()
+    controller = _controller
+    controller.set_participant_weight(experiment_config["participant"]["weight"])
+    rows = []
+    for block_idx, block in enumerate(experiment_config["experiment"]):
+        trials = [trial for trial in results["trials"] if trial["block_idx"] == block_idx]
+        controller.set_direction(block["force_direction"])
+        controller.set_force_mode(block["force_mode"])
+        controller.set_force_amplification(block["force_amplification"])
+        peak_velocities = np.array([trial["peak_velocity"] for trial in trials])
+        movement_times = np.array([trial["movement_time"] for trial in trials])
+        peak_forces = np.array([abs(controller.get_force(np.array([trial["peak_velocity_x"], 0.0, 0.0]), "regular")) for trial in trials])
+
+        n_trials = len(trials)
+        rows.append({
+            "block_idx": block_idx,
+            "n_trials": n_trials,
+            "n_successful_trials": sum(trial["success"] for trial in trials),
+            "success_rate": sum(trial["success"] for trial in trials) / n_trials if n_trials > 0 else None,
+            "desired_velocity_rate": float(np.mean((peak_velocities >= block["desired_velocity"][0]) & (peak_velocities <= block["desired_velocity"][1]))) if n_trials > 0 else None,
+            "desired_trial_time_rate": float(np.mean((movement_times >= block["desired_trial_time"][0]) & (movement_times <= block["desired_trial_time"][1]))) if n_trials > 0 else None,
+            "mean_movement_time": float(movement_times.mean()) if n_trials > 0 else None,
+            "mean_peak_velocity": float(peak_velocities.mean()) if n_trials > 0 else None,
+            "mean_peak_force": float(peak_forces.mean()) if n_trials > 0 else None,
+        })
+    return rows
+
+
+def sweep_session(task):
+    # rescores one session with a list of parameter combinations and returns the table rows of all of them
+    filename, experiment_config_filename, combinations, seed = task
+    if filename not in _session_cache:
+        _session_cache.clear()
+        _session_cache[filename] = (load_session(filename), json.load(open(experiment_config_filename, "r")))
+    session, logged_experiment_config = _session_cache[filename]
+    if seed is None:
+        seed = logged_experiment_config.get("state_machine_seed")
+
+    rows = []
+    for combination_id, parameters in combinations:
+        experiment_config = json.loads(json.dumps(logged_experiment_config))
+        for block in experiment_config["experiment"]:
+            block.update({name: value for name, value in parameters.items() if name not in INTERFACE_PARAMETERS})
+
+        circle_radii = {}
+        if "circle_radius" in parameters:
+            circle_radii.update({name: parameters["circle_radius"] for name in ["middle", "left", "right"]})
+        if "main_circle_radius" in parameters:
+            circle_radii["main"] = parameters["main_circle_radius"]
+        results = rescore_session(session, experiment_config, circle_radii=circle_radii, target_distance=parameters.get("target_distance"), seed=seed)
+
+        n_blocks = len(experiment_config["experiment"])
+        for block_row in summarize_blocks(results, experiment_config):
+            rows.append(dict(block_row, session=filename, combination_id=combination_id, parameters=json.dumps(parameters, sort_keys=True),
+                             n_blocks=n_blocks, score=results["score"], finished=results["finished"]))
+    return rows
+
+
+def read_completed(output_filename):
+    # rows of the (session, combination) pairs that were completely written, i.e. with a row for every block
+    if not os.path.exists(output_filename):
+        return []
+    with open(output_filename, "r") as output_file:
+        lines = output_file.read().split("\n")
+    assert lines[0].split("\t") == SWEEP_COLUMNS, f"{output_filename} is not a sweep table."
+    # the last line is incomplete if the sweep was interrupted while writing it
+    rows = [line.split("\t") for line in lines[1:-1]]
+    rows = [row for row in rows if len(row) == len(SWEEP_COLUMNS)]
+
+    session_idx, combination_idx, n_blocks_idx = SWEEP_COLUMNS.index("session"), SWEEP_COLUMNS.index("combination_id"), SWEEP_COLUMNS.index("n_blocks")
+    n_rows = {}
+    for row in rows:
+        n_rows[(row[session_idx], row[combination_idx])] = n_rows.get((row[session_idx], row[combination_idx]), 0) + 1
+    return [row for row in rows if n_rows[(row[session_idx], row[combination_idx])] == int(row[n_blocks_idx])]
+
+
+def run_sweep(filenames, grid, output_filename, n_workers=None, seed=None, max_task_size=64):
+    # rescores every session with every combination of the grid in a process pool and appends the rows to `output_filename`
+    # as the tasks finish. combinations already in the table are skipped, so an interrupted sweep resumes where it stopped.
+    combinations = expand_grid(grid)
+    n_workers = n_workers or cpu_count()
+    for filename in filenames:
+        experiment_config = json.load(open(get_session_config_filename(filename), "r"))
+        unknown_parameters = [name for name in grid if name not in INTERFACE_PARAMETERS and name not in experiment_config["experiment"][0]]
+        assert len(unknown_parameters) == 0, f"Unknown parameters {unknown_parameters} for {filename}."
+
+    # rewrite the table without incomplete combinations
+    completed_rows = read_completed(output_filename)
+    with open(output_filename, "w") as output_file:
+        output_file.write("\t".join(SWEEP_COLUMNS) + "\n")
+        output_file.write("".join("\t".join(row) + "\n" for row in completed_rows))
+    completed = {(row[0], row[1]) for row in completed_rows}
+
+    # a few tasks per worker, the tasks of a session are not larger than `max_task_size` combinations
+    tasks = []
+    for filename in filenames:
+        pending = [combination for combination in combinations if (filename, combination[0]) not in completed]
+        if len(pending) == 0:
+            continue
+        n_tasks = max(math.ceil(2 * n_workers / len(filenames)), math.ceil(len(pending) / max_task_size))
+        task_size = math.ceil(len(pending) / n_tasks)
+        tasks += [(filename, get_session_config_filename(filename), pending[idx:idx + task_size], seed) for idx in range(0, len(pending), task_size)]
+
+    n_total = len(filenames) * len(combinations)
+    n_done = len(completed)
+    print(datetime.now(), f"- {n_total} session and combination pairs, {n_done} done, {len(tasks)} tasks on {n_workers} workers.")
+    with open(output_filename, "a") as output_file, Pool(n_workers) as pool:
+        for rows in pool.imap_unordered(sweep_session, tasks):
+            output_file.write("".join("\t".join(str(row[column]) for column in SWEEP_COLUMNS) + "\n" for row in rows))
+            output_file.flush()
+            n_done += len(rows) // rows[0]["n_blocks"]
+            print(datetime.now(), f"- {n_done} of {n_total} done.", end="\r")
+    print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rescore logged sessions with every combination of a parameter grid, in parallel.")
+    parser.add_argument("spec", type=str, help="JSON file with a \"grid\" that maps experiment block parameters (e.g. state_wait_time_range, desired_velocity, "
+                                               "force_amplification) and interface parameters (circle_radius, main_circle_radius, target_distance in m) to lists of values.")
+    parser.add_argument("filenames", type=str, nargs="*", help="experiment_data_XX.tsv files, defaults to all sessions in --results_path.")
+    parser.add_argument("--results_path", type=str, default=None, help="Defaults to the results_path in experiment_config.json.")
+    parser.add_argument("--output", type=str, default="sweep_results.tsv", help="Table of the results, one row per session, combination and block. An existing table is resumed.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes, defaults to the number of CPUs.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the wait times, defaults to the logged seed of every session.")
+    args = parser.parse_args()
+
+    spec = json.load(open(args.spec, "r"))
+    filenames = args.filenames
+    if len(filenames) == 0:
+        results_path = args.results_path or json.load(open("experiment_config.json", "r"))["results_path"]
+        filenames = find_sessions(results_path)
+    assert len(filenames) > 0, "No sessions to sweep."
+
+    run_sweep(filenames, spec["grid"], args.output, n_workers=args.workers, seed=args.seed)
+    print(datetime.now(), f"- Saved to {args.output}")
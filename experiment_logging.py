@@ -1,13 +1,653 @@
 import os
 import json
+import itertools
+import mmap
+import struct
+import threading
+import zlib
+from datetime import datetime
+from operator import itemgetter
+from time import monotonic, sleep
 
 import numpy as np
 
+from trial_summary import TrialSegmenter
+
+
+def get_session_filename(results_path, participant_id, session_idx, prefix="experiment_data", extension="tsv"):
+    return os.path.join(results_path, "participant_%03d" % participant_id, f"{prefix}_{'%02d' % session_idx}.{extension}")
+
+
+def get_session_config_filename(trajectory_filename):
+    # the experiment_config_XX.json logged next to experiment_data_XX.tsv
+    directory, basename = os.path.split(trajectory_filename)
+    return os.path.join(directory, os.path.splitext(basename)[0].replace("experiment_data", "experiment_config") + ".json")
+
+
+def get_session_trials_filename(trajectory_filename):
+    # the trial index experiment_trials_XX.tsv logged next to experiment_data_XX
+    directory, basename = os.path.split(trajectory_filename)
+    return os.path.join(directory, os.path.splitext(basename)[0].replace("experiment_data", "experiment_trials") + ".tsv")
+
+
+def find_sessions(results_path, extension="tsv"):
+    # experiment_data_XX files of all participant folders, sorted by participant and session
+    filenames = []
+    for participant_folder in sorted(os.listdir(results_path)):
+        if participant_folder.startswith("participant_") and os.path.isdir(os.path.join(results_path, participant_folder)):
+            filenames += [os.path.join(results_path, participant_folder, filename) for filename in sorted(os.listdir(os.path.join(results_path, participant_folder)))
+                          if filename.startswith("experiment_data_") and filename.endswith("." + extension)]
+    return filenames
+
+
+def count_sessions(participant_path):
+    # number of experiment_data_XX sessions of a participant folder; a session converted to .traj next to its TSV counts once,
+    # so the next session still gets the index of its experiment_config_XX.json
+    return len({filename.split(".")[0] for filename in os.listdir(participant_path) if filename.startswith("experiment_data_")})
+
+
+def read_trajectory_chunks(filename, chunk_size=10000):
+    # streams a trajectory TSV file, yielding (column_names, chunk) where chunk maps column names to string arrays of at most `chunk_size` rows
+    with open(filename, "r") as trajectory_file:
+        column_names = trajectory_file.readline().rstrip("\n").split("\t")
+        
+        rows = []
+        for line in trajectory_file:
+            rows.append(line.rstrip("\n").split("\t"))
+            if len(rows) == chunk_size:
+                yield column_names, _rows_to_columns(column_names, rows)
+                rows = []
+        
+        if len(rows) > 0:
+            yield column_names, _rows_to_columns(column_names, rows)
+
+
+def _rows_to_columns(column_names, rows):
+    rows = np.array(rows, dtype=str)
+    return {column_name: rows[:, idx] for idx, column_name in enumerate(column_names)}
+
+
+def read_trial_index(filename):
+    trials = []
+    with open(filename, "r") as trials_file:
+        column_names = trials_file.readline().rstrip("\n").split("\t")
+        for line in trials_file:
+            trial = dict(zip(column_names, line.rstrip("\n").split("\t")))
+            for column_name in ["trial_idx", "block_idx", "start_row", "end_row"]:
+                trial[column_name] = int(trial[column_name])
+            for column_name in ["start_time", "end_time"]:
+                trial[column_name] = float(trial[column_name])
+            # the movement is None for trials that ended before it
+            for column_name in ["movement_start_row", "movement_end_row"]:
+                trial[column_name] = None if trial.get(column_name, "None") == "None" else int(trial[column_name])
+            for column_name in ["movement_start_time", "movement_end_time"]:
+                trial[column_name] = None if trial.get(column_name, "None") == "None" else float(trial[column_name])
+            trial["success"] = None if trial["success"] == "None" else trial["success"] == "True"
+            trials.append(trial)
+    return trials
+
+
+def derive_trial_index(trajectory_filename):
+    # trial index of a session logged without one (before experiment_trials_XX.tsv existed), from the logged state of every
+    # row: a change of `current_state` is a transition, and the outcome at the end of the hold is whether `score` increased.
+    # transitions taken in the same tick show up as one, and a time-up transition one row later than in the logged index.
+    columns = read_session_columns(trajectory_filename, ["current_state", "score", "block_idx", "marker_timestamp"])
+    states = columns["current_state"].astype(str).tolist()
+    scores = columns["score"].astype(float).tolist()
+    block_idxs = columns["block_idx"].astype(float).astype(int).tolist()
+    timestamps = columns["marker_timestamp"].astype(float).tolist()
+
+    trial_segmenter = TrialSegmenter()
+    trials = []
+    for row_idx in range(1, len(states)):
+        if states[row_idx] == states[row_idx - 1]:
+            continue
+        success = None
+        if states[row_idx - 1].startswith("STAY_IN_") and states[row_idx].endswith("_AFTER_TRIAL"):
+            success = scores[row_idx] > scores[row_idx - 1]
+        event = {"timestamp": timestamps[row_idx], "block_idx": block_idxs[row_idx], "from_state": states[row_idx - 1], "to_state": states[row_idx], "success": success}
+        trials += trial_segmenter.update([event], row_idx)
+    return trials
+
+
+def read_trial(trajectory_filename, trial, columns=None):
+    # rows of one trial from the trial index; .traj files are read by seeking to the trial's chunks,
+    # TSV files skip the preceding lines without parsing them
+    if trajectory_filename.endswith(".traj"):
+        reader = TrajectoryReader(trajectory_filename)
+        rows = {name: np.array(values) for name, values in reader.read_rows(trial["start_row"], trial["end_row"], columns=columns).items()}
+        reader.close()
+        return rows
+    
+    with open(trajectory_filename, "r") as trajectory_file:
+        column_names = trajectory_file.readline().rstrip("\n").split("\t")
+        lines = itertools.islice(trajectory_file, trial["start_row"], trial["end_row"])
+        rows = _rows_to_columns(column_names, [line.rstrip("\n").split("\t") for line in lines])
+    return rows if columns is None else {name: rows[name] for name in columns}
+
+
+def read_session_columns(trajectory_filename, columns, chunk_size=10000):
+    # whole columns of a session; .traj files only decode these columns (categories as strings),
+    # TSV files are streamed and return string arrays
+    if trajectory_filename.endswith(".traj"):
+        reader = TrajectoryReader(trajectory_filename)
+        values = {}
+        for name in columns:
+            values[name] = reader.read_column(name).copy()
+            if name in reader.labels:
+                values[name] = reader.decode_categories(name, values[name]).astype(str)
+        reader.close()
+        return values
+
+    parts = {name: [] for name in columns}
+    for _, chunk in read_trajectory_chunks(trajectory_filename, chunk_size=chunk_size):
+        for name in columns:
+            parts[name].append(chunk[name])
+    return {name: np.concatenate(values) if len(values) > 0 else np.zeros(0, dtype=str) for name, values in parts.items()}
+
+
+class RecordSchema:
+    # fixed, typed layout of the logged state_dict, built once from the first state_dict.
+    # numbers are stored as float64 (lists and arrays as subarrays), bools as bools,
+    # strings and tuples (e.g. colors) as categorical codes. the python type of every scalar number
+    # is kept in a small per-row code, so the TSV shows `2` and `2.0`, or `None`, like `str()` of the value.
+    # vectors keep the length they have in the first state_dict: longer values (e.g. the `catch_trial_idxs` of a later
+    # block) are truncated, shorter ones padded with nan.
+
+    FLOAT = "float"
+    INT = "int"
+    NULLABLE = "nullable"
+    BOOL = "bool"
+    CATEGORY = "category"
+
+    # type codes of scalar numbers, and how each code is formatted
+    NUMBER_TYPES = {float: 0, np.float64: 0, np.float32: 0, int: 1, np.int64: 1, np.int32: 1, type(None): 2, bool: 3, np.bool_: 3}
+    NUMBER_FORMATS = [str, lambda v: str(int(v)), lambda v: "None", lambda v: str(bool(v))]
+    
+    def __init__(self, state_dict):
+        self.keys = []
+        self.kinds = []
+        self.widths = []
+        self.column_names = []
+        self.categories = {}
+        self.labels = {}
+        dtype = []
+        
+        for key in sorted(state_dict.keys()):
+            value = state_dict[key]
+            if isinstance(value, (bool, np.bool_)):
+                kind, width, field_dtype = RecordSchema.BOOL, None, "?"
+            elif isinstance(value, (int, np.integer)):
+                kind, width, field_dtype = RecordSchema.INT, None, "f8"
+            elif isinstance(value, (float, np.floating)):
+                kind, width, field_dtype = RecordSchema.FLOAT, None, "f8"
+            elif value is None:
+                kind, width, field_dtype = RecordSchema.NULLABLE, None, "f8"
+            elif isinstance(value, str):
+                kind, width, field_dtype = RecordSchema.CATEGORY, None, "i4"
+            elif isinstance(value, tuple):
+                kind, width, field_dtype = RecordSchema.CATEGORY, len(value), "i4"
+            elif isinstance(value, (list, np.ndarray)):
+                if len(value) == 0:
+                    continue
+                is_int = all(isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_)) for v in value)
+                kind, width, field_dtype = RecordSchema.INT if is_int else RecordSchema.FLOAT, len(value), "f8"
+            else:
+                print("Unrecognized data type:", type(value), value, key)
+                continue
+            
+            self.keys.append(key)
+            self.kinds.append(kind)
+            self.widths.append(width)
+            if kind == RecordSchema.CATEGORY:
+                self.categories[key] = {}
+                self.labels[key] = []
+                dtype.append((key, field_dtype))
+            else:
+                dtype.append((key, field_dtype) if width is None else (key, field_dtype, (width, )))
+            self.column_names += [key] if width is None else [key + "." + str(idx) for idx in range(width)]
+        
+        self._number_idxs = [idx for idx, (kind, width) in enumerate(zip(self.kinds, self.widths)) if width is None and kind in (RecordSchema.INT, RecordSchema.FLOAT, RecordSchema.NULLABLE)]
+        if len(self._number_idxs) > 0:
+            dtype.append(("_number_types", "u1", (len(self._number_idxs), )))
+        self.dtype = np.dtype(dtype)
+        self._getter = itemgetter(*self.keys) if len(self.keys) > 1 else (lambda state_dict: (state_dict[self.keys[0]], ))
+        self._category_idxs = [(idx, self.categories[key], self.labels[key]) for idx, key in enumerate(self.keys) if key in self.categories]
+        self._vector_idxs = [(idx, width) for idx, (kind, width) in enumerate(zip(self.kinds, self.widths)) if width is not None and kind != RecordSchema.CATEGORY]
+    
+    def encode(self, state_dict):
+        # one row of the structured dtype; this is on the hot path, so no formatting happens here
+        values = list(self._getter(state_dict))
+        for idx, categories, labels in self._category_idxs:
+            code = categories.get(values[idx])
+            if code is None:
+                # the label is appended before the code is published, so a writer thread can always look it up
+                labels.append(values[idx])
+                code = categories[values[idx]] = len(labels) - 1
+            values[idx] = code
+        for idx, width in self._vector_idxs:
+            if len(values[idx]) != width:
+                values[idx] = (list(values[idx][:width]) + [np.nan] * width)[:width]
+        if len(self._number_idxs) > 0:
+            number_types = RecordSchema.NUMBER_TYPES
+            values.append(tuple([number_types.get(type(values[idx]), 0) for idx in self._number_idxs]))
+        return tuple(values)
+    
+    def encode_into(self, array, idx, state_dict):
+        array[idx] = self.encode(state_dict)
+    
+    def format_columns(self, block):
+        # string columns of a block of rows, formatted as `str()` of the original values
+        columns = []
+        number_positions = {idx: position for position, idx in enumerate(self._number_idxs)}
+        for key_idx, (key, kind, width) in enumerate(zip(self.keys, self.kinds, self.widths)):
+            values = block[key]
+            if key_idx in number_positions:
+                formats = RecordSchema.NUMBER_FORMATS
+                number_types = block["_number_types"][:, number_positions[key_idx]].tolist()
+                columns.append([formats[number_type](v) for v, number_type in zip(values.tolist(), number_types)])
+            elif width is not None and kind != RecordSchema.CATEGORY:
+                for idx in range(width):
+                    columns.append(self._format_values(values[:, idx], kind))
+            elif kind == RecordSchema.CATEGORY:
+                labels = self.labels[key]
+                if width is None:
+                    columns.append([str(labels[code]) for code in values.tolist()])
+                else:
+                    for idx in range(width):
+                        lookup = [str(label[idx]) for label in labels]
+                        columns.append([lookup[code] for code in values.tolist()])
+            else:
+                columns.append(self._format_values(values, kind))
+        return columns
+
+    @staticmethod
+    def _format_values(values, kind):
+        if kind == RecordSchema.BOOL:
+            return list(map(str, values.tolist()))
+        elif kind == RecordSchema.INT:
+            return [str(int(v)) if v.is_integer() else str(v) for v in values.tolist()]
+        return list(map(str, values.tolist()))
+    
+    def format_block(self, block):
+        return "".join("\t".join(row) + "\n" for row in zip(*self.format_columns(block)))
+    
+    def to_columns(self, block):
+        # flat, copied columns of a block of rows; tuples are expanded to their numeric components, strings stay categorical codes
+        columns = {}
+        for key, kind, width in zip(self.keys, self.kinds, self.widths):
+            values = block[key]
+            if kind == RecordSchema.CATEGORY and width is not None:
+                labels = self.labels[key]
+                components = np.array(labels[:len(labels)], dtype=float)[values]
+                for idx in range(width):
+                    columns[key + "." + str(idx)] = components[:, idx].copy()
+            elif width is not None:
+                for idx in range(width):
+                    columns[key + "." + str(idx)] = values[:, idx].copy()
+            else:
+                columns[key] = values.copy()
+        return columns
+
+
+class TsvTrajectoryFile:
+    
+    def __init__(self, filename, schema):
+        self.schema = schema
+        self.file = open(filename, "w")
+        self.file.write("\t".join(schema.column_names) + "\n")
+        
+    def write_block(self, block):
+        self.file.write(self.schema.format_block(block))
+        
+    def close(self):
+        self.file.close()
+
+
+class ContainerTrajectoryFile:
+    
+    def __init__(self, filename, schema, chunk_rows=10000, compression="zlib"):
+        self.schema = schema
+        self.writer = TrajectoryContainerWriter(filename, chunk_rows=chunk_rows, compression=compression)
+        
+    def write_block(self, block):
+        self.writer.write_columns(self.schema.to_columns(block), labels=self.schema.labels)
+        
+    def close(self):
+        self.writer.close()
+
+
+class TrajectoryContainerWriter:
+    # binary columnar trajectory file: fixed-size chunks of rows, every column of a chunk compressed separately,
+    # followed by a JSON footer with the column types, category labels, and per-chunk offsets and min/max values.
+    # layout: MAGIC | chunk 0 columns | chunk 1 columns | ... | footer | footer length (uint64) | MAGIC
+    
+    MAGIC = b"MLTRAJ01"
+    
+    def __init__(self, filename, chunk_rows=10000, compression="zlib", compression_level=3):
+        assert compression in {"zlib", "none"}, "Compression must be {zlib, none}."
+        self.filename = filename
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.compression_level = compression_level
+        
+        self.file = open(filename, "wb")
+        self.file.write(TrajectoryContainerWriter.MAGIC)
+        
+        self.column_names = []
+        self.dtypes = {}
+        self.labels = {}
+        self.chunks = []
+        self.n_rows = 0
+        
+        self.pending = {}
+        self.pending_rows = 0
+    
+    def write_columns(self, columns, labels=None):
+        # columns maps names to equally long 1-D arrays; int32 columns are categorical codes into `labels[name]`
+        n_rows = None
+        for name, values in columns.items():
+            if name not in self.dtypes:
+                assert self.n_rows == 0 and self.pending_rows == 0, f"Column {name} added after the first rows were written."
+                self.column_names.append(name)
+                self.dtypes[name] = values.dtype.str
+                self.pending[name] = []
+            if values.dtype == np.int32:
+                self.labels[name] = labels[name]
+            assert n_rows is None or len(values) == n_rows, "All columns must have the same length."
+            n_rows = len(values)
+            self.pending[name].append(values)
+        
+        self.pending_rows += n_rows
+        if self.pending_rows >= self.chunk_rows:
+            self._write_pending(final=False)
+            
+    def _write_pending(self, final):
+        if self.pending_rows == 0:
+            return
+        
+        pending = {name: np.concatenate(self.pending[name]) for name in self.column_names}
+        chunk_start = 0
+        while self.pending_rows - chunk_start >= self.chunk_rows or (final and chunk_start < self.pending_rows):
+            chunk_stop = min(chunk_start + self.chunk_rows, self.pending_rows)
+            self._write_chunk({name: values[chunk_start:chunk_stop] for name, values in pending.items()})
+            chunk_start = chunk_stop
+            
+        self.pending = {name: [values[chunk_start:]] for name, values in pending.items()}
+        self.pending_rows -= chunk_start
+        
+    def _write_chunk(self, columns):
+        chunk = {"row_start": self.n_rows, "n_rows": 0, "columns": []}
+        for name in self.column_names:
+            values = np.ascontiguousarray(columns[name], dtype=self.dtypes[name])
+            chunk["n_rows"] = len(values)
+            
+            if self.compression == "zlib":
+                # byte shuffling groups the similar high bytes of neighbouring floats, which compresses much better
+                data = values.view(np.uint8).reshape(len(values), values.itemsize).T.tobytes()
+                data = zlib.compress(data, self.compression_level)
+            else:
+                data = values.tobytes()
+            
+            # keep every column 8-byte aligned so uncompressed columns can be viewed in place
+            offset = self.file.tell()
+            self.file.write(data + b"\0" * (-len(data) % 8))
+            
+            value_min = value_max = None
+            if values.dtype.kind == "f" and len(values) > 0 and not np.all(np.isnan(values)):
+                value_min, value_max = float(np.nanmin(values)), float(np.nanmax(values))
+            chunk["columns"].append([offset, len(data), value_min, value_max])
+            
+        self.chunks.append(chunk)
+        self.n_rows += chunk["n_rows"]
+        
+    def close(self):
+        self._write_pending(final=True)
+        
+        footer = {
+            "n_rows": self.n_rows,
+            "chunk_rows": self.chunk_rows,
+            "compression": self.compression,
+            "columns": [{"name": name, "dtype": self.dtypes[name], "labels": [str(label) for label in self.labels[name]] if name in self.labels else None} for name in self.column_names],
+            "chunks": self.chunks,
+        }
+        footer = json.dumps(footer).encode("utf-8")
+        self.file.write(footer)
+        self.file.write(struct.pack("<Q", len(footer)))
+        self.file.write(TrajectoryContainerWriter.MAGIC)
+        self.file.close()
+
+
+class TrajectoryReader:
+    # memory-mapped reader for files written by `TrajectoryContainerWriter`.
+    # only the chunks of the requested columns and rows are decoded, uncompressed columns within one chunk are returned as views.
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        magic_length = len(TrajectoryContainerWriter.MAGIC)
+        assert self.mmap[:magic_length] == TrajectoryContainerWriter.MAGIC and self.mmap[-magic_length:] == TrajectoryContainerWriter.MAGIC, f"{filename} is not a trajectory container."
+        footer_length = struct.unpack("<Q", self.mmap[-magic_length - 8:-magic_length])[0]
+        footer = json.loads(self.mmap[-magic_length - 8 - footer_length:-magic_length - 8].decode("utf-8"))
+        
+        self.n_rows = footer["n_rows"]
+        self.compression = footer["compression"]
+        self.column_names = [column["name"] for column in footer["columns"]]
+        self.dtypes = {column["name"]: np.dtype(column["dtype"]) for column in footer["columns"]}
+        self.labels = {column["name"]: column["labels"] for column in footer["columns"] if column["labels"] is not None}
+        self.chunks = footer["chunks"]
+        
+        self._column_idxs = {name: idx for idx, name in enumerate(self.column_names)}
+        self._chunk_starts = np.array([chunk["row_start"] for chunk in self.chunks] + [self.n_rows], dtype=np.int64)
+        
+    def __len__(self):
+        return self.n_rows
+    
+    def _decode(self, name, chunk_idx):
+        chunk = self.chunks[chunk_idx]
+        offset, length, _, _ = chunk["columns"][self._column_idxs[name]]
+        dtype = self.dtypes[name]
+        if self.compression == "zlib":
+            data = zlib.decompress(self.mmap[offset:offset + length])
+            return np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, chunk["n_rows"]).T.copy().view(dtype).ravel()
+        return np.frombuffer(self.mmap, dtype=dtype, count=chunk["n_rows"], offset=offset)
+    
+    def read_column(self, name, start=0, stop=None):
+        stop = self.n_rows if stop is None else min(stop, self.n_rows)
+        if start >= stop:
+            return np.zeros(0, dtype=self.dtypes[name])
+        
+        first_chunk = int(np.searchsorted(self._chunk_starts, start, side="right")) - 1
+        last_chunk = int(np.searchsorted(self._chunk_starts, stop, side="left")) - 1
+        parts = []
+        for chunk_idx in range(first_chunk, last_chunk + 1):
+            chunk_start = self._chunk_starts[chunk_idx]
+            parts.append(self._decode(name, chunk_idx)[max(start - chunk_start, 0):stop - chunk_start])
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+    
+    def read_rows(self, start=0, stop=None, columns=None):
+        columns = self.column_names if columns is None else columns
+        return {name: self.read_column(name, start, stop) for name in columns}
+    
+    def find_rows(self, name, low, high):
+        # row range [start, stop) where the non-decreasing column `name` lies in [low, high), e.g. a time range of `marker_timestamp`.
+        # chunks are selected from the footer min/max, so at most the two boundary chunks are decoded.
+        column_idx = self._column_idxs[name]
+        chunk_maxs = np.array([np.inf if chunk["columns"][column_idx][3] is None else chunk["columns"][column_idx][3] for chunk in self.chunks])
+        chunk_mins = np.array([-np.inf if chunk["columns"][column_idx][2] is None else chunk["columns"][column_idx][2] for chunk in self.chunks])
+        
+        first_chunk = int(np.searchsorted(chunk_maxs, low, side="left"))
+        if first_chunk == len(self.chunks):
+            return self.n_rows, self.n_rows
+        start = self._chunk_starts[first_chunk] + int(np.searchsorted(self._decode(name, first_chunk), low, side="left"))
+        
+        last_chunk = int(np.searchsorted(chunk_mins, high, side="left")) - 1
+        if last_chunk < first_chunk:
+            return start, start
+        stop = self._chunk_starts[last_chunk] + int(np.searchsorted(self._decode(name, last_chunk), high, side="left"))
+        return int(start), int(stop)
+    
+    def read_range(self, name, low, high, columns=None):
+        return self.read_rows(*self.find_rows(name, low, high), columns=columns)
+    
+    def decode_categories(self, name, codes):
+        return np.array(self.labels[name], dtype=object)[codes]
+    
+    def close(self):
+        try:
+            self.mmap.close()
+        except BufferError:
+            # arrays viewing the mapped file still exist; the mapping is released once they are garbage collected
+            pass
+        self.file.close()
+
+
+def convert_tsv_to_container(tsv_filename, container_filename, chunk_rows=10000, compression="zlib"):
+    # streams a TSV trajectory into a container; column types are inferred from the first chunk
+    writer = TrajectoryContainerWriter(container_filename, chunk_rows=chunk_rows, compression=compression)
+    kinds = None
+    categories, labels = {}, {}
+    
+    for column_names, chunk in read_trajectory_chunks(tsv_filename, chunk_size=chunk_rows):
+        if kinds is None:
+            kinds = {name: _infer_column_kind(chunk[name]) for name in column_names}
+            
+        columns = {}
+        for name in column_names:
+            values = chunk[name]
+            if kinds[name] == RecordSchema.BOOL:
+                columns[name] = values == "True"
+            elif kinds[name] == RecordSchema.FLOAT:
+                try:
+                    columns[name] = np.where(values == "None", "nan", values).astype(float)
+                except ValueError:
+                    raise ValueError(f"Column {name} of {tsv_filename} is not numeric after the first {chunk_rows} rows.")
+            else:
+                column_categories = categories.setdefault(name, {})
+                column_labels = labels.setdefault(name, [])
+                unique_values, inverse = np.unique(values, return_inverse=True)
+                unique_codes = np.zeros(len(unique_values), dtype=np.int32)
+                for idx, value in enumerate(unique_values.tolist()):
+                    if value not in column_categories:
+                        column_categories[value] = len(column_labels)
+                        column_labels.append(value)
+                    unique_codes[idx] = column_categories[value]
+                columns[name] = unique_codes[inverse.ravel()]
+        writer.write_columns(columns, labels=labels)
+    
+    writer.close()
+    return writer.n_rows
+
+
+def _infer_column_kind(values):
+    if np.all((values == "True") | (values == "False")):
+        return RecordSchema.BOOL
+    try:
+        np.where(values == "None", "nan", values).astype(float)
+        return RecordSchema.FLOAT
+    except ValueError:
+        return RecordSchema.CATEGORY
+
+
+class AsyncTrajectoryWriter:
+    # single-producer / single-consumer ring of encoded rows, drained in batches by a writer thread.
+    # the producer only advances `write_count` and the consumer only advances `read_count`, so no lock is needed.
+    
+    DROP = "drop"
+    BLOCK = "block"
+    
+    def __init__(self, trajectory_file, schema, capacity=4096, batch_size=500, overflow_policy="drop", late_threshold=1.0, poll_interval=0.01):
+        assert overflow_policy in {AsyncTrajectoryWriter.DROP, AsyncTrajectoryWriter.BLOCK}, "Overflow policy must be {drop, block}."
+        self.trajectory_file = trajectory_file
+        self.schema = schema
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.overflow_policy = overflow_policy
+        self.late_threshold = late_threshold
+        self.poll_interval = poll_interval
+        
+        self.ring = np.zeros(capacity, dtype=schema.dtype)
+        self.push_times = np.zeros(capacity)
+        self.write_count = 0
+        self.read_count = 0
+        
+        self.dropped_records = 0
+        self.late_records = 0
+        self.max_queue_size = 0
+        self.error = None
+        
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        
+    def push(self, state_dict):
+        queue_size = self.write_count - self.read_count
+        if queue_size >= self.capacity:
+            if self.overflow_policy == AsyncTrajectoryWriter.DROP or self.error is not None:
+                self.dropped_records += 1
+                return False
+            while self.write_count - self.read_count >= self.capacity and self.error is None:
+                sleep(0.0005)
+            if self.error is not None:
+                self.dropped_records += 1
+                return False
+        
+        idx = self.write_count % self.capacity
+        self.schema.encode_into(self.ring, idx, state_dict)
+        self.push_times[idx] = monotonic()
+        self.write_count += 1
+        self.max_queue_size = max(self.max_queue_size, self.write_count - self.read_count)
+        return True
+    
+    def _run(self):
+        try:
+            while True:
+                stopping = self._stop.is_set()
+                available = self.write_count - self.read_count
+                if available == 0:
+                    if stopping:
+                        break
+                    self._stop.wait(self.poll_interval)
+                    continue
+                
+                # only drain the contiguous part of the ring, the rest is picked up in the next iteration
+                start = self.read_count % self.capacity
+                n = min(available, self.batch_size, self.capacity - start)
+                self.trajectory_file.write_block(self.ring[start:start + n])
+                self.late_records += int(np.count_nonzero(monotonic() - self.push_times[start:start + n] > self.late_threshold))
+                self.read_count += n
+        except Exception as e:
+            self.error = e
+            print(datetime.now(), "- Trajectory writer failed:", repr(e))
+            
+    def close(self):
+        self._stop.set()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        
 
 class Logger:
     
-    def __init__(self, results_path, participant_id, no_log):
+    EVENT_COLUMNS = ["frame_idx", "timestamp", "block_idx", "from_state", "to_state", "side", "success"]
+    TRIAL_COLUMNS = ["trial_idx", "block_idx", "side", "start_row", "end_row", "start_time", "end_time", "success",
+                     "movement_start_row", "movement_end_row", "movement_start_time", "movement_end_time"]
+    TRIAL_SUMMARY_COLUMNS = ["trial_idx", "block_idx", "side", "success", "perturbation_mode", "force_amplification", "start_time", "end_time", "reaction_time",
+                             "movement_time", "hold_time", "peak_velocity", "mean_velocity", "path_length", "overshoot", "peak_motor_force"]
+    
+    def __init__(self, results_path, participant_id, no_log, buffer_size=50, asynchronous=False, queue_size=4096, overflow_policy="drop", file_format="tsv"):
+        assert file_format in {"tsv", "traj"}, "File format must be {tsv, traj}."
         self.results_path = results_path
+        self.file_format = file_format
+        self.buffer_size = buffer_size
+        self.asynchronous = asynchronous
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.writer = None
+        self.n_datapoints = 0
+        self.trial_segmenter = TrialSegmenter()
         
         self.participant_id = participant_id
         assert isinstance(self.participant_id, int), "Participant ID has to be an integer!"
@@ -23,23 +663,31 @@ class Logger:
             
             
     def create_trajectory_file(self, state_dict):
-        self.column_names = []
         self.original_state_dict_keys = set(state_dict.keys())
-        sorted_keys = sorted(state_dict.keys())
-        for key in sorted_keys:
-            if isinstance(state_dict[key], int) or isinstance(state_dict[key], float) or isinstance(state_dict[key], str) or state_dict[key] is None:
-                self.column_names.append(key)
-            elif isinstance(state_dict[key], list) or isinstance(state_dict[key], np.ndarray) or isinstance(state_dict[key], tuple):
-                self.column_names += [key + "." + str(idx) for idx in range(len(state_dict[key]))]
-            else:
-                print("Unrecognized data type:", type(state_dict[key]), state_dict[key], key)
+        self.schema = RecordSchema(state_dict)
+        self.column_names = self.schema.column_names
+        self.buffer = np.zeros(self.buffer_size, dtype=self.schema.dtype)
+        self.buffer_idx = 0
     
-        file_idx = len([filename for filename in os.listdir(os.path.join(self.results_path, self.participant_folder)) if filename.startswith("experiment_data")])
-        file_idx = str("%02d" % file_idx)
+        file_idx = count_sessions(os.path.join(self.results_path, self.participant_folder))
+        file_idx = self.file_idx = str("%02d" % file_idx)
 
-        self.trajectory_file = open(os.path.join(self.results_path, self.participant_folder, f"experiment_data_{file_idx}.tsv"), "w")
-        self.trajectory_file.write("\t".join(self.column_names) + "\n")
+        filename = os.path.join(self.results_path, self.participant_folder, f"experiment_data_{file_idx}.{self.file_format}")
+        if self.file_format == "tsv":
+            self.trajectory_file = TsvTrajectoryFile(filename, self.schema)
+        else:
+            self.trajectory_file = ContainerTrajectoryFile(filename, self.schema)
         self.trajectory_data_exists = True
+        
+        self.events_file = open(os.path.join(self.results_path, self.participant_folder, f"experiment_events_{file_idx}.tsv"), "w")
+        self.events_file.write("\t".join(Logger.EVENT_COLUMNS) + "\n")
+        self.trials_file = open(os.path.join(self.results_path, self.participant_folder, f"experiment_trials_{file_idx}.tsv"), "w", buffering=1)
+        self.trials_file.write("\t".join(Logger.TRIAL_COLUMNS) + "\n")
+        self.trial_summary_file = open(os.path.join(self.results_path, self.participant_folder, f"experiment_trial_summary_{file_idx}.tsv"), "w", buffering=1)
+        self.trial_summary_file.write("\t".join(Logger.TRIAL_SUMMARY_COLUMNS) + "\n")
+        
+        if self.asynchronous:
+            self.writer = AsyncTrajectoryWriter(self.trajectory_file, self.schema, capacity=self.queue_size, overflow_policy=self.overflow_policy)
     
     def save_datapoint(self, state_dict):
         if self.no_log:
@@ -48,21 +696,48 @@ class Logger:
         if not self.trajectory_data_exists:
             self.create_trajectory_file(state_dict)
             
+        self.n_datapoints += 1
         assert len(self.original_state_dict_keys) == len(state_dict), f"Mismatch in the number of original keys and the number of keys in the current state_dict.\n{set(state_dict.keys()) - self.original_state_dict_keys}"
         
-        datapoint_to_write = []
-        for column_name in self.column_names:
-            column_split = column_name.split(".")
+        if self.writer is not None:
+            self.writer.push(state_dict)
+            return
+        
+        self.schema.encode_into(self.buffer, self.buffer_idx, state_dict)
+        self.buffer_idx += 1
+        if self.buffer_idx == self.buffer_size:
+            self.flush()
             
-            current = state_dict
-            for column_substring in column_split:
-                if column_substring.isdigit():
-                    column_substring = int(column_substring)
-                current = current[column_substring]
-                
-            datapoint_to_write.append(str(current))
+    def save_events(self, events):
+        # state machine transitions of the last logged datapoint, written to a sparse event log and a trial index.
+        # a trial spans the rows [start_row, end_row), from its go cue to the row where its outcome is known, and its
+        # movement the rows [movement_start_row, movement_end_row) (see `trial_summary`).
+        if self.no_log or not self.trajectory_data_exists:
+            return
+        
+        frame_idx = self.n_datapoints - 1
+        for event in events:
+            event = dict(event, frame_idx=frame_idx)
+            self.events_file.write("\t".join(str(event[column]) for column in Logger.EVENT_COLUMNS) + "\n")
+
+        # trials interrupted by a pause or the end of the experiment have no outcome
+        for trial in self.trial_segmenter.update(events, frame_idx):
+            self.trials_file.write("\t".join(str(trial[column]) for column in Logger.TRIAL_COLUMNS) + "\n")
+            
+    def save_trial_summary(self, summary):
+        # one row per finished trial, written as soon as its outcome is known
+        if self.no_log or not self.trajectory_data_exists:
+            return
+
+        values = [("%.6f" % summary[column]) if isinstance(summary[column], float) else str(summary[column]) for column in Logger.TRIAL_SUMMARY_COLUMNS]
+        self.trial_summary_file.write("\t".join(values) + "\n")
+
+    def flush(self):
+        if not self.trajectory_data_exists or self.buffer_idx == 0:
+            return
         
-        self.trajectory_file.write("\t".join(datapoint_to_write) + "\n")
+        self.trajectory_file.write_block(self.buffer[:self.buffer_idx])
+        self.buffer_idx = 0
             
     def save_experiment_config(self, experiment_config, filename=None):
         if not self.no_log:
@@ -82,6 +757,35 @@ class Logger:
                     exit()
                     
             json.dump(com_dict, open(os.path.join(self.results_path, self.participant_folder, "participant_com.json"), "w"), indent=4, sort_keys=True)
-        
+
+    def save_calibration_recording(self, positions, timestamps):
+        # raw (N, 3) recordings of do_before.py, in the experiment_data column layout so they can be replayed
+        if not self.no_log:
+            keys = list(positions.keys())
+            column_names = [f"{key}.{idx}" for key in keys for idx in range(3)] + ["marker_timestamp"]
+            with open(os.path.join(self.results_path, self.participant_folder, "calibration_recording.tsv"), "w") as recording_file:
+                recording_file.write("\t".join(column_names) + "\n")
+                for row_idx, timestamp in enumerate(timestamps):
+                    values = [str(value) for key in keys for value in positions[key][row_idx]] + [str(timestamp)]
+                    recording_file.write("\t".join(values) + "\n")
+
+    def save_timing(self, timing_dict):
+        # loop timing of the session, next to its trajectory file
+        if self.trajectory_data_exists:
+            json.dump(timing_dict, open(os.path.join(self.results_path, self.participant_folder, f"experiment_timing_{self.file_idx}.json"), "w"), indent=4)
+
     def close(self):
-        self.trajectory_file.close()
\ No newline at end of file
+        if not self.trajectory_data_exists:
+            return
+        
+        try:
+            if self.writer is not None:
+                self.writer.close()
+                print(datetime.now(), "- Logged %d records, %d dropped, %d late, max queue size %d." % (self.writer.read_count, self.writer.dropped_records, self.writer.late_records, self.writer.max_queue_size))
+            else:
+                self.flush()
+        finally:
+            self.trajectory_file.close()
+            self.events_file.close()
+            self.trials_file.close()
+            self.trial_summary_file.close()
\ No newline at end of file
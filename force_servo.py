@@ -0,0 +1,135 @@
+from multiprocessing import Process, Event
+from time import monotonic
+
+import numpy as np
+
+from controller import MotorController
+from loop_scheduler import DeadlineScheduler
+from shared_record import SharedRecord
+
+
+PERTURBATION_MODES = ["regular", "channel"]
+FORCE_MODES = ["regular", "none"]
+
+# latest COM kinematics from the control loop; `position` is relative to the CBOS
+KINEMATICS_DTYPE = np.dtype([("sequence", "u8"), ("timestamp", "f8"), ("velocity", "f8", (3, )), ("position", "f8", (3, ))])
+# force law parameters, always replaced together. the amplification decays by `force_decay_rate` per second from `update_time`.
+PARAMETERS_DTYPE = np.dtype([("sequence", "u8"), ("update_time", "f8"), ("force_amplification", "f8"), ("force_decay_rate", "f8"),
+                             ("perturbation_mode", "i4"), ("direction", "f8"), ("force_mode", "i4"), ("participant_weight", "f8")])
+# `timeouts` counts how often the watchdog stopped the force, `stale_updates` the zero forces it sent
+STATUS_DTYPE = np.dtype([("sequence", "u8"), ("force", "f8"), ("n_updates", "u8"), ("overruns", "u8"), ("timeouts", "u8"), ("stale_updates", "u8")])
+
+
+class ForceServo:
+    # computes the force with `MotorController.get_force` and sends it to the pullers from a separate process at `rate` Hz,
+    # independent of rendering and logging. the control loop publishes the kinematics and the force law parameters through
+    # shared memory and never waits on the servo. the servo sends zero force when it stops, and as a watchdog whenever the
+    # kinematics have not been updated for `max_kinematics_age` s (a stalled or crashed control loop), measured on the
+    # servo's own monotonic clock from the time a new record arrives.
+
+    def __init__(self, controller, rate=1000, spin_time=0.0, max_kinematics_age=0.05):
+        self.controller = controller
+        self.kinematics = SharedRecord(KINEMATICS_DTYPE)
+        self.parameters = SharedRecord(PARAMETERS_DTYPE)
+        self.status = SharedRecord(STATUS_DTYPE)
+
+        self._stop = Event()
+        self.process = Process(target=ForceServo._serve, args=(self.kinematics, self.parameters, self.status, self._stop, controller.address, controller.port, controller.max_velocity, controller.protocol, rate, spin_time, max_kinematics_age), daemon=True)
+        self.process.start()
+        self._status = None
+
+    def set_kinematics(self, velocity, position, timestamp):
+        record = self.kinematics.local[0]
+        record["timestamp"] = timestamp
+        record["velocity"] = velocity
+        record["position"] = position
+        self.kinematics.write()
+
+    def set_parameters(self, force_amplification, force_decay_rate, perturbation_mode):
+        # direction, force mode and participant weight are taken from the controller
+        assert self.controller.direction is not None, "You have to set direction before obtaining force."
+        assert self.controller.force_mode is not None, "You have to set force_mode before obtaining force."
+        record = self.parameters.local[0]
+        record["update_time"] = monotonic()
+        record["force_amplification"] = force_amplification
+        record["force_decay_rate"] = force_decay_rate
+        record["perturbation_mode"] = PERTURBATION_MODES.index(perturbation_mode)
+        record["direction"] = self.controller.direction
+        record["force_mode"] = FORCE_MODES.index(self.controller.force_mode)
+        record["participant_weight"] = self.controller.participant_weight
+        self.parameters.write()
+
+    def get_status(self):
+        # (last sent force, number of force updates, number of missed servo deadlines, number of watchdog timeouts,
+        # number of zero forces sent on stale kinematics)
+        status = self.status.read(retries=1)
+        if status is not None:
+            self._status = status
+        if self._status is None:
+            return 0.0, 0, 0, 0, 0
+        return (float(self._status["force"]), int(self._status["n_updates"]), int(self._status["overruns"]), int(self._status["timeouts"]),
+                int(self._status["stale_updates"]))
+
+    def get_force(self):
+        return self.get_status()[0]
+
+    def close(self):
+        self._stop.set()
+        self.process.join(timeout=1.0)
+
+    @staticmethod
+    def _serve(kinematics, parameters, status, stop, address, port, max_velocity, protocol, rate, spin_time, max_kinematics_age):
+        controller = MotorController(address=address, port=port, max_velocity=max_velocity, protocol=protocol)
+        scheduler = DeadlineScheduler(rate, spin_time=spin_time)
+        current_kinematics, current_parameters = None, None
+        # servo time at which the current kinematics record arrived
+        kinematics_time = None
+        n_updates, timeouts, stale_updates = 0, 0, 0
+        is_stale = False
+
+        scheduler.start()
+        while not stop.is_set():
+            # keep the previous records if the control loop is writing them right now
+            record = kinematics.read(retries=1)
+            if record is not None:
+                if current_kinematics is None or record["sequence"] != current_kinematics["sequence"]:
+                    kinematics_time = monotonic()
+                current_kinematics = record
+            record = parameters.read(retries=1)
+            if record is not None:
+                current_parameters = record
+                controller.direction = record["direction"]
+                controller.force_mode = FORCE_MODES[record["force_mode"]]
+                controller.set_participant_weight(record["participant_weight"])
+
+            # the age of the kinematics on the servo clock, as a stalled loop publishes nothing new
+            was_stale = is_stale
+            is_stale = kinematics_time is not None and monotonic() - kinematics_time > max_kinematics_age
+            if is_stale:
+                stale_updates += 1
+                timeouts += not was_stale
+
+            force, perturbation_mode = 0.0, "regular"
+            if current_kinematics is not None and current_parameters is not None and not is_stale:
+                elapsed_time = monotonic() - current_parameters["update_time"]
+                controller.set_force_amplification(max(0, current_parameters["force_amplification"] - current_parameters["force_decay_rate"] * elapsed_time))
+                perturbation_mode = PERTURBATION_MODES[current_parameters["perturbation_mode"]]
+                if perturbation_mode == "regular":
+                    force = controller.get_force(current_kinematics["velocity"], perturbation_mode)
+                else:
+                    force = controller.get_force(current_kinematics["position"], perturbation_mode)
+            controller.send_force(force, perturbation_mode)
+
+            n_updates += 1
+            status.local["force"] = force
+            status.local["n_updates"] = n_updates
+            status.local["overruns"] = scheduler.overruns
+            status.local["timeouts"] = timeouts
+            status.local["stale_updates"] = stale_updates
+            status.write()
+            scheduler.wait()
+
+        controller.send_force(0.0)
+        if protocol == "framed":
+            controller.poll_acks(timeout=0.05)
+            print("Force servo commands:", controller.telemetry.to_dict())
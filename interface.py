@@ -1,6 +1,12 @@
+from multiprocessing import Process, Event
+from time import monotonic, sleep
+
 import numpy as np
 import pygame
 
+from loop_scheduler import DeadlineScheduler
+from shared_record import SharedRecord
+
 
 class Colors:
     
@@ -16,6 +22,8 @@ class Colors:
 
 class Interface:
     
+    TEXT_CACHE_SIZE = 256
+    
     def __init__(self, display_number=1):
         self.display_number = display_number
         
@@ -27,103 +35,290 @@ class Interface:
         
         self.main_font = pygame.font.SysFont(None, 56)
         self.font = pygame.font.SysFont(None, 48)
+        
+        # rendered texts and circles, keyed by their content
+        self.text_cache = {}
+        self.circle_cache = {}
+        # (key, rect, draw operations) of every element drawn in the previous frame
+        self.prev_elements = None
+        self._layout_state_dict = None
+        self._layout_block_idx = None
+    
+    def set_layout(self, state_dict):
+        # static layout, computed once per block; colors are only initialized
+        self.scale = state_dict["pixels_per_m"] * state_dict["display_scaling"]
+        
+        state_dict["main_circle_radius"] = 0.002 * self.scale
+        state_dict.setdefault("main_circle_color", Colors.BLACK)
+        state_dict["middle_circle_position"] = np.array([self.window_width / 2, self.window_height / 2])
+        state_dict["middle_circle_radius"] = 0.005 * self.scale
+        state_dict.setdefault("middle_circle_color", Colors.BLACK)
+        state_dict["right_circle_position"] = np.array(state_dict["middle_circle_position"])
+        state_dict["right_circle_position"][0] += 0.06 * self.scale
+        state_dict["right_circle_radius"] = 0.005 * self.scale
+        state_dict.setdefault("right_circle_color", Colors.BLACK)
+        state_dict["left_circle_position"] = np.array(state_dict["middle_circle_position"])
+        state_dict["left_circle_position"][0] -= 0.06 * self.scale
+        state_dict["left_circle_radius"] = 0.005 * self.scale
+        state_dict.setdefault("left_circle_color", Colors.BLACK)
+        state_dict["screen_center_position"] = np.array([self.window_width / 2, self.window_height / 2])
+        
+        self._layout_state_dict = state_dict
+        self._layout_block_idx = state_dict.get("block_idx")
     
     def update(self, state_dict):
-        if "main_circle_position" not in state_dict:
-            state_dict["main_circle_radius"] = 0.002 * state_dict["pixels_per_m"] * state_dict["display_scaling"]
-            state_dict["main_circle_color"] = Colors.BLACK
-        if "middle_circle_position" not in state_dict:
-            state_dict["middle_circle_position"] = np.array([self.window_width / 2, self.window_height / 2])
-            state_dict["middle_circle_radius"] = 0.005 * state_dict["pixels_per_m"] * state_dict["display_scaling"]
-            state_dict["middle_circle_color"] = Colors.BLACK
-        if "right_circle_position" not in state_dict:
-            state_dict["right_circle_position"] = np.array(state_dict["middle_circle_position"])
-            state_dict["right_circle_position"][0] += 0.06 * state_dict["pixels_per_m"] * state_dict["display_scaling"]
-            state_dict["right_circle_radius"] = 0.005 * state_dict["pixels_per_m"] * state_dict["display_scaling"]
-            state_dict["right_circle_color"] = Colors.BLACK
-        if "left_circle_position" not in state_dict:
-            state_dict["left_circle_position"] = np.array(state_dict["middle_circle_position"])
-            state_dict["left_circle_position"][0] -= 0.06 * state_dict["pixels_per_m"] * state_dict["display_scaling"]
-            state_dict["left_circle_radius"] = 0.005 * state_dict["pixels_per_m"] * state_dict["display_scaling"]
-            state_dict["left_circle_color"] = Colors.BLACK
-        if "screen_center_position" not in state_dict:
-            state_dict["screen_center_position"] = np.array([self.window_width / 2, self.window_height / 2])
+        if state_dict is not self._layout_state_dict or state_dict.get("block_idx") != self._layout_block_idx:
+            self.set_layout(state_dict)
         
         # update the raw marker position to reflect the position on screen
-        position_x = self.window_width / 2 - (state_dict["marker_position"][0] - state_dict["cbos"][0]) * state_dict["pixels_per_m"] * state_dict["display_scaling"]
-        position_y = self.window_height / 2 + (state_dict["marker_position"][1] - state_dict["cbos"][1]) * state_dict["pixels_per_m"] * state_dict["display_scaling"]
+        position_x = self.window_width / 2 - (state_dict["marker_position"][0] - state_dict["cbos"][0]) * self.scale
+        position_y = self.window_height / 2 + (state_dict["marker_position"][1] - state_dict["cbos"][1]) * self.scale
             
         state_dict["main_circle_position"] = np.array([position_x, position_y])
         
         self.state_dict = state_dict
     
     def draw(self):
-        self.window.fill(Colors.BLACK)
+        elements = [
+            self._get_circle("left"),
+            self._get_circle("middle"),
+            self._get_circle("right"),
+            self._get_circle("main"),
+            self._get_progress_bar(),
+            self._get_remaining_time(),
+            self._get_score(),
+            self._get_main_text(),
+        ]
         
-        self._draw_left_circle()
-        self._draw_middle_circle()
-        self._draw_right_circle()
-        self._draw_main_circle()
+        if self.prev_elements is None:
+            self.window.fill(Colors.BLACK)
+            for element in elements:
+                self._draw_element(element)
+            pygame.display.update()
+        else:
+            # redraw only the old and new areas of the elements that changed
+            dirty_rects = []
+            for (key, rect, _), (prev_key, prev_rect, _) in zip(elements, self.prev_elements):
+                if key != prev_key:
+                    dirty_rects += [dirty_rect for dirty_rect in (prev_rect, rect) if dirty_rect is not None]
+            
+            for dirty_rect in dirty_rects:
+                self.window.set_clip(dirty_rect)
+                self.window.fill(Colors.BLACK)
+                for element in elements:
+                    if element[1] is not None and element[1].colliderect(dirty_rect):
+                        self._draw_element(element)
+            self.window.set_clip(None)
+            
+            if len(dirty_rects) > 0:
+                pygame.display.update(dirty_rects)
+        
+        self.prev_elements = elements
+    
+    def _draw_element(self, element):
+        # blit (surface, position) or fill (color, rect) operations
+        for source, destination in element[2]:
+            if isinstance(source, pygame.Surface):
+                self.window.blit(source, destination)
+            else:
+                self.window.fill(source, destination)
+    
+    def _render_text(self, font, text, color):
+        key = (id(font), text, color)
+        surface = self.text_cache.get(key)
+        if surface is None:
+            if len(self.text_cache) >= Interface.TEXT_CACHE_SIZE:
+                self.text_cache.clear()
+            surface = self.text_cache[key] = font.render(text, True, color)
+        return surface
+    
+    def _render_circle(self, color, radius):
+        key = (color, radius)
+        surface = self.circle_cache.get(key)
+        if surface is None:
+            size = int(np.ceil(radius)) * 2 + 2
+            surface = pygame.Surface((size, size), pygame.SRCALPHA)
+            pygame.draw.circle(surface, color, (size / 2, size / 2), radius)
+            self.circle_cache[key] = surface
+        return surface
+    
+    def _get_circle(self, name):
+        color = self.state_dict[name + "_circle_color"]
+        position_x, position_y = self.state_dict[name + "_circle_position"].tolist()
+        radius = self.state_dict[name + "_circle_radius"]
         
-        self._draw_progress_bar()
-        self._draw_remaining_time()
-        self._draw_score()
+        surface = self._render_circle(color, radius)
+        rect = surface.get_rect(center=(int(position_x), int(position_y)))
+        return (color, rect.topleft, radius), rect, [(surface, rect)]
+    
+    def _get_progress_bar(self):
+        if not self.state_dict.get("show_progress_bar", None):
+            return None, None, []
+        rect = pygame.Rect(0, 0.02 * self.window_height, self.window_width, 0.05 * self.window_height)
+        remaining_rect = pygame.Rect(0, 0.02 * self.window_height, self.window_width * self.state_dict["remaining_perc"], 0.05 * self.window_height)
+        return remaining_rect.width, rect, [(Colors.RED, rect), (Colors.DARK_GREEN, remaining_rect)]
+    
+    def _get_remaining_time(self):
+        if not self.state_dict.get("show_remaining_time", None):
+            return None, None, []
+        remaining_time = np.round(self.state_dict["remaining_time"], 1)
+        render = self._render_text(self.font, f"Remaining time: {remaining_time}", Colors.WHITE)
+        render_position_x = 0.005 * self.window_width
+        render_position_y = 0.09 * self.window_height
+        rect = render.get_rect(topleft=(int(render_position_x), int(render_position_y)))
+        return remaining_time, rect, [(render, (render_position_x, render_position_y))]
+    
+    def _get_score(self):
+        if not self.state_dict.get("show_score", None):
+            return None, None, []
+        render = self._render_text(self.main_font, self.state_dict["score_text"], Colors.WHITE)
+        render_position_x = 0.5 * self.window_width - render.get_width() / 2
+        render_position_y = 0.6 * self.window_height
+        rect = render.get_rect(topleft=(int(render_position_x), int(render_position_y)))
+        return self.state_dict["score_text"], rect, [(render, (render_position_x, render_position_y))]
+    
+    def _get_main_text(self):
+        if not self.state_dict.get("main_text", ""):
+            return None, None, []
+        render = self._render_text(self.main_font, self.state_dict["main_text"], Colors.WHITE)
+        render_position_x = self.window_width / 2 - render.get_width() / 2
+        render_position_y = self.window_height / 2 - render.get_height() / 2
+        rect = render.get_rect(topleft=(int(render_position_x), int(render_position_y)))
+        return self.state_dict["main_text"], rect, [(render, (render_position_x, render_position_y))]
+    
+    def pump_events(self):
+        pygame.event.get()
+    
+    def is_enter_pressed(self):
+        return pygame.key.get_pressed()[pygame.K_RETURN]
+    
+    def get_mouse_pos(self):
+        return pygame.mouse.get_pos()
+    
+    def close(self):
+        pygame.quit()
+
+
+CIRCLE_NAMES = ["main", "middle", "left", "right"]
+TEXT_SIZE = 128
+
+# everything `Interface.draw` reads from the state_dict, as one fixed-size shared memory record
+DRAW_STATE_DTYPE = np.dtype(
+    [("sequence", "u8")] +
+    [field for name in CIRCLE_NAMES for field in [(name + "_circle_position", "f8", (2, )), (name + "_circle_radius", "f8"), (name + "_circle_color", "u1", (3, ))]] +
+    [("show_progress_bar", "?"), ("remaining_perc", "f8"), ("show_remaining_time", "?"), ("remaining_time", "f8"), ("show_score", "?"), ("score_text", f"S{TEXT_SIZE}"), ("main_text", f"S{TEXT_SIZE}")]
+)
+INPUT_STATE_DTYPE = np.dtype([("sequence", "u8"), ("window_size", "i4", (2, )), ("enter_pressed", "?"), ("mouse_pos", "i4", (2, ))])
+
+
+def pack_draw_state(state_dict, record):
+    for name in CIRCLE_NAMES:
+        record[name + "_circle_position"] = state_dict[name + "_circle_position"]
+        record[name + "_circle_radius"] = state_dict[name + "_circle_radius"]
+        record[name + "_circle_color"] = state_dict[name + "_circle_color"]
+    record["show_progress_bar"] = bool(state_dict.get("show_progress_bar", False))
+    record["remaining_perc"] = state_dict.get("remaining_perc", 0.0)
+    record["show_remaining_time"] = bool(state_dict.get("show_remaining_time", False))
+    record["remaining_time"] = state_dict.get("remaining_time", 0.0)
+    record["show_score"] = bool(state_dict.get("show_score", False))
+    record["score_text"] = state_dict.get("score_text", "").encode("utf-8")[:TEXT_SIZE]
+    record["main_text"] = state_dict.get("main_text", "").encode("utf-8")[:TEXT_SIZE]
+
+
+def unpack_draw_state(record):
+    state_dict = {}
+    for name in CIRCLE_NAMES:
+        state_dict[name + "_circle_position"] = record[name + "_circle_position"]
+        state_dict[name + "_circle_radius"] = float(record[name + "_circle_radius"])
+        state_dict[name + "_circle_color"] = tuple(record[name + "_circle_color"].tolist())
+    for key in ["show_progress_bar", "show_remaining_time", "show_score"]:
+        state_dict[key] = bool(record[key])
+    for key in ["remaining_perc", "remaining_time"]:
+        state_dict[key] = float(record[key])
+    for key in ["score_text", "main_text"]:
+        state_dict[key] = record[key].decode("utf-8", errors="ignore")
+    return state_dict
+
+
+def get_refresh_rate(default=60):
+    try:
+        refresh_rate = pygame.display.get_desktop_refresh_rates()[0]
+    except (AttributeError, IndexError, pygame.error):
+        refresh_rate = 0
+    return refresh_rate if refresh_rate > 0 else default
+
+
+class RemoteInterface(Interface):
+    # same interface, but the window is owned and drawn by a renderer process at the display refresh rate.
+    # `draw` only publishes the draw state to shared memory under a sequence lock, so the control loop never waits on the display;
+    # the renderer publishes the keyboard and mouse state back.
+    
+    def __init__(self, display_number=1, refresh_rate=None, timeout=10.0):
+        self.display_number = display_number
+        self._layout_state_dict = None
+        self._layout_block_idx = None
         
-        self._draw_main_text()
+        self.draw_state = SharedRecord(DRAW_STATE_DTYPE)
+        self.input_state = SharedRecord(INPUT_STATE_DTYPE)
         
-        pygame.display.update()
+        self._stop = Event()
+        self.renderer = Process(target=RemoteInterface._render, args=(self.draw_state, self.input_state, self._stop, display_number, refresh_rate), daemon=True)
+        self.renderer.start()
         
-    def _draw_middle_circle(self):
-        pygame.draw.circle(self.window, 
-                           self.state_dict["middle_circle_color"], 
-                           self.state_dict["middle_circle_position"], 
-                           self.state_dict["middle_circle_radius"])
-    
-    def _draw_left_circle(self):
-        pygame.draw.circle(self.window, 
-                           self.state_dict["left_circle_color"], 
-                           self.state_dict["left_circle_position"], 
-                           self.state_dict["left_circle_radius"])
+        # the layout depends on the window size
+        wait_start = monotonic()
+        self._input = self.input_state.read()
+        while self._input is None:
+            assert self.renderer.is_alive(), "Renderer process failed to start."
+            assert monotonic() - wait_start < timeout, f"Renderer did not open a window in {timeout}s."
+            sleep(0.01)
+            self._input = self.input_state.read()
+        self.window_width, self.window_height = self._input["window_size"].tolist()
+    
+    def draw(self):
+        pack_draw_state(self.state_dict, self.draw_state.local[0])
+        self.draw_state.write()
+    
+    def pump_events(self):
+        # keeps the previous input if the renderer is writing it right now
+        record = self.input_state.read(retries=1)
+        if record is not None:
+            self._input = record
+    
+    def is_enter_pressed(self):
+        return bool(self._input["enter_pressed"])
+    
+    def get_mouse_pos(self):
+        return tuple(self._input["mouse_pos"].tolist())
+    
+    def close(self):
+        self._stop.set()
+        self.renderer.join(timeout=1.0)
+    
+    @staticmethod
+    def _render(draw_state, input_state, stop, display_number, refresh_rate):
+        interface = Interface(display_number=display_number)
+        input_state.local["window_size"] = (interface.window_width, interface.window_height)
         
-    def _draw_right_circle(self):
-        pygame.draw.circle(self.window, 
-                           self.state_dict["right_circle_color"],
-                           self.state_dict["right_circle_position"],
-                           self.state_dict["right_circle_radius"])
+        scheduler = DeadlineScheduler(refresh_rate or get_refresh_rate())
+        scheduler.start()
+        drawn_sequence = 0
+        while not stop.is_set():
+            pygame.event.get()
+            input_state.local["enter_pressed"] = pygame.key.get_pressed()[pygame.K_RETURN]
+            input_state.local["mouse_pos"] = pygame.mouse.get_pos()
+            input_state.write()
+            
+            # draw the newest complete record, if it is new
+            record = draw_state.read(retries=1)
+            if record is not None and record["sequence"] != drawn_sequence:
+                interface.state_dict = unpack_draw_state(record)
+                interface.draw()
+                drawn_sequence = record["sequence"]
+            
+            scheduler.wait()
         
-    def _draw_main_circle(self):
-        pygame.draw.circle(self.window,
-                           self.state_dict["main_circle_color"],
-                           self.state_dict["main_circle_position"],
-                           self.state_dict["main_circle_radius"])
-    
-    def _draw_progress_bar(self):
-        if self.state_dict.get("show_progress_bar", None):
-            pygame.draw.rect(self.window, Colors.RED, pygame.Rect(0, 0.02 * self.window_height, self.window_width, 0.05 * self.window_height))
-            pygame.draw.rect(self.window, Colors.DARK_GREEN, pygame.Rect(0, 0.02 * self.window_height, self.window_width * self.state_dict["remaining_perc"], 0.05 * self.window_height))
-    
-    def _draw_remaining_time(self):
-        if self.state_dict.get("show_remaining_time", None):
-            remaining_time = np.round(self.state_dict["remaining_time"], 1)
-            render = self.font.render(f"Remaining time: {remaining_time}", True, Colors.WHITE)
-            render_position_x = 0.005 * self.window_width
-            render_position_y = 0.09 * self.window_height
-            self.window.blit(render, (render_position_x, render_position_y))
-    
-    def _draw_score(self):
-        if self.state_dict.get("show_score", None):
-            render = self.main_font.render(self.state_dict["score_text"], True, Colors.WHITE)
-            # render = self.main_font.render("Reward: %.2f€" % (self.state_dict["score"] / 20), True, Colors.WHITE)
-            render_position_x = 0.5 * self.window_width - render.get_width() / 2
-            render_position_y = 0.6 * self.window_height
-            self.window.blit(render, (render_position_x, render_position_y))
-    
-    def _draw_main_text(self):
-        if self.state_dict.get("main_text", ""):
-            render = self.main_font.render(self.state_dict["main_text"], True, Colors.WHITE)
-            render_position_x = self.window_width / 2 - render.get_width() / 2
-            render_position_y = self.window_height / 2 - render.get_height() / 2
-            self.window.blit(render, (render_position_x, render_position_y))
+        interface.close()
     
 
 if __name__ == "__main__":
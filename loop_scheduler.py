@@ -0,0 +1,57 @@
+from time import monotonic, sleep
+
+
+class DeadlineScheduler:
+    # paces a loop on absolute monotonic deadlines, `1 / frequency` apart, so sleep errors do not accumulate.
+    # the last `spin_time` seconds before a deadline are busy-waited, as sleep() often wakes up too late.
+    # when a tick misses its deadline, "skip" drops the missed periods and waits for the next deadline on the grid,
+    # "catch_up" runs the following ticks without waiting until the loop is back on schedule.
+
+    SKIP = "skip"
+    CATCH_UP = "catch_up"
+
+    def __init__(self, frequency, spin_time=0.0, missed_deadline_policy="skip", clock=monotonic):
+        assert missed_deadline_policy in {DeadlineScheduler.SKIP, DeadlineScheduler.CATCH_UP}, "Missed deadline policy must be {skip, catch_up}."
+        self.period = 1 / frequency
+        self.spin_time = spin_time
+        self.missed_deadline_policy = missed_deadline_policy
+        self.clock = clock
+
+        self.deadline = None
+        self.n_ticks = 0
+        self.overruns = 0
+        self.skipped_periods = 0
+        self.max_lateness = 0.0
+
+    def start(self):
+        self.deadline = self.clock() + self.period
+
+    def wait(self):
+        # waits for the end of the current period and returns how late the tick finished (0 if on time)
+        if self.deadline is None:
+            self.start()
+        self.n_ticks += 1
+
+        now = self.clock()
+        lateness = now - self.deadline
+        if lateness > 0:
+            self.overruns += 1
+            self.max_lateness = max(self.max_lateness, lateness)
+            if self.missed_deadline_policy == DeadlineScheduler.SKIP:
+                n_missed = int(lateness / self.period) + 1
+                self.skipped_periods += n_missed - 1
+                self.deadline += n_missed * self.period
+                self._wait_until(self.deadline)
+            self.deadline += self.period
+            return lateness
+
+        self._wait_until(self.deadline)
+        self.deadline += self.period
+        return 0.0
+
+    def _wait_until(self, deadline):
+        sleep_time = deadline - self.clock() - self.spin_time
+        if sleep_time > 0:
+            sleep(sleep_time)
+        while self.clock() < deadline:
+            pass
@@ -0,0 +1,90 @@
+from bisect import bisect_right
+
+import numpy as np
+
+
+class LoopTimer:
+    # per-block histograms of the stage durations, the whole tick and the loop period, in preallocated arrays.
+    # `record` takes the stage boundary timestamps of one tick (e.g. `ExperimentLoop.stage_times`) and costs a few us.
+    # a tick overruns when its stages take longer than the loop period; the longest stage of every overrun is counted.
+
+    BUCKET_EDGES_US = np.array([0, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, np.inf])
+
+    def __init__(self, stage_names, n_blocks, frequency):
+        self.stage_names = list(stage_names)
+        self.row_names = self.stage_names + ["tick", "period"]
+        self.n_stages = len(self.stage_names)
+        self.n_blocks = n_blocks
+        self.period_us = 1e6 / frequency
+
+        # flat, preallocated python lists are cheaper to update one element at a time than numpy arrays
+        self.n_rows, self.n_buckets = len(self.row_names), len(LoopTimer.BUCKET_EDGES_US) - 1
+        self._bucket_edges = LoopTimer.BUCKET_EDGES_US[1:-1].tolist()
+        self._histograms = [0] * (n_blocks * self.n_rows * self.n_buckets)
+        self._max_us = [0.0] * (n_blocks * self.n_rows)
+        self._total_us = [0.0] * (n_blocks * self.n_rows)
+        self._overrun_stages = [0] * (n_blocks * self.n_stages)
+        self.n_ticks = [0] * n_blocks
+        self.n_periods = [0] * n_blocks
+        self.overruns = [0] * n_blocks
+        self._prev_start = None
+
+    def record(self, block_idx, stage_times):
+        n_stages = self.n_stages
+        durations = [(stage_times[idx + 1] - stage_times[idx]) * 1e6 for idx in range(n_stages)]
+        durations.append((stage_times[n_stages] - stage_times[0]) * 1e6)
+        # there is no period before the first tick
+        if self._prev_start is not None:
+            durations.append((stage_times[0] - self._prev_start) * 1e6)
+            self.n_periods[block_idx] += 1
+        self._prev_start = stage_times[0]
+
+        row_offset = block_idx * self.n_rows
+        histograms, max_us, total_us, bucket_edges = self._histograms, self._max_us, self._total_us, self._bucket_edges
+        for row_idx, duration in enumerate(durations):
+            histograms[(row_offset + row_idx) * self.n_buckets + bisect_right(bucket_edges, duration)] += 1
+            total_us[row_offset + row_idx] += duration
+            if duration > max_us[row_offset + row_idx]:
+                max_us[row_offset + row_idx] = duration
+        self.n_ticks[block_idx] += 1
+
+        if durations[n_stages] > self.period_us:
+            self.overruns[block_idx] += 1
+            stage_durations = durations[:n_stages]
+            self._overrun_stages[block_idx * n_stages + stage_durations.index(max(stage_durations))] += 1
+
+    @property
+    def histograms(self):
+        return np.array(self._histograms, dtype=np.int64).reshape(self.n_blocks, self.n_rows, self.n_buckets)
+
+    @property
+    def overrun_stages(self):
+        return np.array(self._overrun_stages, dtype=np.int64).reshape(self.n_blocks, self.n_stages)
+
+    def to_dict(self):
+        histograms, overrun_stages = self.histograms, self.overrun_stages
+        max_us = np.array(self._max_us).reshape(self.n_blocks, self.n_rows)
+        total_us = np.array(self._total_us).reshape(self.n_blocks, self.n_rows)
+        blocks = []
+        for block_idx in range(self.n_blocks):
+            if self.n_ticks[block_idx] == 0:
+                continue
+            n_samples = [self.n_ticks[block_idx]] * (self.n_stages + 1) + [max(self.n_periods[block_idx], 1)]
+            blocks.append({
+                "block_idx": block_idx,
+                "n_ticks": int(self.n_ticks[block_idx]),
+                "overruns": int(self.overruns[block_idx]),
+                "overrun_stages": {stage_name: int(count) for stage_name, count in zip(self.stage_names, overrun_stages[block_idx])},
+                "rows": {row_name: {
+                    "histogram": histograms[block_idx, row_idx].tolist(),
+                    "mean_us": float(total_us[block_idx, row_idx] / n_samples[row_idx]),
+                    "max_us": float(max_us[block_idx, row_idx]),
+                } for row_idx, row_name in enumerate(self.row_names)},
+            })
+
+        return {
+            # bucket i counts durations in [bucket_edges_us[i], bucket_edges_us[i + 1]), the last bucket is unbounded
+            "bucket_edges_us": LoopTimer.BUCKET_EDGES_US[:-1].tolist(),
+            "period_us": self.period_us,
+            "blocks": blocks,
+        }
@@ -0,0 +1,115 @@
+import argparse
+import socket
+import struct
+from multiprocessing import Process, Event, Value
+from time import monotonic, sleep
+
+from controller import PROTOCOL_VERSION, COMMAND_FORMAT, ACK_FORMAT, COMMAND_MODES, MotorController
+
+
+class PullerLoopback:
+    # local UDP stand-in for the puller controller, in a separate process. framed commands are acknowledged with
+    # their sequence number and send time, so the sender can measure round-trip time, loss and jitter on one machine.
+    # raw commands (a bare force) are only counted. `drop_every` > 0 drops every n-th framed command unacknowledged.
+
+    def __init__(self, address="127.0.0.1", port=0, drop_every=0):
+        self.address = address
+        self.n_commands = Value("Q", 0, lock=False)
+        self.n_acks = Value("Q", 0, lock=False)
+        self.last_force = Value("d", 0.0, lock=False)
+        self._port = Value("i", 0, lock=False)
+        self._stop = Event()
+        self._ready = Event()
+
+        self.process = Process(target=PullerLoopback._serve, args=(address, port, drop_every, self._port, self.n_commands, self.n_acks, self.last_force, self._stop, self._ready), daemon=True)
+        self.process.start()
+        assert self._ready.wait(timeout=5.0), "Puller loopback did not start."
+        self.port = self._port.value
+
+    def close(self):
+        self._stop.set()
+        self.process.join(timeout=1.0)
+
+    @staticmethod
+    def _serve(address, port, drop_every, bound_port, n_commands, n_acks, last_force, stop, ready):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((address, port))
+        sock.settimeout(0.1)
+        bound_port.value = sock.getsockname()[1]
+        ready.set()
+
+        while not stop.is_set():
+            try:
+                data, sender = sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            receive_time = monotonic()
+            n_commands.value += 1
+
+            if len(data) == 8:
+                last_force.value = struct.unpack("d", data)[0]
+                continue
+            if len(data) != COMMAND_FORMAT.size:
+                continue
+            version, sequence, send_time, mode, force = COMMAND_FORMAT.unpack(data)
+            if version != PROTOCOL_VERSION or mode >= len(COMMAND_MODES):
+                continue
+            last_force.value = force
+            if drop_every > 0 and n_commands.value % drop_every == 0:
+                continue
+            sock.sendto(ACK_FORMAT.pack(PROTOCOL_VERSION, sequence, send_time, receive_time), sender)
+            n_acks.value += 1
+        sock.close()
+
+
+def measure_commands(rate, duration, port=None, address="127.0.0.1", drop_every=0):
+    # sends framed zero-force commands at `rate` Hz for `duration` s and returns the command telemetry.
+    # without `port`, a local puller loopback is started.
+    loopback = None
+    if port is None:
+        loopback = PullerLoopback(address=address, drop_every=drop_every)
+        port = loopback.port
+    controller = MotorController(address=address, port=port, protocol="framed")
+    controller.force_mode = "none"
+
+    period = 1 / rate
+    deadline = monotonic()
+    end_time = deadline + duration
+    while deadline < end_time:
+        controller.send_force(0.0)
+        deadline += period
+        # read the acknowledgements as they arrive until the next deadline
+        while monotonic() < deadline:
+            controller.poll_acks(timeout=deadline - monotonic())
+
+    # wait for the last acknowledgements
+    end_time = monotonic() + 0.1
+    while monotonic() < end_time:
+        controller.poll_acks(timeout=end_time - monotonic())
+    if loopback is not None:
+        loopback.close()
+    return controller.telemetry.to_dict()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local UDP stand-in for the puller controller. Acknowledges framed motor commands, or measures their round-trip time.")
+    parser.add_argument("--address", type=str, default="127.0.0.1", help="Address to listen on (or to send to with --measure).")
+    parser.add_argument("--port", type=int, default=9005, help="Port to listen on (or to send to with --measure).")
+    parser.add_argument("--drop_every", type=int, default=0, help="Drop every n-th framed command without acknowledging it, 0 drops none.")
+    parser.add_argument("--measure", action="store_true", help="Send framed commands to a running loopback (or puller) and report round-trip time, loss and jitter.")
+    parser.add_argument("--rate", type=float, default=1000, help="Command rate in Hz for --measure.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Measurement duration in s for --measure.")
+    args = parser.parse_args()
+
+    if args.measure:
+        print(measure_commands(args.rate, args.duration, port=args.port, address=args.address))
+    else:
+        loopback = PullerLoopback(address=args.address, port=args.port, drop_every=args.drop_every)
+        print("Listening on %s:%d, press Ctrl+C to stop." % (args.address, loopback.port))
+        try:
+            while True:
+                sleep(1.0)
+                print("\rCommands: %d, acknowledged: %d, last force: %.2f N" % (loopback.n_commands.value, loopback.n_acks.value, loopback.last_force.value), end="")
+        except KeyboardInterrupt:
+            print()
+        loopback.close()
@@ -0,0 +1,50 @@
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+
+class SharedRecord:
+    # one fixed-size numpy record in shared memory with a single writer process, read under a sequence lock:
+    # the writer makes the sequence number odd while it writes, readers retry until they copy a record with the
+    # same even sequence number before and after the copy. neither side ever blocks the other.
+    # `dtype` must start with a ("sequence", "u8") field; pass the record to other processes as a Process argument.
+
+    def __init__(self, dtype, buffer=None):
+        self.dtype = np.dtype(dtype)
+        assert self.dtype.names[0] == "sequence", "The first field must be the sequence number."
+        self.buffer = RawArray("B", self.dtype.itemsize) if buffer is None else buffer
+        self._init_views()
+
+    def _init_views(self):
+        self.array = np.frombuffer(self.buffer, dtype=self.dtype)
+        self.sequence = self.array["sequence"]
+        # the record the writer fills before `write`
+        self.local = np.zeros(1, dtype=self.dtype)
+        self._sequence = 0
+
+    def __getstate__(self):
+        return {"dtype": self.dtype, "buffer": self.buffer}
+
+    def __setstate__(self, state):
+        self.dtype, self.buffer = state["dtype"], state["buffer"]
+        self._init_views()
+
+    def write(self):
+        # publishes `self.local`
+        self.local["sequence"] = self._sequence + 1
+        self.sequence[0] = self._sequence + 1
+        self.array[:] = self.local
+        self._sequence += 2
+        self.sequence[0] = self._sequence
+
+    def read(self, retries=10):
+        # a consistent copy of the newest record, or None if nothing was written yet or the writer kept interfering
+        for _ in range(retries):
+            sequence = self.sequence[0]
+            if sequence == 0:
+                return None
+            if sequence % 2 == 0:
+                record = self.array.copy()[0]
+                if self.sequence[0] == sequence:
+                    return record
+        return None
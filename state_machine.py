@@ -1,4 +1,4 @@
-from time import time
+from time import monotonic
 
 import numpy as np
 from interface import Colors
@@ -26,195 +26,260 @@ class StateMachine:
     STAY_IN_RIGHT_CIRCLE = 13
     GO_OUT_OF_RIGHT_CIRCLE = 14
 
-    TRIAL_TERMINATION = 15
     PAUSE = 16
     EXIT = 17
     
-    def __init__(self):
-        self.current_state = None
-        self.prev_main_circle_position = None
-        
-        # construct reverse state lookup
-        all_variables = vars(StateMachine)
-        self.reverse_state_lookup = {all_variables[name]: name for name in all_variables if isinstance(all_variables[name], int) and name.isupper()}
+    CIRCLE_NAMES = ["middle", "left", "right"]
     
-    def maybe_update_state(self, state_dict):
-        continue_loop = True
+    # per state: (action run on every tick in the state, transitions). transitions are (guard, circle, next state, actions),
+    # checked in order; the first one whose guard holds is taken and its actions run in order. an action is a method name,
+    # or (method name, argument). the circle guards compare squared distances of the main circle to the named circle.
+    TRANSITIONS = {
+        None: (None, [
+            ("always", None, WAITING_FOR_START, ["set_waiting_for_start"]),
+        ]),
         
-        #### WHEN NONE
-        if self.current_state is None:
-            self.current_state = StateMachine.WAITING_FOR_START
-            self.set_waiting_for_start(state_dict)
-
         #### AT THE BEGINNING
-        elif self.current_state == StateMachine.WAITING_FOR_START:
-            if state_dict["is_recording"] == True:
-                self.current_state = StateMachine.INITIAL_SCREEN
-                self.set_initial_screen(state_dict)
-
-        elif self.current_state == StateMachine.INITIAL_SCREEN:
-            if state_dict["enter_pressed"]:
-                self.current_state = StateMachine.GO_TO_MIDDLE_CIRCLE
-                self.set_start_experiment(state_dict)
-                self.set_go_to_middle_circle(state_dict)
-
-        elif self.current_state == StateMachine.GO_TO_MIDDLE_CIRCLE:
-            if np.linalg.norm(state_dict["main_circle_position"] - state_dict["middle_circle_position"]) < state_dict["middle_circle_radius"]:
-                self.current_state = StateMachine.IN_MIDDLE_CIRCLE
-                self.set_in_middle_circle(state_dict)
-
-        elif self.current_state == StateMachine.IN_MIDDLE_CIRCLE:
-            if time() - state_dict["state_start_time"] >= state_dict["state_wait_time"]:
-                self.current_state = StateMachine.GO_TO_LEFT_CIRCLE_AFTER_TRIAL
-                self.set_go_to_left_circle_after_trial(state_dict)
-            elif np.linalg.norm(state_dict["main_circle_position"] - state_dict["middle_circle_position"]) > state_dict["middle_circle_radius"]:
-                self.current_state = StateMachine.GO_TO_MIDDLE_CIRCLE
-                self.set_go_to_middle_circle(state_dict)
-
+        WAITING_FOR_START: (None, [
+            ("is_recording", None, INITIAL_SCREEN, ["set_initial_screen"]),
+        ]),
+        INITIAL_SCREEN: (None, [
+            ("enter_pressed", None, GO_TO_MIDDLE_CIRCLE, ["set_start_experiment", "set_go_to_middle_circle"]),
+        ]),
+        GO_TO_MIDDLE_CIRCLE: (None, [
+            ("inside", "middle", IN_MIDDLE_CIRCLE, ["set_in_middle_circle"]),
+        ]),
+        IN_MIDDLE_CIRCLE: (None, [
+            ("wait_elapsed", None, GO_TO_LEFT_CIRCLE_AFTER_TRIAL, ["set_go_to_left_circle_after_trial"]),
+            ("outside", "middle", GO_TO_MIDDLE_CIRCLE, ["set_go_to_middle_circle"]),
+        ]),
+        
         #### GO TO THE LEFT / RIGHT AFTER INITIATION ENDS, OR AFTER TRIAL
-        elif self.current_state == StateMachine.GO_TO_LEFT_CIRCLE_AFTER_TRIAL:
-            if np.linalg.norm(state_dict["main_circle_position"] - state_dict["left_circle_position"]) < state_dict["left_circle_radius"]:
-                self.current_state = StateMachine.IN_LEFT_CIRCLE
-                self.set_in_left_circle(state_dict)
-
-        elif self.current_state == StateMachine.GO_TO_RIGHT_CIRCLE_AFTER_TRIAL:
-            if np.linalg.norm(state_dict["main_circle_position"] - state_dict["right_circle_position"]) < state_dict["right_circle_radius"]:
-                self.current_state = StateMachine.IN_RIGHT_CIRCLE
-                self.set_in_right_circle(state_dict)
-
+        GO_TO_LEFT_CIRCLE_AFTER_TRIAL: (None, [
+            ("inside", "left", IN_LEFT_CIRCLE, ["set_in_left_circle"]),
+        ]),
+        GO_TO_RIGHT_CIRCLE_AFTER_TRIAL: (None, [
+            ("inside", "right", IN_RIGHT_CIRCLE, ["set_in_right_circle"]),
+        ]),
+        
         #### WHEN WAITING IN THE LEFT / RIGHT CIRCLE TO GO OUT
-        elif self.current_state == StateMachine.IN_LEFT_CIRCLE:
-            if time() - state_dict["state_start_time"] >= state_dict["state_wait_time"]:
-                self.current_state = StateMachine.GO_OUT_OF_LEFT_CIRCLE
-                self.set_go_out_of_left_circle(state_dict)
-                self.prev_time = time()
-            elif np.linalg.norm(state_dict["main_circle_position"] - state_dict["left_circle_position"]) > state_dict["left_circle_radius"]:
-                self.current_state = StateMachine.GO_TO_LEFT_CIRCLE_AFTER_TRIAL
-                self.set_go_to_left_circle_after_trial(state_dict)
-
-        elif self.current_state == StateMachine.IN_RIGHT_CIRCLE:
-            if time() - state_dict["state_start_time"] >= state_dict["state_wait_time"]:
-                self.current_state = StateMachine.GO_OUT_OF_RIGHT_CIRCLE
-                self.set_go_out_of_right_circle(state_dict)
-                self.prev_time = time()
-            elif np.linalg.norm(state_dict["main_circle_position"] - state_dict["right_circle_position"]) > state_dict["right_circle_radius"]:
-                self.current_state = StateMachine.GO_TO_RIGHT_CIRCLE_AFTER_TRIAL
-                self.set_go_to_right_circle_after_trial(state_dict)
-
+        IN_LEFT_CIRCLE: (None, [
+            ("wait_elapsed", None, GO_OUT_OF_LEFT_CIRCLE, ["set_go_out_of_left_circle", "start_countdown"]),
+            ("outside", "left", GO_TO_LEFT_CIRCLE_AFTER_TRIAL, ["set_go_to_left_circle_after_trial"]),
+        ]),
+        IN_RIGHT_CIRCLE: (None, [
+            ("wait_elapsed", None, GO_OUT_OF_RIGHT_CIRCLE, ["set_go_out_of_right_circle", "start_countdown"]),
+            ("outside", "right", GO_TO_RIGHT_CIRCLE_AFTER_TRIAL, ["set_go_to_right_circle_after_trial"]),
+        ]),
+        
         #### WHEN TRIAL STARTS
-        elif self.current_state == StateMachine.GO_OUT_OF_LEFT_CIRCLE:
-            state_dict["remaining_time"] -= time() - self.prev_time
-            self.prev_time = time()
-
-            if np.linalg.norm(state_dict["main_circle_position"] - state_dict["left_circle_position"]) >= state_dict["left_circle_radius"]:
-                self.current_state = StateMachine.GO_TO_RIGHT_CIRCLE
-                self.set_go_to_right_circle(state_dict)
-                self.prev_time = time()
-
-        elif self.current_state == StateMachine.GO_OUT_OF_RIGHT_CIRCLE:
-            state_dict["remaining_time"] -= time() - self.prev_time
-            self.prev_time = time()
-
-            if np.linalg.norm(state_dict["main_circle_position"] - state_dict["right_circle_position"]) >= state_dict["right_circle_radius"]:
-                self.current_state = StateMachine.GO_TO_LEFT_CIRCLE
-                self.set_go_to_left_circle(state_dict)
-                self.prev_time = time()
-
+        GO_OUT_OF_LEFT_CIRCLE: ("count_down", [
+            ("not_inside", "left", GO_TO_RIGHT_CIRCLE, ["set_go_to_right_circle"]),
+        ]),
+        GO_OUT_OF_RIGHT_CIRCLE: ("count_down", [
+            ("not_inside", "right", GO_TO_LEFT_CIRCLE, ["set_go_to_left_circle"]),
+        ]),
+        
         #### WHEN TRIAL IS IN PROGRESS
-        elif self.current_state in {StateMachine.GO_TO_RIGHT_CIRCLE, StateMachine.GO_TO_LEFT_CIRCLE}:
-            state_dict["remaining_time"] -= time() - self.prev_time
-            self.prev_time = time()
-
-            if self.current_state == StateMachine.GO_TO_RIGHT_CIRCLE:
-                maybe_next_state = StateMachine.STAY_IN_RIGHT_CIRCLE
-                side = "right"
-            else:
-                maybe_next_state = StateMachine.STAY_IN_LEFT_CIRCLE
-                side = "left"
-            
-            if np.linalg.norm(state_dict["main_circle_position"] - state_dict[side + "_circle_position"]) < state_dict[side + "_circle_radius"]:
-                self.current_state = maybe_next_state
-                self.set_trial_termination(state_dict)
-
-            elif (side == "right" and state_dict["main_circle_position"][0] > (state_dict[side + "_circle_position"][0] + state_dict[side + "_circle_radius"])) or \
-                 (side == "left" and state_dict["main_circle_position"][0] < (state_dict[side + "_circle_position"][0] - state_dict[side + "_circle_radius"])):
-                
-                if self._get_line_distance_to_center(self.prev_main_circle_position, state_dict["main_circle_position"], state_dict[side + "_circle_position"]) < state_dict[side + "_circle_radius"]:
-                    self.set_unsuccessful_trial(state_dict, side)
-                else:
-                    self.set_unsuccessful_trial(state_dict, side)
-                
-                self.current_state = maybe_next_state
-                self.set_trial_termination(state_dict)
-
+        GO_TO_RIGHT_CIRCLE: ("count_down", [
+            ("inside", "right", STAY_IN_RIGHT_CIRCLE, ["set_trial_termination"]),
+            ("passed", "right", STAY_IN_RIGHT_CIRCLE, [("set_passed_target", "right"), "set_trial_termination"]),
+        ]),
+        GO_TO_LEFT_CIRCLE: ("count_down", [
+            ("inside", "left", STAY_IN_LEFT_CIRCLE, ["set_trial_termination"]),
+            ("passed", "left", STAY_IN_LEFT_CIRCLE, [("set_passed_target", "left"), "set_trial_termination"]),
+        ]),
+        
         #### WHEN TRIAL ENDED, BUT WE DON'T WANT THE PARTICIPANT TO OVERSHOOT
-        elif self.current_state in {StateMachine.STAY_IN_LEFT_CIRCLE, StateMachine.STAY_IN_RIGHT_CIRCLE}:
-            self.prev_time = time()
-            trial_terminated = False
-
-            if self.current_state == StateMachine.STAY_IN_RIGHT_CIRCLE:
-                maybe_next_state = StateMachine.GO_TO_RIGHT_CIRCLE_AFTER_TRIAL
-                side = "right"
-            else:
-                maybe_next_state = StateMachine.GO_TO_LEFT_CIRCLE_AFTER_TRIAL
-                side = "left"
-
-            if time() - state_dict["state_start_time"] >= state_dict["state_wait_time"]:
-                self.set_successful_trial(state_dict, side)
-                trial_terminated = True
-
-            elif np.linalg.norm(state_dict["main_circle_position"] - state_dict[side + "_circle_position"]) > (state_dict[side + "_circle_radius"] + state_dict["main_circle_radius"]):
-                self.set_unsuccessful_trial(state_dict, side)
-                trial_terminated = True
-
-            if trial_terminated:
-                self.current_state = maybe_next_state
-                self.set_trial_termination(state_dict)
-
-        elif self.current_state == StateMachine.PAUSE:
-            if time() - state_dict["state_start_time"] >= state_dict["state_wait_time"]:
-                self.current_state = StateMachine.GO_TO_MIDDLE_CIRCLE
-                self.set_unpause(state_dict)
-                self.set_waiting_for_start(state_dict)
-                self.set_initial_screen(state_dict)
-                self.set_start_experiment(state_dict)
-                self.set_go_to_middle_circle(state_dict)
-
-        #### WHEN TRIAL TERMINATES
-        elif self.current_state == StateMachine.TRIAL_TERMINATION:
-            if time() - state_dict["state_start_time"] >= state_dict["state_wait_time"]:
-                self.current_state = StateMachine.GO_TO_START_CIRCLE
-                self.set_go_to_start_circle(state_dict)
+        # the outcome of a trial is decided here, at the end of the hold, and is the one that is scored
+        STAY_IN_RIGHT_CIRCLE: ("start_countdown", [
+            ("wait_elapsed", None, GO_TO_RIGHT_CIRCLE_AFTER_TRIAL, [("set_successful_trial", "right"), "set_trial_termination"]),
+            ("overshot", "right", GO_TO_RIGHT_CIRCLE_AFTER_TRIAL, [("set_unsuccessful_trial", "right"), "set_trial_termination"]),
+        ]),
+        STAY_IN_LEFT_CIRCLE: ("start_countdown", [
+            ("wait_elapsed", None, GO_TO_LEFT_CIRCLE_AFTER_TRIAL, [("set_successful_trial", "left"), "set_trial_termination"]),
+            ("overshot", "left", GO_TO_LEFT_CIRCLE_AFTER_TRIAL, [("set_unsuccessful_trial", "left"), "set_trial_termination"]),
+        ]),
+        
+        PAUSE: (None, [
+            ("wait_elapsed", None, GO_TO_MIDDLE_CIRCLE, ["set_unpause", "set_waiting_for_start", "set_initial_screen", "set_start_experiment", "set_go_to_middle_circle"]),
+        ]),
+        EXIT: (None, [
+            ("enter_pressed", None, EXIT, ["stop_loop"]),
+        ]),
+    }
+    
+    # checked after the transitions of the current state, except in these states
+    TIME_UP_TRANSITIONS = [
+        ("time_up_before_last_block", None, PAUSE, ["set_pause"]),
+        ("time_up", None, EXIT, ["set_exit"]),
+    ]
+    TIME_UP_EXEMPT_STATES = {PAUSE, EXIT, STAY_IN_RIGHT_CIRCLE, STAY_IN_LEFT_CIRCLE, GO_TO_RIGHT_CIRCLE_AFTER_TRIAL, GO_TO_LEFT_CIRCLE_AFTER_TRIAL}
+    
+    def __init__(self, clock=monotonic, seed=None):
+        # `clock` returns the time in s, e.g. a virtual clock for replays. the wait times are drawn from a generator
+        # seeded with `seed`, or from the global numpy generator without a seed.
+        self.current_state = None
+        self.clock = clock
+        self.rng = np.random if seed is None else np.random.default_rng(seed)
+        # one clock sample per tick, used by all guards and actions
+        self.now = None
+        self.continue_loop = True
+        
+        # state transitions since the last `pop_events`, one per transition taken, and the outcome of the trial terminated by the current transition
+        self.events = []
+        self.trial_outcome = None
+        
+        # construct reverse state lookup
+        all_variables = vars(StateMachine)
+        self.reverse_state_lookup = {all_variables[name]: name for name in all_variables if isinstance(all_variables[name], int) and name.isupper()}
+        
+        # circle geometry as (x, y, radius, squared radius, squared overshoot radius), recomputed when the interface layout changes
+        self.regions = None
+        self._layout = None
+        self.main_circle_x, self.main_circle_y = 0.0, 0.0
+        
+        self.transitions = self._build_transitions(StateMachine.TRANSITIONS)
+        self.time_up_transitions = self._build_transitions({None: (None, StateMachine.TIME_UP_TRANSITIONS)})[None][1]
+        self._check_reachable()
+    
+    def _build_transitions(self, table):
+        # resolves the guard and action names of the table and checks that every transition leads to a state with transitions
+        guards = {
+            "always": lambda state_dict, circle: True,
+            "is_recording": lambda state_dict, circle: state_dict["is_recording"] == True,
+            "enter_pressed": lambda state_dict, circle: state_dict["enter_pressed"],
+            "wait_elapsed": lambda state_dict, circle: self.now - state_dict["state_start_time"] >= state_dict["state_wait_time"],
+            "inside": lambda state_dict, circle: self._squared_distance(circle) < self.regions[circle][3],
+            "outside": lambda state_dict, circle: self._squared_distance(circle) > self.regions[circle][3],
+            "not_inside": lambda state_dict, circle: self._squared_distance(circle) >= self.regions[circle][3],
+            "overshot": lambda state_dict, circle: self._squared_distance(circle) > self.regions[circle][4],
+            # the main circle passed the target circle along x
+            "passed": lambda state_dict, circle: self.main_circle_x > self.regions[circle][0] + self.regions[circle][2] if circle == "right" else self.main_circle_x < self.regions[circle][0] - self.regions[circle][2],
+            "time_up_before_last_block": lambda state_dict, circle: state_dict["remaining_time"] == 0 and state_dict["block_idx"] < state_dict["total_blocks"] - 1,
+            "time_up": lambda state_dict, circle: state_dict["remaining_time"] == 0,
+        }
+        circle_guards = {"inside", "outside", "not_inside", "overshot", "passed"}
+        
+        transitions = {}
+        for state, (tick_action, state_transitions) in table.items():
+            assert state is None or state in self.reverse_state_lookup, f"Unknown state {state}."
+            assert tick_action is None or callable(getattr(self, tick_action, None)), f"Unknown action {tick_action} in state {self.reverse_state_lookup.get(state)}."
+            
+            built_transitions = []
+            for guard, circle, next_state, actions in state_transitions:
+                assert guard in guards, f"Unknown guard {guard} in state {self.reverse_state_lookup.get(state)}."
+                assert (circle in StateMachine.CIRCLE_NAMES) == (guard in circle_guards), f"Guard {guard} in state {self.reverse_state_lookup.get(state)} has a wrong circle {circle}."
+                assert next_state in StateMachine.TRANSITIONS, f"Transition from {self.reverse_state_lookup.get(state)} to {next_state}, which has no transitions."
                 
-        elif self.current_state == StateMachine.EXIT:
-            if state_dict["enter_pressed"]:
-                continue_loop = False
+                built_actions = []
+                for action in actions:
+                    action_name, arguments = (action, ()) if isinstance(action, str) else (action[0], action[1:])
+                    assert callable(getattr(self, action_name, None)), f"Unknown action {action_name} in state {self.reverse_state_lookup.get(state)}."
+                    built_actions.append((getattr(self, action_name), arguments))
+                built_transitions.append((guards[guard], circle, next_state, built_actions))
+            
+            transitions[state] = (None if tick_action is None else getattr(self, tick_action), built_transitions)
+        return transitions
+    
+    def _check_reachable(self):
+        # every state with transitions can be reached from the initial state
+        reachable, frontier = {None}, [None]
+        while len(frontier) > 0:
+            state = frontier.pop()
+            next_states = [next_state for _, _, next_state, _ in self.transitions[state][1]]
+            if state not in StateMachine.TIME_UP_EXEMPT_STATES:
+                next_states += [next_state for _, _, next_state, _ in self.time_up_transitions]
+            for next_state in next_states:
+                if next_state not in reachable:
+                    reachable.add(next_state)
+                    frontier.append(next_state)
+        unreachable_states = set(self.transitions) - reachable
+        assert len(unreachable_states) == 0, f"Unreachable states: {[self.reverse_state_lookup[state] for state in unreachable_states]}."
+    
+    def _update_regions(self, state_dict):
+        # the interface creates new circle positions whenever it changes the layout
+        layout = state_dict["middle_circle_position"]
+        if layout is self._layout:
+            return
+        main_circle_radius = state_dict["main_circle_radius"]
+        self.regions = {}
+        for name in StateMachine.CIRCLE_NAMES:
+            x, y = state_dict[name + "_circle_position"].tolist()
+            radius = state_dict[name + "_circle_radius"]
+            self.regions[name] = (x, y, radius, radius ** 2, (radius + main_circle_radius) ** 2)
+        self._layout = layout
+    
+    def _squared_distance(self, circle):
+        x, y = self.regions[circle][:2]
+        return (self.main_circle_x - x) ** 2 + (self.main_circle_y - y) ** 2
+    
+    def _take_transition(self, state_dict, transitions):
+        for guard, circle, next_state, actions in transitions:
+            if guard(state_dict, circle):
+                prev_state = self.current_state
+                self.current_state = next_state
+                for action, arguments in actions:
+                    action(state_dict, *arguments)
+                if next_state != prev_state:
+                    self._add_event(prev_state, state_dict)
+                return
+    
+    def maybe_update_state(self, state_dict):
+        self.now = self.clock()
+        self.continue_loop = True
+        
+        if "main_circle_position" in state_dict:
+            self._update_regions(state_dict)
+            self.main_circle_x, self.main_circle_y = state_dict["main_circle_position"].tolist()
+        
+        tick_action, transitions = self.transitions[self.current_state]
+        if tick_action is not None:
+            tick_action(state_dict)
+        self._take_transition(state_dict, transitions)
                 
-        state_dict["remaining_time"] = float(np.clip(state_dict["remaining_time"], a_min=0, a_max=state_dict["total_time"]))
+        state_dict["remaining_time"] = min(max(float(state_dict["remaining_time"]), 0), state_dict["total_time"])
         state_dict["remaining_perc"] = state_dict["remaining_time"] / state_dict["total_time"]
         state_dict["current_state"] = self.reverse_state_lookup[self.current_state]
         
-        if state_dict["remaining_time"] == 0 and \
-           self.current_state not in {StateMachine.PAUSE, StateMachine.STAY_IN_RIGHT_CIRCLE, StateMachine.STAY_IN_LEFT_CIRCLE, StateMachine.GO_TO_RIGHT_CIRCLE_AFTER_TRIAL, StateMachine.GO_TO_LEFT_CIRCLE_AFTER_TRIAL}:
-            if state_dict["block_idx"] < state_dict["total_blocks"] - 1:
-                self.current_state = StateMachine.PAUSE
-                self.set_pause(state_dict)
-                state_dict["needs_update"] = True
-            else:
-                self.current_state = StateMachine.EXIT
-                self.set_exit(state_dict)
-            
-        if "main_circle_position" in state_dict:
-            self.prev_main_circle_position = np.copy(state_dict["main_circle_position"])
+        if self.current_state not in StateMachine.TIME_UP_EXEMPT_STATES:
+            self._take_transition(state_dict, self.time_up_transitions)
             
-        return continue_loop, state_dict
-
-    def _get_line_distance_to_center(self, p0, p1, c):
-        # https://www.wikiwand.com/en/Distance_from_a_point_to_a_line#:~:text=horizontal%20line%20segment.-,Line%20defined%20by%20two%20points,-If%20the%20line
-
-        numerator = np.abs((p1[0] - p0[0]) * (p0[1] - c[1]) - (p0[0] - c[0]) * (p1[1] - p0[1]))
-        denominator = np.linalg.norm(p0 - p1)
-        return numerator / denominator
+        return self.continue_loop, state_dict
+    
+    def pop_events(self):
+        events = self.events
+        self.events = []
+        return events
+
+    def _add_event(self, prev_state, state_dict):
+        to_state = self.reverse_state_lookup[self.current_state]
+        if self.trial_outcome is not None:
+            side, success = self.trial_outcome
+        else:
+            side = "left" if "LEFT" in to_state else "right" if "RIGHT" in to_state else ""
+            success = None
+        self.trial_outcome = None
+        
+        self.events.append({
+            "timestamp": self.now,
+            "block_idx": state_dict["block_idx"],
+            "from_state": self.reverse_state_lookup.get(prev_state, str(prev_state)),
+            "to_state": to_state,
+            "side": side,
+            "success": success,
+        })
+
+    def count_down(self, state_dict):
+        # the block time only runs while the participant moves between the circles
+        state_dict["remaining_time"] -= self.now - self.prev_time
+        self.prev_time = self.now
+    
+    def start_countdown(self, state_dict):
+        self.prev_time = self.now
+    
+    def stop_loop(self, state_dict):
+        self.continue_loop = False
 
     def set_waiting_for_start(self, state_dict):
         state_dict["state_start_time"] = None
@@ -234,7 +299,7 @@ class StateMachine:
         state_dict["main_text"] = "Press <Enter> when ready."
 
     def set_start_experiment(self, state_dict):
-        state_dict["experiment_start"] = time()
+        state_dict["experiment_start"] = self.now
         state_dict["main_circle_offset"] = (state_dict["marker_position"] - state_dict["cbos"])
         state_dict["show_progress_bar"] = state_dict["show_remaining_time"] = state_dict["show_score"] = True
         state_dict["main_text"] = ""
@@ -245,7 +310,7 @@ class StateMachine:
         state_dict["middle_circle_color"] = Colors.DARK_GRAY
 
     def set_in_middle_circle(self, state_dict):
-        state_dict["state_start_time"] = time()
+        state_dict["state_start_time"] = self.now
         state_dict["state_wait_time"] = 2.0 # s
         state_dict["middle_circle_color"] = Colors.BLUE
 
@@ -262,20 +327,20 @@ class StateMachine:
         state_dict["left_circle_color"] = Colors.DARK_GRAY
     
     def set_in_left_circle(self, state_dict):
-        state_dict["state_start_time"] = time()
-        state_dict["state_wait_time"] = np.random.uniform(*state_dict["state_wait_time_range"])
+        state_dict["state_start_time"] = self.now
+        state_dict["state_wait_time"] = self.rng.uniform(*state_dict["state_wait_time_range"])
 
     def set_in_right_circle(self, state_dict):
-        state_dict["state_start_time"] = time()
-        state_dict["state_wait_time"] = np.random.uniform(*state_dict["state_wait_time_range"])
+        state_dict["state_start_time"] = self.now
+        state_dict["state_wait_time"] = self.rng.uniform(*state_dict["state_wait_time_range"])
         
     def set_go_out_of_left_circle(self, state_dict):
-        state_dict["state_start_time"] = time()
+        state_dict["state_start_time"] = self.now
         state_dict["left_circle_color"] = Colors.DARK_GRAY
         state_dict["right_circle_color"] = Colors.BLUE
     
     def set_go_out_of_right_circle(self, state_dict):
-        state_dict["state_start_time"] = time()
+        state_dict["state_start_time"] = self.now
         state_dict["left_circle_color"] = Colors.BLUE
         state_dict["right_circle_color"] = Colors.DARK_GRAY
 
@@ -286,30 +351,37 @@ class StateMachine:
         self.set_go_to_circle(state_dict)
 
     def set_go_to_circle(self, state_dict):
-        state_dict["state_start_time"] = time()
+        state_dict["state_start_time"] = self.now
         state_dict["current_force_amplification"] = state_dict["force_amplification"]
         state_dict["current_force_decay"] = 0
         state_dict["perturbation_mode"] = "regular"
         
     def set_successful_trial(self, state_dict, side):
+        self.trial_outcome = (side, True)
         state_dict["score"] += 1
         state_dict["score_text"] = "Reward: %.2f€" % (state_dict["score"] / 20)
         state_dict[side + "_circle_color"] = Colors.DARK_GREEN
         
     def set_unsuccessful_trial(self, state_dict, side):
+        self.trial_outcome = (side, False)
+        state_dict[side + "_circle_color"] = Colors.RED
+
+    def set_passed_target(self, state_dict, side):
+        # shown as a miss, but the outcome is only decided at the end of the hold that follows
         state_dict[side + "_circle_color"] = Colors.RED
         
     def set_trial_termination(self, state_dict):        
-        state_dict["state_start_time"] = time()
+        state_dict["state_start_time"] = self.now
         state_dict["state_wait_time"] = 0.5
         # state_dict["current_force_amplification"] = 0
         state_dict["current_force_decay"] = state_dict["force_amplification"] / 100
 
     def set_pause(self, state_dict):
-        state_dict["state_start_time"] = time()
+        state_dict["state_start_time"] = self.now
         state_dict["state_wait_time"] = state_dict["pause_duration"]
         state_dict["current_force_amplification"] = 0
         state_dict["main_text"] = "Experiment paused for %d seconds" % state_dict["pause_duration"]
+        state_dict["needs_update"] = True
 
     def set_unpause(self, state_dict):
         state_dict["main_text"] = ""
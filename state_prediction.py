@@ -0,0 +1,72 @@
+import numpy as np
+
+
+class StatePredictor:
+    # extrapolates the COM position and velocity of the newest frame to the time the pullers apply the force:
+    # - constant_velocity: the position moves on with the estimated velocity, the velocity is kept
+    # - constant_acceleration: the velocity also moves on, with the acceleration over the last `acceleration_window` velocity estimates
+    # the horizon is the measured pipeline latency plus `actuation_delay`, or a fixed `horizon`, clipped to [0, `max_horizon`].
+    # the velocity is extrapolated over the horizon plus the delay of the velocity estimator (`velocity_delay_frames`).
+
+    NONE = "none"
+    CONSTANT_VELOCITY = "constant_velocity"
+    CONSTANT_ACCELERATION = "constant_acceleration"
+
+    def __init__(self, model="constant_acceleration", horizon=None, actuation_delay=0.0, velocity_delay_frames=0.0, acceleration_window=10, max_horizon=0.1):
+        assert model in {StatePredictor.NONE, StatePredictor.CONSTANT_VELOCITY, StatePredictor.CONSTANT_ACCELERATION}, "Model must be {none, constant_velocity, constant_acceleration}."
+        assert acceleration_window >= 2, "The acceleration needs at least two velocity estimates."
+        self.model = model
+        self.fixed_horizon = horizon
+        self.actuation_delay = actuation_delay
+        self.velocity_delay_frames = velocity_delay_frames
+        self.max_horizon = max_horizon
+
+        self.velocities = np.zeros((acceleration_window, 3))
+        self.times = np.zeros(acceleration_window)
+        self.acceleration = np.zeros(3)
+        self.frame_period = 0.0
+        self.horizon = 0.0
+        self.n_updates = 0
+
+    def predict(self, position, velocity, timestamp, latency=0.0):
+        # `timestamp` is the frame time, `latency` the time from the frame to sending the force in s.
+        # a frame that is not newer than the previous one is extrapolated with the previous acceleration.
+        window = len(self.times)
+        if self.n_updates == 0 or timestamp > self.times[(self.n_updates - 1) % window]:
+            idx = self.n_updates % window
+            self.velocities[idx] = velocity
+            self.times[idx] = timestamp
+            self.n_updates += 1
+
+            n_frames = min(self.n_updates, window)
+            if n_frames > 1:
+                oldest_idx = (self.n_updates - n_frames) % window
+                time_difference = timestamp - self.times[oldest_idx]
+                self.acceleration = (velocity - self.velocities[oldest_idx]) / time_difference
+                self.frame_period = time_difference / (n_frames - 1)
+
+        horizon = latency + self.actuation_delay if self.fixed_horizon is None else self.fixed_horizon
+        self.horizon = min(max(horizon, 0.0), self.max_horizon)
+
+        if self.model == StatePredictor.NONE:
+            return position, velocity
+        if self.model == StatePredictor.CONSTANT_VELOCITY:
+            return position + velocity * self.horizon, velocity
+
+        # the velocity estimate describes the movement `velocity_delay_frames` ago
+        current_velocity = velocity + self.acceleration * self.velocity_delay_frames * self.frame_period
+        predicted_position = position + current_velocity * self.horizon + 0.5 * self.acceleration * self.horizon ** 2
+        return predicted_position, current_velocity + self.acceleration * self.horizon
+
+
+def create_state_predictor(experiment_config, velocity_estimator):
+    # the predictor configured in `experiment_config`, or None without prediction
+    model = experiment_config.get("prediction_model", StatePredictor.NONE)
+    if model == StatePredictor.NONE:
+        return None
+    return StatePredictor(model=model,
+                          horizon=experiment_config.get("prediction_horizon"),
+                          actuation_delay=experiment_config.get("actuation_delay", 0.0),
+                          velocity_delay_frames=velocity_estimator.delay_frames,
+                          acceleration_window=experiment_config.get("prediction_acceleration_window", 10),
+                          max_horizon=experiment_config.get("prediction_max_horizon", 0.1))
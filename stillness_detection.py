@@ -0,0 +1,51 @@
+import numpy as np
+
+
+class StillnessMonitor:
+    # running bounds and variance (Welford) of every point since the start of the current still period, O(1) per frame.
+    # the period restarts at a frame that makes the bounding box diagonal of a point longer than `max_distance` m, or the
+    # standard deviation of a point (largest axis) larger than `max_std` m. the diagonal is an upper bound of the largest
+    # distance between two positions of a point, so a still period also passes the pairwise distance check.
+
+    def __init__(self, n_points, window_frames, max_distance=0.05, max_std=0.01):
+        self.n_points = n_points
+        self.window_frames = window_frames
+        self.max_distance = max_distance
+        self.max_std = max_std
+
+        self.n_restarts = 0
+        self._restart(None)
+
+    def _restart(self, positions):
+        # starts a new still period, with `positions` as its first frame
+        self.n_frames = 0 if positions is None else 1
+        self.lower = np.full((self.n_points, 3), np.inf) if positions is None else positions.copy()
+        self.upper = np.full((self.n_points, 3), -np.inf) if positions is None else positions.copy()
+        self.mean = np.zeros((self.n_points, 3)) if positions is None else positions.copy()
+        self.m2 = np.zeros((self.n_points, 3))
+        self.ranges = np.zeros(self.n_points)
+        self.stds = np.zeros(self.n_points)
+
+    def update(self, positions):
+        # `positions` is the (n_points, 3) frame; returns whether the current still period spans `window_frames` frames
+        lower = np.minimum(self.lower, positions)
+        upper = np.maximum(self.upper, positions)
+        ranges = np.sqrt(((upper - lower) ** 2).sum(axis=1))
+        if ranges.max() > self.max_distance:
+            self.n_restarts += 1
+            self._restart(positions)
+            return False
+
+        n_frames = self.n_frames + 1
+        delta = positions - self.mean
+        mean = self.mean + delta / n_frames
+        m2 = self.m2 + delta * (positions - mean)
+        stds = np.sqrt(m2.max(axis=1) / n_frames)
+        if stds.max() > self.max_std:
+            self.n_restarts += 1
+            self._restart(positions)
+            return False
+
+        self.n_frames, self.lower, self.upper, self.mean, self.m2 = n_frames, lower, upper, mean, m2
+        self.ranges, self.stds = ranges, stds
+        return self.n_frames >= self.window_frames
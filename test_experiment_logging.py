@@ -0,0 +1,38 @@
+import numpy as np
+
+from experiment_logging import RecordSchema, TsvTrajectoryFile, read_trajectory_chunks
+
+
+def test_list_lengths_change_across_blocks(tmp_path):
+    # the lists of a block's config, e.g. `catch_trial_idxs`, keep the columns of the first block
+    state_dict = {"catch_trial_idxs": [1, 2], "channel_trial_idxs": [4, 5, 6], "marker_position": np.zeros(3), "score": 0}
+    schema = RecordSchema(state_dict)
+    buffer = np.zeros(4, dtype=schema.dtype)
+    schema.encode_into(buffer, 0, state_dict)
+    for idx, (catch_trial_idxs, channel_trial_idxs) in enumerate([([3, 4, 5], [7]), ([], [8, 9, 10, 11]), ([6], [])], start=1):
+        state_dict.update(catch_trial_idxs=catch_trial_idxs, channel_trial_idxs=channel_trial_idxs, score=idx)
+        schema.encode_into(buffer, idx, state_dict)
+
+    filename = str(tmp_path / "experiment_data_00.tsv")
+    trajectory_file = TsvTrajectoryFile(filename, schema)
+    trajectory_file.write_block(buffer)
+    trajectory_file.close()
+
+    column_names, chunk = next(read_trajectory_chunks(filename))
+    assert column_names == ["catch_trial_idxs.0", "catch_trial_idxs.1", "channel_trial_idxs.0", "channel_trial_idxs.1", "channel_trial_idxs.2",
+                            "marker_position.0", "marker_position.1", "marker_position.2", "score"]
+    assert chunk["catch_trial_idxs.0"].tolist() == ["1", "3", "nan", "6"]
+    assert chunk["catch_trial_idxs.1"].tolist() == ["2", "4", "nan", "nan"]
+    assert chunk["channel_trial_idxs.0"].tolist() == ["4", "7", "8", "nan"]
+    assert chunk["channel_trial_idxs.2"].tolist() == ["6", "nan", "10", "nan"]
+    assert chunk["score"].tolist() == ["0", "1", "2", "3"]
+
+
+def test_numbers_are_formatted_like_their_type():
+    state_dict = {"state_wait_time": -1, "state_start_time": 1.5}
+    schema = RecordSchema(state_dict)
+    buffer = np.zeros(2, dtype=schema.dtype)
+    schema.encode_into(buffer, 0, state_dict)
+    state_dict.update(state_wait_time=2.0, state_start_time=None)
+    schema.encode_into(buffer, 1, state_dict)
+    assert schema.format_block(buffer) == "1.5\t-1\nNone\t2.0\n"
@@ -0,0 +1,179 @@
+# trials in the state machine events, shared by the trial index of the logger, the trial summary, the rescoring and the
+# aggregation. a trial starts at the go cue (GO_OUT_OF_*, the target circle turns blue while the COM is still in the start
+# circle) and ends with its outcome at the end of the hold in the target circle, or without one at a pause or the end of
+# the experiment. the movement runs from the COM leaving the start circle (GO_OUT_OF_* -> GO_TO_*) to the target circle
+# being reached or passed (GO_TO_* -> STAY_IN_*); before it is the reaction time, after it the hold.
+TRIAL_START_STATES = {"GO_OUT_OF_LEFT_CIRCLE", "GO_OUT_OF_RIGHT_CIRCLE"}
+MOVEMENT_START_STATES = {"GO_TO_LEFT_CIRCLE", "GO_TO_RIGHT_CIRCLE"}
+MOVEMENT_END_STATES = {"STAY_IN_LEFT_CIRCLE", "STAY_IN_RIGHT_CIRCLE"}
+TRIAL_END_STATES = {"PAUSE", "EXIT"}
+
+
+def is_trial_start(event):
+    return event["to_state"] in TRIAL_START_STATES
+
+
+def is_movement_start(event):
+    return event["to_state"] in MOVEMENT_START_STATES
+
+
+def is_movement_end(event):
+    return event["to_state"] in MOVEMENT_END_STATES
+
+
+def is_trial_end(event):
+    return event["success"] is not None or event["to_state"] in TRIAL_END_STATES
+
+
+def get_trial_side(event):
+    # side of the target circle of a trial start event
+    return "right" if event["to_state"] == "GO_OUT_OF_LEFT_CIRCLE" else "left"
+
+
+class TrialSegmenter:
+    # rows and times of the trials in a stream of events, as [start_row, end_row) of the whole trial and
+    # [movement_start_row, movement_end_row) of its movement. the movement rows and times are None if the trial
+    # ended before them.
+
+    def __init__(self):
+        self.n_trials = 0
+        self.trial = None
+
+    def update(self, events, row_idx):
+        # `events` happened in row `row_idx`; returns the trials that ended in it
+        trials = []
+        for event in events:
+            if is_trial_start(event):
+                self.trial = {
+                    "trial_idx": self.n_trials,
+                    "block_idx": event["block_idx"],
+                    "side": get_trial_side(event),
+                    "start_row": row_idx,
+                    "start_time": event["timestamp"],
+                    "movement_start_row": None,
+                    "movement_end_row": None,
+                    "movement_start_time": None,
+                    "movement_end_time": None,
+                }
+                self.n_trials += 1
+            elif self.trial is None:
+                continue
+            elif is_movement_start(event):
+                self.trial.update(movement_start_row=row_idx, movement_start_time=event["timestamp"])
+            elif is_movement_end(event):
+                self.trial.update(movement_end_row=row_idx + 1, movement_end_time=event["timestamp"])
+            elif is_trial_end(event):
+                self.trial.update(end_row=row_idx + 1, end_time=event["timestamp"], success=event["success"])
+                trials.append(self.trial)
+                self.trial = None
+        return trials
+
+
+class TrialAccumulator:
+    # streaming per-trial metrics, updated once per loop tick in O(1), over the trials of `is_trial_start` and `is_trial_end`.
+    # - reaction_time, movement_time, hold_time: from the go cue to the start of the movement, of the movement, and from its
+    #   end to the outcome, in s (None if the trial ended before)
+    # - peak_velocity, mean_velocity: of the COM speed over the ticks of the movement, in m/s
+    # - path_length: distance travelled by the COM during the movement in m
+    # - overshoot: how far the COM moved past the center of the target circle, along the movement, during the movement
+    #   and the hold, in m
+    # - peak_motor_force: largest absolute motor force during the movement and the hold, in N
+
+    def __init__(self):
+        self.n_trials = 0
+        self.trial = None
+        self.peak_velocity = 0.0
+
+    def update(self, state_dict, events):
+        # `events` are the state machine events of this tick; returns the summaries of the trials that ended in this tick.
+        # the tick that starts the movement and the tick that ends it both count to the movement.
+        for event in events:
+            if is_trial_start(event):
+                self._start(event, state_dict)
+            elif self.trial is not None and is_movement_start(event):
+                self.trial["movement_start_time"] = event["timestamp"]
+                self.trial["is_moving"] = True
+                self.trial["last_position"] = state_dict["marker_position"].tolist()
+
+        trial = self.trial
+        if trial is None:
+            return []
+
+        if trial["is_moving"]:
+            # python floats, indexing numpy arrays element by element is slower
+            velocity = state_dict["marker_velocity"].tolist()
+            speed = (velocity[0] * velocity[0] + velocity[1] * velocity[1] + velocity[2] * velocity[2]) ** 0.5
+            if speed > self.peak_velocity:
+                self.peak_velocity = speed
+            trial["velocity_sum"] += speed
+            trial["n_ticks"] += 1
+
+            position = state_dict["marker_position"].tolist()
+            last_position = trial["last_position"]
+            trial["path_length"] += ((position[0] - last_position[0]) ** 2 + (position[1] - last_position[1]) ** 2 + (position[2] - last_position[2]) ** 2) ** 0.5
+            trial["last_position"] = position
+
+        if trial["movement_start_time"] is not None:
+            # on screen, positive overshoot is past the target circle away from the start circle
+            overshoot = trial["direction"] * (float(state_dict["main_circle_position"][0]) - trial["target_x"]) / trial["scale"]
+            if overshoot > trial["overshoot"]:
+                trial["overshoot"] = overshoot
+            motor_force = abs(float(state_dict["motor_force"]))
+            if motor_force > trial["peak_motor_force"]:
+                trial["peak_motor_force"] = motor_force
+
+        for event in events:
+            if is_movement_end(event):
+                trial["movement_end_time"] = event["timestamp"]
+                trial["is_moving"] = False
+            elif is_trial_end(event):
+                return [self._finish(event, state_dict)]
+        return []
+
+    def _start(self, event, state_dict):
+        side = get_trial_side(event)
+        start_x = state_dict[("left" if side == "right" else "right") + "_circle_position"][0]
+        target_x = float(state_dict[side + "_circle_position"][0])
+        self.trial = {
+            "trial_idx": self.n_trials,
+            "block_idx": event["block_idx"],
+            "side": side,
+            "start_time": event["timestamp"],
+            "movement_start_time": None,
+            "movement_end_time": None,
+            "is_moving": False,
+            "direction": 1.0 if target_x > start_x else -1.0,
+            "target_x": target_x,
+            "scale": state_dict["pixels_per_m"] * state_dict["display_scaling"],
+            "last_position": None,
+            "velocity_sum": 0.0,
+            "n_ticks": 0,
+            "path_length": 0.0,
+            "overshoot": 0.0,
+            "peak_motor_force": 0.0,
+        }
+        self.n_trials += 1
+        self.peak_velocity = 0.0
+
+    def _finish(self, event, state_dict):
+        trial = self.trial
+        self.trial = None
+        movement_start_time, movement_end_time = trial["movement_start_time"], trial["movement_end_time"]
+        return {
+            "trial_idx": trial["trial_idx"],
+            "block_idx": trial["block_idx"],
+            "side": trial["side"],
+            "success": event["success"],
+            "perturbation_mode": state_dict["perturbation_mode"],
+            "force_amplification": state_dict["force_amplification"],
+            "start_time": trial["start_time"],
+            "end_time": event["timestamp"],
+            "reaction_time": None if movement_start_time is None else movement_start_time - trial["start_time"],
+            "movement_time": None if movement_end_time is None else movement_end_time - movement_start_time,
+            "hold_time": None if movement_end_time is None else event["timestamp"] - movement_end_time,
+            "peak_velocity": self.peak_velocity,
+            "mean_velocity": trial["velocity_sum"] / trial["n_ticks"] if trial["n_ticks"] > 0 else None,
+            "path_length": trial["path_length"],
+            "overshoot": trial["overshoot"],
+            "peak_motor_force": trial["peak_motor_force"],
+        }
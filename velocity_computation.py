@@ -0,0 +1,118 @@
+from time import perf_counter
+
+import numpy as np
+from scipy.signal import savgol_coeffs
+
+
+class VelocityEstimator:
+    # velocity of several points (e.g. all markers and the COM) from a preallocated ring of their last positions.
+    # every update is O(1) in the length of the recording:
+    # - boxcar: mean of the last `buffer_size` finite differences, kept as a running sum (same as `ViconClient.get_velocity`)
+    # - central_difference: one difference over the last `buffer_size` frames, i.e. the velocity in the middle of the window
+    # - savitzky_golay: derivative of a `polyorder` polynomial fitted to the last `buffer_size` frames, evaluated at the newest frame
+
+    BOXCAR = "boxcar"
+    CENTRAL_DIFFERENCE = "central_difference"
+    SAVITZKY_GOLAY = "savitzky_golay"
+
+    def __init__(self, n_points, buffer_size=5, kernel="boxcar", polyorder=2, resum_interval=10000):
+        assert kernel in {VelocityEstimator.BOXCAR, VelocityEstimator.CENTRAL_DIFFERENCE, VelocityEstimator.SAVITZKY_GOLAY}, "Kernel must be {boxcar, central_difference, savitzky_golay}."
+        self.n_points = n_points
+        self.buffer_size = buffer_size
+        self.kernel = kernel
+        self.resum_interval = resum_interval
+
+        self.positions = np.zeros((buffer_size + 1, n_points, 3))
+        self.times = np.zeros(buffer_size + 1)
+        self.differences = np.zeros((buffer_size, n_points, 3))
+        self.difference_sum = np.zeros((n_points, 3))
+        self.velocity = np.zeros((n_points, 3))
+        self.n_updates = 0
+        # how many frames the estimate lags behind the newest frame, for a constant acceleration
+        self.delay_frames = 0.0 if kernel == VelocityEstimator.SAVITZKY_GOLAY else buffer_size / 2
+
+        if kernel == VelocityEstimator.SAVITZKY_GOLAY:
+            assert buffer_size > polyorder, "Savitzky-Golay needs more frames than the polynomial order."
+            # coefficients for unit sample spacing, oldest frame first
+            self.coefficients = savgol_coeffs(buffer_size, polyorder, deriv=1, pos=buffer_size - 1, use="dot")
+            self.window_idxs = [(np.arange(buffer_size) + offset) % (buffer_size + 1) for offset in range(buffer_size + 1)]
+
+    def update(self, positions, timestamp):
+        # `positions` is (n_points, 3), `timestamp` should be the Vicon frame time.
+        # a frame that is not newer than the previous one (e.g. the same Vicon frame read twice) returns the previous estimate.
+        ring_size = self.buffer_size + 1
+        prev_idx = (self.n_updates - 1) % ring_size
+        if self.n_updates > 0 and timestamp <= self.times[prev_idx]:
+            return self.velocity
+
+        idx = self.n_updates % ring_size
+        self.positions[idx] = positions
+        self.times[idx] = timestamp
+
+        if self.kernel == VelocityEstimator.BOXCAR:
+            difference_idx = self.n_updates % self.buffer_size
+            self.difference_sum -= self.differences[difference_idx]
+            if self.n_updates == 0:
+                self.differences[difference_idx] = 0
+            else:
+                self.differences[difference_idx] = (positions - self.positions[prev_idx]) / (timestamp - self.times[prev_idx])
+            self.difference_sum += self.differences[difference_idx]
+
+            # the running sum slowly accumulates rounding errors
+            if (self.n_updates + 1) % self.resum_interval == 0:
+                self.difference_sum = self.differences.sum(axis=0)
+            self.velocity = self.difference_sum / min(self.n_updates + 1, self.buffer_size)
+
+        elif self.kernel == VelocityEstimator.SAVITZKY_GOLAY and self.n_updates + 1 >= self.buffer_size:
+            window_idxs = self.window_idxs[(self.n_updates - self.buffer_size + 1) % ring_size]
+            frame_time = (timestamp - self.times[window_idxs[0]]) / (self.buffer_size - 1)
+            self.velocity = (self.coefficients @ self.positions[window_idxs].reshape(self.buffer_size, -1)).reshape(self.n_points, 3) / frame_time
+
+        else:
+            # central difference, also used by Savitzky-Golay until its window is filled
+            window = min(self.n_updates, self.buffer_size)
+            if window == 0:
+                self.velocity = np.zeros((self.n_points, 3))
+            else:
+                oldest_idx = (self.n_updates - window) % ring_size
+                self.velocity = (positions - self.positions[oldest_idx]) / (timestamp - self.times[oldest_idx])
+
+        self.n_updates += 1
+        return self.velocity
+
+
+def benchmark_velocity_estimators(buffer_size=5, frequency=200, duration=60, noise=0.0005, n_points=10, seed=42):
+    # per-call cost, delay with respect to the true velocity and RMS error of every kernel on a noisy, sway-like COM trajectory
+    rng = np.random.default_rng(seed)
+    times = np.arange(int(duration * frequency)) / frequency
+    frequencies = np.array([0.3, 0.7, 1.3])
+    amplitudes = np.array([0.03, 0.02, 0.01])
+    true_positions = (amplitudes * np.sin(2 * np.pi * frequencies * times[:, None])).sum(axis=1)
+    true_velocities = (amplitudes * 2 * np.pi * frequencies * np.cos(2 * np.pi * frequencies * times[:, None])).sum(axis=1)
+    positions = np.zeros((len(times), n_points, 3))
+    positions[:, :, 0] = true_positions[:, None] + rng.normal(0, noise, size=(len(times), n_points))
+
+    results = {}
+    for kernel in [VelocityEstimator.BOXCAR, VelocityEstimator.CENTRAL_DIFFERENCE, VelocityEstimator.SAVITZKY_GOLAY]:
+        estimator = VelocityEstimator(n_points, buffer_size=buffer_size, kernel=kernel)
+        estimates = np.zeros(len(times))
+        time_start = perf_counter()
+        for idx in range(len(times)):
+            estimates[idx] = estimator.update(positions[idx], times[idx])[0, 0]
+        call_time = (perf_counter() - time_start) / len(times)
+
+        # delay that best aligns the estimate with the true velocity
+        skip = buffer_size * 2
+        lags = np.arange(0, 4 * buffer_size)
+        errors = [np.mean((estimates[skip + lag:] - true_velocities[skip:len(times) - lag]) ** 2) for lag in lags]
+        results[kernel] = {
+            "call_time_us": call_time * 1e6,
+            "delay_ms": lags[int(np.argmin(errors))] / frequency * 1000,
+            "rms_error": float(np.sqrt(np.mean((estimates[skip:] - true_velocities[skip:]) ** 2))),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    for kernel, result in benchmark_velocity_estimators().items():
+        print("%-20s %8.2f us/call %8.1f ms delay %10.5f m/s RMS error" % (kernel, result["call_time_us"], result["delay_ms"], result["rms_error"]))
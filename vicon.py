@@ -1,11 +1,17 @@
-from time import time
+from time import time, monotonic
 from datetime import datetime
 import socket
+import threading
 from multiprocessing import Process, Value
 from collections import defaultdict
 
 import numpy as np
-from vicon_dssdk import ViconDataStream
+
+try:
+    from vicon_dssdk import ViconDataStream
+except ImportError:
+    # allows offline tools to use `MARKER_NAMES` and to replay recorded sessions without the Vicon SDK installed
+    import vicon_replay as ViconDataStream
 
 
 MARKER_NAMES = [
@@ -23,10 +29,11 @@ MARKER_NAMES = [
 
 class ViconClient:
     
-    def __init__(self, subject_name="WholeBodyLearningExp", address="localhost", port=801, velocity_buffer_size=5):
+    def __init__(self, subject_name="WholeBodyLearningExp", address="localhost", port=801, velocity_buffer_size=5, client=None, listen_for_recording=True):
         self.address = address
         self.port = port
-        self.client = ViconDataStream.Client()
+        # `client` replaces the SDK client, e.g. with `vicon_replay.Client`
+        self.client = ViconDataStream.Client() if client is None else client
 
         self.subject_name = subject_name
         self.prev_marker_positions = dict()
@@ -35,10 +42,32 @@ class ViconClient:
         self.velocity_buffer_size = velocity_buffer_size
         self.velocity_buffer = defaultdict(list)
         
+        # fixed frame layout, row i of every frame array belongs to MARKER_NAMES[i]
+        self.marker_idxs = {marker_name: marker_idx for marker_idx, marker_name in enumerate(MARKER_NAMES)}
+        self.use_labeled_markers = True
+        self.frame_positions = np.zeros((len(MARKER_NAMES), 3))
+        self.frame_occluded = np.zeros(len(MARKER_NAMES), dtype=bool)
+        
+        # double buffer of the latest frame, filled by the acquisition thread
+        self.acquisition_thread = None
+        self._position_buffers = np.zeros((2, len(MARKER_NAMES), 3))
+        self._occluded_buffers = np.zeros((2, len(MARKER_NAMES)), dtype=bool)
+        self._latest_frame = None
+        self._first_frame = threading.Event()
+        self._stop_acquisition = threading.Event()
+        self.acquisition_errors = 0
+        self.acquisition_exception = None
+        # Vicon system latency of the newest frame in s, from camera exposure to the SDK
+        self.latency = 0.0
+        
         self.init_connection(self.client)
 
         self._is_recording = Value("i", 0)
-        self.udp_listener = Process(target=self._get_recording_state, args=(self._is_recording, ), daemon=True).start()
+        self.udp_listener = None
+        if listen_for_recording:
+            self.udp_listener = Process(target=self._get_recording_state, args=(self._is_recording, ), daemon=True).start()
+        else:
+            self._is_recording.value = 1
         
     def init_connection(self, client):
         client.Connect(self.address + ":" + str(self.port))
@@ -59,15 +88,107 @@ class ViconClient:
         client.EnableCentroidData()
 
         # Try setting the different stream modes
-        client.SetStreamMode(ViconDataStream.Client.StreamMode.EServerPush)
+        client.SetStreamMode(client.StreamMode.EServerPush)
         # print("Get Frame Push", client.GetFrame(), client.GetFrameNumber())
 
     def is_recording(self):
         return bool(self._is_recording.value)
     
-    def get_current_position(self, name, mode="segment"):
-        assert mode in {"segment", "marker", "all_markers"} or isinstance(mode, list), "Mode must be {segment, marker, all_markers}, or a list of marker names."
+    def start_acquisition(self, timeout=5.0):
+        # pulls frames in a dedicated thread, so the control loop never waits on the SDK.
+        # while it runs, the SDK must only be used by the acquisition thread, i.e. through `get_latest_frame`.
+        assert self.acquisition_thread is None, "Acquisition is already running."
+        self._stop_acquisition.clear()
+        self.acquisition_thread = threading.Thread(target=self._acquire, daemon=True)
+        self.acquisition_thread.start()
+        assert self._first_frame.wait(timeout), f"No frame received from Vicon in {timeout}s."
+        if self.acquisition_exception is not None:
+            raise self.acquisition_exception
+        
+    def stop_acquisition(self):
+        if self.acquisition_thread is not None:
+            self._stop_acquisition.set()
+            # GetFrame blocks while the server sends no frames, so do not wait forever
+            self.acquisition_thread.join(timeout=1.0)
+            self.acquisition_thread = None
+    
+    def _acquire(self):
+        while not self._stop_acquisition.is_set():
+            try:
+                # in ServerPush mode this blocks until the next frame arrives
+                self.client.GetFrame()
+                frame_number = self.client.GetFrameNumber()
+                frame_rate = self.client.GetFrameRate()
+                self.latency = self.client.GetLatencyTotal()
+            except ViconDataStream.DataStreamException as e:
+                self.acquisition_errors += 1
+                continue
+            except Exception as e:
+                # e.g. the end of a replayed session, raised to the control loop by `get_latest_frame`
+                self.acquisition_exception = e
+                self._first_frame.set()
+                return
+            receive_time = monotonic()
+            
+            # write into the buffer that is not published, then publish it with a single reference assignment
+            buffer_idx = 0 if self._latest_frame is None else 1 - self._latest_frame[0]
+            self._fill_frame(self._position_buffers[buffer_idx], self._occluded_buffers[buffer_idx])
+            
+            self._latest_frame = (buffer_idx, frame_number, frame_number / frame_rate, receive_time)
+            self._first_frame.set()
+            
+    def get_latest_frame(self):
+        # returns copies of the newest (len(MARKER_NAMES), 3) marker positions and occlusion flags, its Vicon frame number,
+        # its Vicon time (frame number / frame rate) and its monotonic receive time, or None before the first frame.
+        # the published buffer is only rewritten after the other one is published, so the copy is consistent.
+        if self.acquisition_exception is not None:
+            raise self.acquisition_exception
+        latest_frame = self._latest_frame
+        if latest_frame is None:
+            return None
+        buffer_idx, frame_number, frame_time, receive_time = latest_frame
+        return self._position_buffers[buffer_idx].copy(), self._occluded_buffers[buffer_idx].copy(), frame_number, frame_time, receive_time
+    
+    def get_frame(self):
+        # fetches the next frame into the preallocated (len(MARKER_NAMES), 3) positions and occlusion flags.
+        # the returned arrays are overwritten by the next call.
+        assert self.acquisition_thread is None, "Use get_latest_frame while the acquisition thread is running."
+        self._wait_for_frame()
+        frame_number = self.client.GetFrameNumber()
+        frame_time = frame_number / self.client.GetFrameRate()
+        self.latency = self.client.GetLatencyTotal()
+        self._fill_frame(self.frame_positions, self.frame_occluded)
+        return self.frame_positions, self.frame_occluded, frame_number, frame_time
+    
+    def _fill_frame(self, positions, occluded):
+        # occluded markers have zero positions, as reported by GetMarkerGlobalTranslation
+        if self.use_labeled_markers:
+            # a single SDK call for all labeled markers, ((x, y, z), (subject_name, marker_name)) each;
+            # markers of the subject that are not labeled in this frame are occluded
+            try:
+                labeled_markers = self.client.GetLabeledMarkers()
+                occluded[:] = True
+                for marker_position, (subject_name, marker_name) in labeled_markers:
+                    marker_idx = self.marker_idxs.get(marker_name)
+                    if marker_idx is not None and subject_name == self.subject_name:
+                        positions[marker_idx] = marker_position
+                        occluded[marker_idx] = False
+            except (AttributeError, TypeError, ValueError):
+                # this SDK version reports labeled markers differently, use one call per marker from now on
+                print(f"{datetime.now()} - Labeled markers not available, querying markers one by one.")
+                self.use_labeled_markers = False
+            else:
+                if not (occluded.all() and len(labeled_markers) > 0):
+                    positions[occluded] = 0
+                    positions /= 1000
+                    return
+                # none of the subject's markers are labeled while other markers are, query this frame marker by marker
         
+        for marker_idx, marker_name in enumerate(MARKER_NAMES):
+            positions[marker_idx], occluded[marker_idx] = self.client.GetMarkerGlobalTranslation(self.subject_name, marker_name)
+        positions /= 1000
+    
+    def _wait_for_frame(self):
         has_frame = False
         while not has_frame:
             try:
@@ -75,6 +196,12 @@ class ViconClient:
                 has_frame = True
             except ViconDataStream.DataStreamException as e:
                 print(f"Error: '{str(e)}' ")
+    
+    def get_current_position(self, name, mode="segment"):
+        assert self.acquisition_thread is None, "Use get_latest_frame while the acquisition thread is running."
+        assert isinstance(mode, list) or mode in {"segment", "marker", "all_markers"}, "Mode must be {segment, marker, all_markers}, or a list of marker names."
+        
+        self._wait_for_frame()
 
         if mode == "segment":
             segment_position = self.client.GetSegmentGlobalTranslation(self.subject_name, name)
@@ -97,6 +224,7 @@ class ViconClient:
                 positions[marker_name] = np.array(marker_position[0]) / 1000
         
         elif isinstance(mode, list):
+            positions = dict()
             for marker_name in mode:
                 marker_position = self.client.GetMarkerGlobalTranslation(self.subject_name, marker_name)
                 positions[marker_name] = np.array(marker_position[0]) / 1000
@@ -119,13 +247,8 @@ class ViconClient:
         return np.stack(self.velocity_buffer[name], axis=0).mean(axis=0)
 
     def get_center_of_pressure(self):
-        has_frame = False
-        while not has_frame:
-            try:
-                self.client.GetFrame()
-                has_frame = True
-            except ViconDataStream.DataStreamException as e:
-                print(f"Error: '{str(e)}' ")
+        assert self.acquisition_thread is None, "The Vicon SDK is used by the acquisition thread."
+        self._wait_for_frame()
 
         cop0 = np.array(self.client.GetGlobalCenterOfPressure(1)).mean(axis=0)
         cop1 = np.array(self.client.GetGlobalCenterOfPressure(2)).mean(axis=0)
@@ -0,0 +1,157 @@
+from time import monotonic, sleep
+
+import numpy as np
+
+from experiment_logging import read_trajectory_chunks
+
+
+class DataStreamException(Exception):
+    pass
+
+
+class ReplayFinished(Exception):
+    pass
+
+
+class Client:
+    # stand-in for `vicon_dssdk.ViconDataStream.Client` that streams the marker (and, if recorded, COP) frames of a
+    # logged experiment_data_XX.tsv or calibration_recording.tsv file. frames are paced by their logged timestamps,
+    # `speed` times faster than real time, or as fast as they are requested if `speed` is None.
+
+    class StreamMode:
+        EClientPull = 0
+        EClientPullPreFetch = 1
+        EServerPush = 2
+
+    def __init__(self, filename=None, speed=1.0, loop=False, subject_name="WholeBodyLearningExp", frame_rate=None, chunk_size=10000):
+        assert filename is not None, "vicon_dssdk is not installed, pass a recorded session to replay instead."
+        assert speed is None or speed > 0, "Speed must be positive, or None to replay as fast as possible."
+        self.filename = filename
+        self.speed = speed
+        self.loop = loop
+        self.subject_name = subject_name
+        self.frame_rate = frame_rate
+        self.chunk_size = chunk_size
+
+        self.marker_names = None
+        self.has_cop = False
+        self.frame_number = 0
+        self.position = None
+        self.cop = np.zeros(3)
+
+        self._frames = None
+        self._next_frame = None
+        self._replay_start = None
+        self._first_time = None
+        self._time_offset = 0.0
+
+    def Connect(self, address):
+        self._frames = self._read_frames()
+        self._next_frame = next(self._frames)
+        self._replay_start = monotonic()
+        self._first_time = self._next_frame[0]
+
+    def GetVersion(self):
+        return "replay"
+
+    def SetBufferSize(self, buffer_size):
+        pass
+
+    def EnableSegmentData(self):
+        pass
+
+    def EnableMarkerData(self):
+        pass
+
+    def EnableUnlabeledMarkerData(self):
+        pass
+
+    def EnableMarkerRayData(self):
+        pass
+
+    def EnableDeviceData(self):
+        pass
+
+    def EnableCentroidData(self):
+        pass
+
+    def SetStreamMode(self, stream_mode):
+        pass
+
+    def _read_frames(self):
+        # yields (timestamp, marker positions in mm, cop) of every row with a newer timestamp than the previous one
+        from vicon import MARKER_NAMES
+        while True:
+            prev_timestamp = -np.inf
+            for column_names, chunk in read_trajectory_chunks(self.filename, chunk_size=self.chunk_size):
+                if self.marker_names is None:
+                    self.marker_names = [marker_name for marker_name in MARKER_NAMES if f"{marker_name}.0" in chunk]
+                    self.has_cop = "cop.0" in chunk
+                    if self.frame_rate is None:
+                        time_differences = np.diff(chunk["marker_timestamp"].astype(float))
+                        self.frame_rate = 1 / np.median(time_differences[time_differences > 0])
+
+                timestamps = chunk["marker_timestamp"].astype(float)
+                positions = np.stack([np.stack([chunk[f"{marker_name}.{idx}"].astype(float) for idx in range(3)], axis=1) for marker_name in self.marker_names], axis=1) * 1000
+                cops = np.stack([chunk[f"cop.{idx}"].astype(float) for idx in range(3)], axis=1) if self.has_cop else np.zeros((len(timestamps), 3))
+
+                for row_idx in range(len(timestamps)):
+                    if timestamps[row_idx] > prev_timestamp:
+                        prev_timestamp = timestamps[row_idx]
+                        yield timestamps[row_idx] + self._time_offset, positions[row_idx], cops[row_idx]
+
+            if not self.loop:
+                return
+            # continue the timestamps after the end of the recording
+            self._time_offset = prev_timestamp + 1 / self.frame_rate - self._first_time + self._time_offset
+
+    def GetFrame(self):
+        if self._next_frame is None:
+            raise ReplayFinished(f"Reached the end of {self.filename}.")
+
+        if self.speed is not None:
+            # wait until the next frame is due, then skip to the newest frame that is due, as a live server would
+            due_time = self._replay_start + (self._next_frame[0] - self._first_time) / self.speed
+            wait_time = due_time - monotonic()
+            if wait_time > 0:
+                sleep(wait_time)
+
+        while True:
+            _, self.position, self.cop = self._next_frame
+            self.frame_number += 1
+            self._next_frame = next(self._frames, None)
+            if self.speed is None or self._next_frame is None or self._replay_start + (self._next_frame[0] - self._first_time) / self.speed > monotonic():
+                break
+
+    def GetFrameNumber(self):
+        return self.frame_number
+
+    def GetFrameRate(self):
+        return self.frame_rate
+
+    def GetLatencyTotal(self):
+        # recorded frames are replayed as soon as they are due
+        return 0.0
+
+    def GetMarkerNames(self, subject_name):
+        return [(marker_name, "") for marker_name in self.marker_names]
+
+    def GetMarkerGlobalTranslation(self, subject_name, marker_name):
+        return tuple(self.position[self.marker_names.index(marker_name)]), False
+
+    def GetLabeledMarkers(self):
+        return [(tuple(position), (self.subject_name, marker_name)) for marker_name, position in zip(self.marker_names, self.position)]
+
+    def GetGlobalCenterOfPressure(self, plate_idx):
+        # the recording holds the combined COP only; both plates report it with equal force
+        assert self.has_cop, f"{self.filename} has no center of pressure columns."
+        return [tuple(self.cop)]
+
+    def GetGlobalForceVector(self, plate_idx):
+        return [(0.0, 0.0, 1.0)]
+
+
+def create_replay_client(filename, speed=1.0, loop=False, **kwargs):
+    # a ViconClient that replays `filename` and always reports that Vicon is recording
+    from vicon import ViconClient
+    return ViconClient(client=Client(filename, speed=speed, loop=loop), listen_for_recording=False, **kwargs)